@@ -0,0 +1,5 @@
+"""
+Reproducible benchmarks of epana with seeded synthetic data.
+
+Run `python -m epana.bench --help` for the command-line interface.
+"""
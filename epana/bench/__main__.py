@@ -0,0 +1,49 @@
+"""
+Command-line entry point: `python -m epana.bench`.
+"""
+import argparse
+import sys
+
+from epana.bench.suite import BENCHMARKS
+from epana.bench.suite import compare
+from epana.bench.suite import run_suite
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m epana.bench',
+                                     description='Run epana benchmarks.')
+    parser.add_argument('names', nargs='*', help='benchmarks (default all): '
+                        + ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='bench_results.json',
+                        help='results file (default %(default)s)')
+    parser.add_argument('--baseline', help='baseline results to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional growth (default 0.2)')
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.names or None, scale=args.scale,
+                        repeat=args.repeat, seed=args.seed,
+                        results_fn=args.out)
+    for name, res in sorted(results['benchmarks'].items()):
+        if 'error' in res:
+            print('%-28s ERROR %s' % (name, res['error']))
+        else:
+            print('%-28s %10.4f s %12.1f MiB%s' % (
+                name, res['secs'], res['peak_bytes'] / 2**20,
+                ' (result %.1f MiB)' % (res['result_bytes'] / 2**20)
+                if 'result_bytes' in res else ''))
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance,
+                              args.tolerance)
+        for (name, metric, base, cur, ratio) in regressions:
+            print('REGRESSION %s %s: %.4g -> %.4g (x%.2f)' %
+                  (name, metric, base, cur, ratio))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
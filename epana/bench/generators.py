@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Evan T. Phelps
+#
+# Distributed under terms of the MIT license.
+"""
+Seeded synthetic data generators for benchmarks.  The same seed always
+produces the same bytes.
+"""
+##############################################################################
+import bz2
+import contextlib
+import gzip
+import lzma
+import string
+
+import numpy as np
+
+import pandas as pd
+
+_ACCENTED = 'áéíóúñçüÁÉÍÓÚÑÇÜ'
+_WORDS = np.array(['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta',
+                   'eta', 'theta', 'iota', 'kappa', 'lambda', 'mu'])
+
+
+def _words(rng, n, null_frac=0.05):
+    vals = _WORDS[rng.integers(0, len(_WORDS), n)].astype(object)
+    vals[rng.random(n) < null_frac] = None
+    return vals
+
+
+def wide_frame(n_rows=10000, n_cols=50, seed=0):
+    """Dataframe of n_cols columns cycling through int, float, categorical
+    word, free text, and date columns, with about 5% nulls."""
+    rng = np.random.default_rng(seed)
+    cols = {}
+    for j in range(n_cols):
+        kind = j % 5
+        if kind == 0:
+            cols['int%d' % j] = rng.integers(0, 1000, n_rows)
+        elif kind == 1:
+            vals = rng.normal(100, 15, n_rows).round(2)
+            vals[rng.random(n_rows) < 0.05] = np.nan
+            cols['float%d' % j] = vals
+        elif kind == 2:
+            cols['word%d' % j] = _words(rng, n_rows)
+        elif kind == 3:
+            letters = np.array(list(string.ascii_letters))
+            cols['text%d' % j] = [''.join(letters[rng.integers(0, 52, k)])
+                                  for k in rng.integers(1, 30, n_rows)]
+        else:
+            days = rng.integers(0, 3650, n_rows)
+            cols['date%d' % j] = (np.datetime64('2010-01-01') +
+                                  days.astype('timedelta64[D]'))
+    return pd.DataFrame(cols)
+
+
+def long_frame(n_rows=100000, seed=0):
+    """Narrow dataframe of id, category, subcategory, code, and value
+    columns, suitable for grouped frequencies."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'id': np.arange(n_rows),
+        'cat': _words(rng, n_rows, 0.01),
+        'subcat': rng.integers(0, 20, n_rows).astype(str),
+        'code': ['C%04d' % c for c in rng.zipf(1.5, n_rows) % 10000],
+        'value': rng.exponential(50, n_rows).round(2)})
+
+
+def write_csv(df, fn, sep=','):
+    df.to_csv(fn, index=False, sep=sep)
+    return fn
+
+
+def mixed_encoding_file(fn, n_rows=10000, encoding='ISO-8859-1',
+                        mojibake_frac=0.1, seed=0):
+    """Write a CSV in `encoding` with accented names, where a fraction
+    `mojibake_frac` of rows carry UTF-8 text mis-decoded as cp1252 (classic
+    mojibake, e.g. 'Ã©' for 'é')."""
+    rng = np.random.default_rng(seed)
+    lines = ['id,name,city']
+    for i in range(n_rows):
+        name = ''.join(rng.choice(list(string.ascii_lowercase + _ACCENTED),
+                                  rng.integers(3, 12)))
+        if rng.random() < mojibake_frac:
+            name = name.encode('utf8').decode('cp1252', errors='replace')
+        lines.append('%d,%s,%s' % (i, name, _WORDS[i % len(_WORDS)]))
+    with open(fn, 'w', encoding=encoding, errors='replace') as fout:
+        fout.write('\n'.join(lines) + '\n')
+    return fn
+
+
+def compress_file(fn_in, fn, kind='gzip', member_size=1048576):
+    """Write file fn_in compressed in format `kind` ('gzip', 'bz2', or 'xz')
+    to fn as independent members of `member_size` uncompressed bytes (as
+    bgzip or pbzip2 do), or as a single member if member_size is None."""
+    compress = {'gzip': gzip.compress, 'bz2': bz2.compress,
+                'xz': lzma.compress}[kind]
+    with open(fn_in, 'rb') as fin, open(fn, 'wb') as fout:
+        while True:
+            blk = fin.read(member_size or -1)
+            if not blk:
+                break
+            fout.write(compress(blk))
+    return fn
+
+
+def fixed_width_file(fn, n_rows=10000, seed=0, ragged=False):
+    """Write a fixed-width-field file with a header and right-justified id,
+    left-justified name, zero-padded zip code, amount, and an account number
+    packed against a code.  With ragged=True, trailing blanks are stripped
+    so that lines differ in length."""
+    rng = np.random.default_rng(seed)
+    names = _WORDS[rng.integers(0, len(_WORDS), n_rows)]
+    codes = np.array(['ABC', 'XY', 'Q', 'ZZTOP'])[rng.integers(0, 4, n_rows)]
+    df = pd.DataFrame({'id': rng.integers(1, 10 ** 6, n_rows),
+                       'name': names,
+                       'zip': rng.integers(0, 10 ** 5, n_rows),
+                       'amount': rng.normal(100, 50, n_rows),
+                       'acct': rng.integers(10 ** 5, 10 ** 6, n_rows),
+                       'code': codes})
+    lines = df.id.map('{:8d}'.format) + df.name.str.ljust(10) + \
+        df.zip.map('{:05d}'.format) + df.amount.map(' {:10.2f} '.format) + \
+        df.acct.map('{:06d}'.format) + df.code.str.ljust(8)
+    if ragged:
+        lines = lines.str.rstrip()
+    with open(fn, 'w') as fout:
+        fout.write('%8s%-10s%5s %10s %6s%-8s\n' % ('ID', 'NAME', 'ZIP',
+                                                 'AMOUNT', 'ACCT', 'CODE'))
+        fout.write('\n'.join(lines) + '\n')
+    return fn
+
+
+def keyed_tables(n_keys=100000, n_tables=4, rows_per_key=2.0, coverage=0.8,
+                 seed=0):
+    """List of n_tables dataframes with a `key` column drawn from n_keys
+    keys.  Each table covers about `coverage` of the keys with a Poisson
+    number of rows (mean `rows_per_key`) per covered key."""
+    rng = np.random.default_rng(seed)
+    tables = []
+    for j in range(n_tables):
+        keys = np.flatnonzero(rng.random(n_keys) < coverage)
+        reps = rng.poisson(rows_per_key, len(keys))
+        key = np.repeat(keys, reps)
+        tables.append(pd.DataFrame({'key': key.astype(str),
+                                    'val': rng.random(len(key))}))
+    return tables
+
+
+class _MockResponse(object):
+    def __init__(self, payload, status_code=200):
+        self._payload = payload
+        self.status_code = status_code
+
+    def json(self):
+        return self._payload
+
+
+def mock_rxnav_get(url, timeout=None):
+    """Stand-in for `requests.get` that answers RxNav REST URLs with small
+    canned payloads shaped like the real ones."""
+    rxcui = url.split('rxcui/')[-1].split('/')[0] if 'rxcui/' in url \
+        else '0'
+    if '/related' in url:
+        payload = {'relatedGroup': {'conceptGroup': [
+            {'tty': 'SCD', 'conceptProperties': [
+                {'rxcui': str(int(rxcui) * 10 + k), 'tty': 'SCD',
+                 'name': 'drug %s-%d' % (rxcui, k)} for k in range(3)]}]}}
+    elif '/status' in url:
+        payload = {'rxcuiStatus': {'status': 'Active', 'minConceptGroup': {
+            'minConcept': [{'rxcui': rxcui}]}}}
+    else:
+        payload = {'properties': {'rxcui': rxcui, 'name': 'drug %s' % rxcui,
+                                  'synonym': '', 'tty': 'SCD'}}
+    return _MockResponse(payload)
+
+
+@contextlib.contextmanager
+def mocked_rxnav(rxn_module, per_sec=1e6):
+    """Within the context, `rxn_module.rxnorm_req` talks to
+    `mock_rxnav_get` instead of the network, with an empty in-memory cache
+    (the pickle file is neither read nor written) and its adaptive throttle
+    pinned at `per_sec` calls per second, so that timings measure only the
+    client's own overhead."""
+    class _Requests(object):
+        get = staticmethod(mock_rxnav_get)
+
+    inner = rxn_module.rxnorm_req.__wrapped__
+    control = rxn_module.rxnorm_req.throttle.control
+    saved = (rxn_module.requests, inner.cache, control.bucket.rate,
+             control.min_per_sec, control.max_per_sec)
+    cache = rxn_module._PickleCache(None)
+    cache.loaded = True
+    rxn_module.requests = _Requests()
+    inner.cache = cache
+    control.bucket.rate = control.min_per_sec = control.max_per_sec = \
+        float(per_sec)
+    try:
+        yield
+    finally:
+        (rxn_module.requests, inner.cache, control.bucket.rate,
+         control.min_per_sec, control.max_per_sec) = saved
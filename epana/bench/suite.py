@@ -0,0 +1,291 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Evan T. Phelps
+#
+# Distributed under terms of the MIT license.
+"""
+Benchmark registry, runner, and baseline comparison.
+
+Each benchmark is a setup function registered with `@benchmark`.  It takes a
+scratch directory, a scale factor, and a seed, prepares its data, and returns
+the zero-argument callable to be timed.
+"""
+##############################################################################
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from epana.bench import generators as gen
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Register a benchmark setup function under its name."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def _rows(n, scale):
+    return max(10, int(n * scale))
+
+
+@benchmark
+def get_summary(workdir, scale, seed):
+    from epana import tabular
+    df = gen.wide_frame(_rows(20000, scale), 20, seed=seed)
+    return lambda: tabular.get_summary(df)
+
+
+@benchmark
+def freq(workdir, scale, seed):
+    from epana import tabular
+    df = gen.long_frame(_rows(500000, scale), seed=seed)
+    return lambda: tabular.freq(df, ['cat', 'subcat'], agglvl=1, cumsum=True)
+
+
+@benchmark
+def multi_freq(workdir, scale, seed):
+    from epana import tabular
+    df = gen.long_frame(_rows(500000, scale), seed=seed)
+    grps = [['cat', 'subcat'], ['cat'], ['subcat'], ['code'], ['cat', 'code']]
+    return lambda: tabular.multi_freq(df, grps, agglvl=1, cumsum=True)
+
+
+@benchmark
+def shrink_df(workdir, scale, seed):
+    from epana import tabular
+    df = gen.wide_frame(_rows(100000, scale), 20, seed=seed)
+    return lambda: tabular.shrink_df(df.copy())
+
+
+def _object_frame(scale, seed):
+    from epana import tabular
+    return tabular.to_arrow_strings(
+        gen.wide_frame(_rows(200000, scale), 20, seed=seed)).astype(object)
+
+
+@benchmark
+def mem_usage_deep(workdir, scale, seed):
+    from epana import tabular
+    df = _object_frame(scale, seed)
+    return lambda: tabular.get_mem_usage(df)
+
+
+@benchmark
+def mem_usage_estimate(workdir, scale, seed):
+    from epana import tabular
+    df = _object_frame(scale, seed)
+    return lambda: tabular.get_mem_usage(df, estimate=True)
+
+
+@benchmark
+def read_fwf(workdir, scale, seed):
+    from epana import tabular
+    fn = gen.fixed_width_file(os.path.join(workdir, 'fixed.txt'),
+                              _rows(200000, scale), seed=seed)
+    return lambda: tabular.read_fwf(fn)
+
+
+def _raw_storage_benchmarks(storage):
+    """Register benchmarks of loading and summarizing a raw frame with the
+    given `tabular.RAW_STORAGES` storage."""
+    def load(workdir, scale, seed):
+        from epana import tabular
+        fn = gen.write_csv(gen.wide_frame(_rows(100000, scale), 20,
+                                          seed=seed),
+                           os.path.join(workdir, 'raw.csv'))
+        return lambda: tabular.get_df_raw(fn, storage=storage)
+
+    def summarize(workdir, scale, seed):
+        from epana import tabular
+        df = load(workdir, scale, seed)()
+        return lambda: tabular.get_summary(df)
+
+    BENCHMARKS['load_raw_%s' % storage] = load
+    BENCHMARKS['summary_raw_%s' % storage] = summarize
+
+
+for _storage in ('object', 'arrow', 'dictionary'):
+    _raw_storage_benchmarks(_storage)
+
+
+def _compressed_benchmarks(kind):
+    """Register benchmarks of reading a multi-member file compressed in
+    format `kind` in parallel and serially, and of reading its head."""
+    def setup(workdir, scale, seed):
+        fn = gen.write_csv(gen.wide_frame(_rows(200000, scale), 20,
+                                          seed=seed),
+                           os.path.join(workdir, 'compressed.csv'))
+        return gen.compress_file(fn, fn + '.' + kind, kind)
+
+    def read_all(fn, threads):
+        from epana import compression
+        with compression.open_input(fn, threads=threads) as fin:
+            while fin.read(1048576):
+                pass
+
+    def parallel(workdir, scale, seed):
+        fn = setup(workdir, scale, seed)
+        return lambda: read_all(fn, None)
+
+    def serial(workdir, scale, seed):
+        fn = setup(workdir, scale, seed)
+        return lambda: read_all(fn, 1)
+
+    def head(workdir, scale, seed):
+        from epana import scrubdub
+        fn = setup(workdir, scale, seed)
+        return lambda: scrubdub.head(fn)
+
+    BENCHMARKS['decompress_%s' % kind] = parallel
+    BENCHMARKS['decompress_%s_serial' % kind] = serial
+    BENCHMARKS['head_%s' % kind] = head
+
+
+for _kind in ('gzip', 'bz2', 'xz'):
+    _compressed_benchmarks(_kind)
+
+
+@benchmark
+def count_charclasses(workdir, scale, seed):
+    from epana import scrubdub
+    fn = gen.write_csv(gen.wide_frame(_rows(50000, scale), 20, seed=seed),
+                       os.path.join(workdir, 'charclasses.csv'))
+    return lambda: scrubdub.count_charclasses(fn)
+
+
+@benchmark
+def guess_encoding(workdir, scale, seed):
+    from epana import scrubdub
+    fn = gen.mixed_encoding_file(os.path.join(workdir, 'encoding.csv'),
+                                 _rows(100000, scale), seed=seed)
+    return lambda: scrubdub.guess_encoding(fn)
+
+
+@benchmark
+def fix_unicode_and_copy(workdir, scale, seed):
+    from epana import scrubdub
+    fn = gen.mixed_encoding_file(os.path.join(workdir, 'mojibake.csv'),
+                                 _rows(20000, scale), seed=seed)
+    fn_out = os.path.join(workdir, 'fixed.csv')
+    return lambda: scrubdub.fix_unicode_and_copy(fn, fn_out)
+
+
+@benchmark
+def count_relational_patterns(workdir, scale, seed):
+    from epana import crosstabular
+    dfs = gen.keyed_tables(_rows(200000, scale), 4, seed=seed)
+    names = ['t%d' % j for j in range(len(dfs))]
+    return lambda: crosstabular.count_relational_patterns(dfs, names, 'key')
+
+
+@benchmark
+def count_existence_patterns(workdir, scale, seed):
+    from epana import crosstabular
+    dfs = gen.keyed_tables(_rows(200000, scale), 12, seed=seed)
+    names = ['t%d' % j for j in range(len(dfs))]
+    return lambda: crosstabular.count_existence_patterns(dfs, names, 'key')
+
+
+@benchmark
+def rxnorm_req(workdir, scale, seed):
+    from epana import rxn
+    n = _rows(100, scale)
+    start = (seed + 1) * 10 ** 7
+
+    def run():
+        with gen.mocked_rxnav(rxn):
+            # Distinct rxcuis in a fresh cache, so the cache never hits.
+            for i in range(n):
+                rxn.rxnorm_req('rxcui/%d/properties' % (start + i))
+        return n
+    return run
+
+
+def _measure(setup, workdir, scale, seed, repeat):
+    """Best wall time over `repeat` runs, then one traced run for peak
+    memory (tracing slows the run, so it is not timed).  Peak memory counts
+    only allocations that Python traces, not, e.g., Arrow buffers, so the
+    deep memory usage of any dataframe result is recorded as well."""
+    times = []
+    result_bytes = None
+    for _ in range(repeat):
+        fn = setup(workdir, scale, seed)
+        gc.collect()
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+        if hasattr(result, 'memory_usage'):
+            result_bytes = int(result.memory_usage(deep=True).sum())
+        del result
+    fn = setup(workdir, scale, seed)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    res = {'secs': min(times), 'secs_all': times, 'peak_bytes': peak}
+    if result_bytes is not None:
+        res['result_bytes'] = result_bytes
+    return res
+
+
+def run_suite(names=None, scale=1.0, repeat=3, seed=0, results_fn=None):
+    """Run the named benchmarks (default all) and return a results dict,
+    also written as JSON to `results_fn` if given.  A benchmark that raises
+    (e.g., for a missing optional dependency) records the error instead."""
+    names = sorted(BENCHMARKS) if names is None else names
+    results = {'meta': {'python': sys.version.split()[0],
+                        'platform': platform.platform(),
+                        'time': time.time(), 'scale': scale, 'seed': seed,
+                        'repeat': repeat},
+               'benchmarks': {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names:
+            try:
+                res = _measure(BENCHMARKS[name], workdir, scale, seed, repeat)
+            except Exception as e:
+                res = {'error': '%s: %s' % (type(e).__name__, e)}
+            results['benchmarks'][name] = res
+    if results_fn is not None:
+        with open(results_fn, 'w') as fout:
+            json.dump(results, fout, indent=2)
+    return results
+
+
+def compare(results, baseline, time_tol=0.2, mem_tol=0.2):
+    """Compare results to baseline results (dicts or JSON file names).
+
+    Returns a list of `(name, metric, baseline, current, ratio)` for every
+    benchmark whose time or peak memory grew by more than its tolerance.
+    Benchmarks must have been run at the same scale to be comparable.
+    """
+    if not isinstance(results, dict):
+        with open(results) as fin:
+            results = json.load(fin)
+    if not isinstance(baseline, dict):
+        with open(baseline) as fin:
+            baseline = json.load(fin)
+    if results['meta']['scale'] != baseline['meta']['scale']:
+        raise ValueError('results and baseline differ in scale')
+    regressions = []
+    for name, cur in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None or 'error' in base or 'error' in cur:
+            continue
+        for metric, tol in (('secs', time_tol), ('peak_bytes', mem_tol)):
+            ratio = cur[metric] / base[metric] if base[metric] else 1.0
+            if ratio > 1 + tol:
+                regressions.append((name, metric, base[metric], cur[metric],
+                                    ratio))
+    return regressions
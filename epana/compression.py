@@ -0,0 +1,302 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Evan T. Phelps
+#
+# Distributed under terms of the MIT license.
+"""
+Transparent decryption and decompression of input files.
+
+`open_input` is how the file-reading functions of `scrubdub` and `tabular`
+open their input.  Files ending with '.gpg' are decrypted, and gzip, bzip2,
+xz, and zstd data is recognized by its magic bytes (whatever the file is
+called) and decompressed as a stream.  Input made of several members
+(concatenated or bgzip gzip files, pbzip2 output, concatenated xz streams,
+pzstd frames) is split at member headers and the members decompressed in
+parallel threads.  Leaving `open_input` early stops reading, decrypting,
+and decompressing, so callers that only need the start of a file (`head`,
+encoding guesses from a sample) do not pay for the rest.
+
+zstd data is decompressed by the `zstd` command, as there is no zstd module
+in the standard library.
+"""
+##############################################################################
+import bz2
+import functools
+import itertools
+import lzma
+import os
+import re
+import subprocess
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from epana.cryptic import decrypt_blocks
+from epana.cryptic import fopen
+from epana.cryptic import pipe_blocks
+
+ZSTD = 'zstd'
+
+# Headers that begin every member, stream, or frame of each format.
+MEMBER_MAGIC = {
+    'gzip': re.compile(re.escape(b'\x1f\x8b\x08')),
+    'bz2': re.compile(b'BZh[1-9](?:1AY&SY|' + re.escape(b'\x17rE8P\x90') +
+                      b')'),
+    'xz': re.compile(re.escape(b'\xfd7zXZ\x00')),
+    'zstd': re.compile(re.escape(b'\x28\xb5\x2f\xfd')),
+}
+_ZSTD_SKIPPABLE = re.compile(b'[\x50-\x5f]' + re.escape(b'\x2a\x4d\x18'))
+_MAGIC_LEN = 10
+
+_DECOMPRESSORS = {'gzip': lambda: zlib.decompressobj(wbits=31),
+                  'bz2': bz2.BZ2Decompressor,
+                  'xz': lambda: lzma.LZMADecompressor(lzma.FORMAT_XZ)}
+_ERRORS = (zlib.error, lzma.LZMAError, OSError, EOFError)
+
+
+def sniff_compression(prefix):
+    """Return 'gzip', 'bz2', 'xz', or 'zstd' if bytes prefix (the first 10
+    or more bytes of some data) is the start of data compressed in that
+    format, or else None."""
+    for (kind, magic) in MEMBER_MAGIC.items():
+        if magic.match(prefix):
+            return kind
+    return 'zstd' if _ZSTD_SKIPPABLE.match(prefix) else None
+
+
+def decompress_members(data, kind):
+    """Return the decompressed bytes of data, or None unless data is a whole
+    number of complete and intact members in format kind."""
+    if kind == 'zstd':
+        proc = subprocess.run([ZSTD, '-dcq'], input=data,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL)
+        return proc.stdout if proc.returncode == 0 else None
+    out = []
+    try:
+        while data:
+            dec = _DECOMPRESSORS[kind]()
+            out.append(dec.decompress(data))
+            if not dec.eof:
+                return None
+            data = dec.unused_data
+            if kind == 'xz':  # stream padding
+                data = data.lstrip(b'\0')
+    except _ERRORS:
+        return None
+    return b''.join(out)
+
+
+def _stream(blocks, kind):
+    """Yield the decompressed blocks of all members of an iterable of
+    blocks, one member after another."""
+    if kind == 'zstd':
+        yield from pipe_blocks(blocks, [ZSTD, '-dcq'])
+        return
+    dec = None
+    for blk in blocks:
+        while blk:
+            if dec is None:
+                blk = blk.lstrip(b'\0') if kind == 'xz' else blk
+                if not blk:
+                    break
+                dec = _DECOMPRESSORS[kind]()
+            out = dec.decompress(blk)
+            if out:
+                yield out
+            blk = b''
+            if dec.eof:
+                blk, dec = dec.unused_data, None
+    if dec is not None:
+        raise EOFError('%s input ended in the middle of a member' % kind)
+
+
+def decompress_blocks(blocks, kind=None, threads=None, max_member=16777216):
+    """Yield decompressed blocks of bytes from an iterable of blocks of
+    compressed bytes in format `kind` ('gzip', 'bz2', 'xz', or 'zstd'; if
+    None, it is sniffed from the first bytes, and input in no known format
+    is passed through unchanged).
+
+    The input is split at member headers, and up to `threads` (default: the
+    number of CPUs) members are decompressed at once, while the output stays
+    in order.  A header that turns out to be a chance match inside
+    compressed data is merged back into its member.  At the first member
+    longer than `max_member` compressed bytes (e.g., any ordinary
+    single-member file), splitting stops and the rest of the input is
+    decompressed serially, as is everything if threads is 1.  Memory use is
+    bounded by about `2 * threads` members and `max_member`.
+    """
+    blocks = iter(blocks)
+    buf = b''
+    if kind is None:
+        for blk in blocks:
+            buf += blk
+            if len(buf) >= _MAGIC_LEN:
+                break
+        kind = sniff_compression(buf)
+        if kind is None:
+            if buf:
+                yield buf
+            yield from blocks
+            return
+    threads = threads or os.cpu_count() or 1
+    if threads == 1:
+        yield from _stream(itertools.chain([buf], blocks), kind)
+    else:
+        yield from _parallel(blocks, buf, kind, threads, max_member)
+
+
+def _parallel(blocks, buf, kind, threads, max_member):
+    magic = MEMBER_MAGIC[kind]
+    pending = deque()
+    pool = ThreadPoolExecutor(threads)
+
+    def submit(piece):
+        pending.append((piece, pool.submit(decompress_members, piece, kind)))
+
+    def drain(n):
+        """Yield the output of pending pieces, in order, until at most n are
+        left, and return the start of a member still incomplete (if any)."""
+        while len(pending) > n:
+            (piece, future) = pending.popleft()
+            out = future.result()
+            while out is None:  # a chance header split the member
+                if not pending:
+                    return piece
+                (more, future) = pending.popleft()
+                future.cancel()
+                piece += more
+                out = decompress_members(piece, kind)
+            yield out
+        return b''
+
+    try:
+        start = 1  # buf always begins with a member header
+        for blk in blocks:
+            buf += blk
+            prev = 0
+            for m in magic.finditer(buf, start):
+                submit(buf[prev:m.start()])
+                prev = m.start()
+            buf = buf[prev:]
+            if len(buf) > max_member:
+                buf = (yield from drain(0)) + buf
+                yield from _stream(itertools.chain([buf], blocks), kind)
+                return
+            buf = (yield from drain(2 * threads)) + buf
+            start = max(1, len(buf) - _MAGIC_LEN + 1)
+        if buf:
+            submit(buf)
+        if (yield from drain(0)):
+            raise EOFError('%s input is truncated or corrupt' % kind)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        if hasattr(blocks, 'close'):
+            blocks.close()
+
+
+def input_blocks(fpath, pwd=None, threads=None, blocksize=1048576,
+                 stats=None):
+    """Yield the contents of file `fpath` (local or remote, as understood by
+    `cryptic.fopen`) in blocks of bytes, decrypted if the name ends with
+    '.gpg' and then decompressed if compressed (see `decompress_blocks`).
+
+    If `stats` is a dict, it is kept up to date with the `compression`
+    found and the `raw_bytes` read and `bytes` yielded so far, from which a
+    caller can estimate the uncompressed size.
+    """
+    stats = {} if stats is None else stats
+    stats.update(compression=None, raw_bytes=0, bytes=0)
+
+    def raw():
+        with fopen(fpath) as fin:
+            while True:
+                blk = fin.read(blocksize)
+                if not blk:
+                    break
+                stats['raw_bytes'] += len(blk)
+                yield blk
+
+    blocks = raw()
+    if fpath.endswith('.gpg'):
+        blocks = decrypt_blocks(blocks, pwd, blocksize=blocksize)
+    first = b''
+    for blk in blocks:
+        first += blk
+        if len(first) >= _MAGIC_LEN:
+            break
+    kind = sniff_compression(first)
+    stats['compression'] = kind
+    blocks = itertools.chain([first], blocks)
+    if kind is not None:
+        blocks = decompress_blocks(blocks, kind, threads)
+    try:
+        for blk in blocks:
+            stats['bytes'] += len(blk)
+            yield blk
+    finally:
+        if hasattr(blocks, 'close'):
+            blocks.close()
+
+
+@contextmanager
+def open_input(fpath, pwd=None, threads=None, blocksize=1048576, stats=None):
+    """Yield a readable binary stream of the contents of file `fpath`,
+    decrypted and decompressed as by `input_blocks`.
+
+    A file that is neither encrypted nor compressed is yielded as opened by
+    `cryptic.fopen`, so that it is seekable and read at full speed.
+
+    >>> with open_input('feed.csv.gz') as fin:
+    ...     header = fin.readline()
+    """
+    if not fpath.endswith('.gpg'):
+        with fopen(fpath) as fin:
+            if sniff_compression(fin.read(_MAGIC_LEN)) is None:
+                fin.seek(0)
+                if stats is not None:
+                    stats.update(compression=None, raw_bytes=0, bytes=0)
+                yield fin
+                return
+    from epana.scrubdub import iterable_to_stream
+    blocks = input_blocks(fpath, pwd, threads, blocksize, stats)
+    try:
+        with iterable_to_stream(blocks, buffer_size=blocksize) as stream:
+            yield stream
+    finally:
+        blocks.close()
+
+
+def rewind(fin, head, blocksize=1048576):
+    """Return a stream of all of binary stream fin, of which bytes `head`
+    (e.g., a sample for guessing the encoding) have already been read from
+    the start: fin itself, seeked back, if it is seekable, or else a stream
+    of head followed by the rest of fin.  This lets one `open_input` serve
+    both the sample and the full read, so encrypted input is decrypted (and
+    its passphrase asked for) only once.
+    """
+    if fin.seekable():
+        fin.seek(0)
+        return fin
+    from epana.scrubdub import iterable_to_stream
+    rest = iter(functools.partial(fin.read, blocksize), b'')
+    return iterable_to_stream(itertools.chain([head], rest),
+                              buffer_size=blocksize)
+
+
+def test_rewind():
+    import gzip
+    import tempfile
+    data = b''.join(b'%d,caf\xc3\xa9\n' % i for i in range(10000))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for (name, raw) in [('a.csv', data),
+                            ('a.csv.gz', gzip.compress(data))]:
+            fn = os.path.join(tmpdir, name)
+            with open(fn, 'wb') as fout:
+                fout.write(raw)
+            with open_input(fn) as fin:
+                head = b''.join(itertools.islice(fin, 10)) + fin.read(100)
+                assert rewind(fin, head, blocksize=1000).read() == data
@@ -9,9 +9,82 @@
 Basic cross-tabular-data utilities for data exploration.
 """
 ##############################################################################
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
 import pandas as pd
 
 from epana.scrubdub import isstring
+from epana.sketches import ColumnSketch
+from epana.sketches import estimate_overlap
+from epana.sketches import normalize_values
+
+
+def factorize_keys(dfs, keycol):
+    """Map the `keycol` values of every dataframe of `dfs` into one shared
+    int64 code space.
+
+    Returns `(codes, keys)`: `codes` is a list with one int64 array per
+    dataframe giving each row's key code (-1 where any key column is null),
+    and `keys` is an index (a MultiIndex for multi-column keys) of the
+    distinct key values in sorted order, so that code `i` stands for
+    `keys[i]`.
+
+    Multi-column keys are combined one column at a time as
+    `code * n_values + column_code` and refactorized after each column, so
+    the codes are exact (no hash collisions) and never overflow.
+    """
+    kcol = [keycol] if isstring(keycol) else keycol
+    bounds = np.cumsum([0] + [len(df) for df in dfs])
+    combined, null, colcodes, levels = None, None, [], []
+    for col in kcol:
+        vals = pd.concat([df[col] for df in dfs], ignore_index=True)
+        c, uniques = pd.factorize(vals, sort=True)
+        colcodes.append(c)
+        levels.append(uniques)
+        if combined is None:
+            combined, null = c.astype(np.int64), c < 0
+        else:
+            null |= c < 0
+            combined = combined * len(uniques) + c
+            combined[~null] = pd.factorize(combined[~null], sort=True)[0]
+            combined[null] = -1
+    valid = combined >= 0
+    _, first = np.unique(combined[valid], return_index=True)
+    first = np.flatnonzero(valid)[first]
+    if len(kcol) == 1:
+        keys = pd.Index(levels[0].take(colcodes[0][first]), name=kcol[0])
+    else:
+        keys = pd.MultiIndex.from_arrays(
+            [lvl.take(c[first]) for (lvl, c) in zip(levels, colcodes)],
+            names=kcol)
+    codes = [combined[lo:hi] for (lo, hi) in zip(bounds[:-1], bounds[1:])]
+    return codes, keys
+
+
+def count_matrix(dfs, keycol):
+    """Return `(counts, keys)` where `counts[i, j]` is the number of rows of
+    `dfs[j]` with key `keys[i]` (see `factorize_keys`).  Counts are computed
+    with `np.bincount` over the shared key codes."""
+    codes, keys = factorize_keys(dfs, keycol)
+    counts = np.empty((len(keys), len(dfs)), dtype=np.int64)
+    for j, c in enumerate(codes):
+        counts[:, j] = np.bincount(c[c >= 0], minlength=len(keys))
+    return counts, keys
+
+
+def _pattern_frame(counts, names):
+    """Count the distinct rows of `counts` into a dataframe of patterns with
+    column names `names` plus `COUNT`."""
+    if len(counts) == 0:
+        return pd.DataFrame(columns=list(names) + ['COUNT'])
+    patterns, n = np.unique(counts, axis=0, return_counts=True)
+    patterns = pd.DataFrame(patterns, columns=names)
+    patterns['COUNT'] = n
+    return patterns
 
 
 def count_outer_relations(dfs, names, keycol):
@@ -28,12 +101,10 @@ def count_outer_relations(dfs, names, keycol):
     values that link each dataframe in `dfs`.  It may also be a list of column
     names to support multi-column keys.
     """
-    kcol = [keycol] if isstring(keycol) else keycol
-    dfs_reduced = [df[kcol].groupby(kcol)[kcol[0]].count()
-                   for df in dfs]
-    outer_count = pd.concat(dfs_reduced, axis=1, ignore_index=True).fillna(0)
-    outer_count.columns = names
-    outer_count.loc[:,keycol] = outer_count.index.values
+    counts, keys = count_matrix(dfs, keycol)
+    outer_count = pd.DataFrame(counts, index=keys, columns=names)
+    for kname in keys.names:
+        outer_count.loc[:, kname] = keys.get_level_values(kname).values
     return outer_count
 
 
@@ -61,19 +132,269 @@ def count_relational_patterns(dfs, names, keycol):
     values that link each dataframe in `dfs`.  It may also be a list of column
     names to support multi-column keys.
     """
-    outer_count = count_outer_relations(dfs, names, keycol)
-    # outer_count.reset_index(inplace=True)
-    patterns = outer_count.groupby(names).count().reset_index()
-    patterns.columns = list(patterns.columns[:-1]) + ['COUNT']
-    return patterns.astype(int)
+    counts, _ = count_matrix(dfs, keycol)
+    return _pattern_frame(counts, names).astype(int)
 
 
-# TODO Maybe refactor to use outer_existence_pattern
 def count_existence_patterns(dfs, names, keycol):
     """Like `count_relational_patterns` (see comments) but counts
     *existence patterns* instead of *count patterns*.
     """
-    rel_counts = count_relational_patterns(dfs, names, keycol)
-    rel_counts[names] = rel_counts[names] > 0
-    patterns = rel_counts.groupby(names)['COUNT'].sum().reset_index()
+    counts, _ = count_matrix(dfs, keycol)
+    masks, n = count_masks(existence_masks(counts > 0))
+    patterns = decode_masks(masks, names)
+    patterns['COUNT'] = n
     return patterns
+
+
+def existence_masks(exists):
+    """Pack a boolean (keys x tables) array into bitmasks.
+
+    Table `j` is bit `63 - j % 64` of word `j // 64`, so the first table is
+    the most significant bit and masks sort like the boolean rows they
+    encode.  Returns a uint64 array with one mask per key for up to 64
+    tables, or a (keys x words) array beyond that.
+    """
+    exists = np.asarray(exists, dtype=bool)
+    n_words = max(1, -(-exists.shape[1] // 64))
+    packed = np.zeros((exists.shape[0], n_words * 8), dtype=np.uint8)
+    bits = np.packbits(exists, axis=1, bitorder='big')
+    packed[:, :bits.shape[1]] = bits
+    masks = packed.view('>u8').astype(np.uint64)
+    return masks[:, 0] if n_words == 1 else masks
+
+
+def count_masks(masks):
+    """Return the distinct masks (see `existence_masks`) and the number of
+    keys with each, from a single `np.unique`."""
+    return np.unique(masks, axis=None if masks.ndim == 1 else 0,
+                     return_counts=True)
+
+
+def decode_masks(masks, names):
+    """Unpack masks into a boolean dataframe with one column per table name.
+    """
+    n_words = masks.shape[1] if masks.ndim == 2 else 1
+    masks = masks.reshape(len(masks), n_words).astype('>u8')
+    bits = np.unpackbits(masks.view(np.uint8).reshape(len(masks),
+                                                     8 * n_words),
+                         axis=1, bitorder='big')
+    return pd.DataFrame(bits[:, :len(names)].astype(bool), columns=names)
+
+
+def decode_mask(mask, names):
+    """Return the names of the tables present in a single mask."""
+    return [name for (name, present) in
+            zip(names, decode_masks(np.asarray([mask]), names).iloc[0])
+            if present]
+
+
+##############################################################################
+# Out-of-core variants over tables too big to load together.
+
+def _iter_key_chunks(source, kcol, chunksize, read_kwargs):
+    """Yield dataframes of the `kcol` columns of `source`, a CSV file path
+    (read as strings) or an iterable of dataframe chunks."""
+    if isstring(source):
+        reader = pd.read_csv(source, usecols=kcol, dtype=str,
+                             chunksize=chunksize, **read_kwargs)
+        for chunk in reader:
+            yield chunk
+    else:
+        for chunk in source:
+            yield chunk[kcol]
+
+
+def spill_keys(sources, keycol, spill_dir, n_buckets=64, chunksize=1000000,
+               read_kwargs=None):
+    """Hash-partition the keys of each table of `sources` into `n_buckets`
+    spill files under `spill_dir`, reading only the key columns one chunk at
+    a time.
+
+    Returns a list with one list of file paths per bucket, one file per
+    table.  Each file holds a sequence of pickled dataframes of keys.  All
+    rows with the same key land in the same bucket, whichever table they come
+    from.
+    """
+    kcol = [keycol] if isstring(keycol) else keycol
+    read_kwargs = {} if read_kwargs is None else read_kwargs
+    paths = [[os.path.join(spill_dir, 'b%05d_t%05d.pkl' % (b, j))
+              for j in range(len(sources))] for b in range(n_buckets)]
+    for j, source in enumerate(sources):
+        fouts = [open(paths[b][j], 'wb') for b in range(n_buckets)]
+        try:
+            for chunk in _iter_key_chunks(source, kcol, chunksize,
+                                          read_kwargs):
+                hashes = pd.util.hash_pandas_object(chunk, index=False)
+                buckets = (hashes.values % n_buckets).astype(np.int64)
+                for b, part in chunk.groupby(buckets):
+                    pickle.dump(part, fouts[b],
+                                protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            for fout in fouts:
+                fout.close()
+    return paths
+
+
+def _load_spill(path, kcol):
+    parts = []
+    with open(path, 'rb') as fin:
+        while True:
+            try:
+                parts.append(pickle.load(fin))
+            except EOFError:
+                break
+    return pd.concat(parts, ignore_index=True) if parts else \
+        pd.DataFrame(columns=kcol)
+
+
+def iter_bucket_counts(sources, keycol, n_buckets=64, chunksize=1000000,
+                       spill_dir=None, read_kwargs=None):
+    """Spill the keys of `sources` (see `spill_keys`) to a temporary
+    directory under `spill_dir` and yield `(counts, keys)` (see
+    `count_matrix`) for one bucket at a time.  Memory is bounded by the size
+    of the largest bucket, so raise `n_buckets` for bigger inputs."""
+    kcol = [keycol] if isstring(keycol) else keycol
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmpdir:
+        paths = spill_keys(sources, kcol, tmpdir, n_buckets=n_buckets,
+                           chunksize=chunksize, read_kwargs=read_kwargs)
+        for bucket_paths in paths:
+            dfs = [_load_spill(path, kcol) for path in bucket_paths]
+            yield count_matrix(dfs, keycol)
+            for path in bucket_paths:
+                os.remove(path)
+
+
+def iter_outer_relations(sources, names, keycol, **kwargs):
+    """Out-of-core `count_outer_relations`: yields its result one bucket of
+    keys at a time.  `sources` are CSV file paths or iterables of dataframe
+    chunks; see `iter_bucket_counts` for keyword arguments."""
+    for counts, keys in iter_bucket_counts(sources, keycol, **kwargs):
+        outer_count = pd.DataFrame(counts, index=keys, columns=names)
+        for kname in keys.names:
+            outer_count.loc[:, kname] = keys.get_level_values(kname).values
+        yield outer_count
+
+
+def _merge_patterns(frames, names):
+    patterns = pd.concat(frames, ignore_index=True)
+    return patterns.groupby(list(names))['COUNT'].sum().reset_index()
+
+
+def count_relational_patterns_ooc(sources, names, keycol, **kwargs):
+    """Out-of-core `count_relational_patterns`; see `iter_outer_relations`.
+    """
+    return _merge_patterns([_pattern_frame(counts, names) for (counts, _) in
+                            iter_bucket_counts(sources, keycol, **kwargs)],
+                           names).astype(int)
+
+
+def count_existence_patterns_ooc(sources, names, keycol, **kwargs):
+    """Out-of-core `count_existence_patterns`; see `iter_outer_relations`.
+    """
+    frames = []
+    for counts, _ in iter_bucket_counts(sources, keycol, **kwargs):
+        masks, n = count_masks(existence_masks(counts > 0))
+        patterns = decode_masks(masks, names)
+        patterns['COUNT'] = n
+        frames.append(patterns)
+    return _merge_patterns(frames, names)
+
+
+##############################################################################
+# Key discovery from column sketches.
+
+def _iter_chunks(source, chunksize, usecols=None):
+    if isinstance(source, pd.DataFrame):
+        yield source if usecols is None else source[usecols]
+    elif isstring(source):
+        for chunk in pd.read_csv(source, dtype=str, usecols=usecols,
+                                 chunksize=chunksize):
+            yield chunk
+    else:
+        for chunk in source:
+            yield chunk if usecols is None else chunk[usecols]
+
+
+def sketch_tables(tables, chunksize=1000000, k=1024, p=12):
+    """Build a `ColumnSketch` of every column of every table in one
+    streaming pass per table.
+
+    `tables` maps table names to dataframes, CSV file paths, or iterables of
+    dataframe chunks.  Returns a dict mapping `(table, column)` to sketches.
+    """
+    sketches = {}
+    for name, source in tables.items():
+        for chunk in _iter_chunks(source, chunksize):
+            for col in chunk.columns:
+                if (name, col) not in sketches:
+                    sketches[(name, col)] = ColumnSketch(k=k, p=p)
+                sketches[(name, col)].update(chunk[col].values)
+    return sketches
+
+
+def discover_keys(sketches, min_containment=0.8, min_distinct=2):
+    """Rank likely foreign-key relationships between columns of different
+    tables from their sketches (see `sketch_tables`).
+
+    Each candidate is a child column `(table_a, col_a)` whose distinct values
+    are mostly contained (at least `min_containment`) in a parent column
+    `(table_b, col_b)`.  The `score` is that containment times the parent's
+    uniqueness, so columns that look like primary keys rank first.  Columns
+    with fewer than `min_distinct` distinct values are skipped.
+    """
+    cols = [(key, sk) for (key, sk) in sketches.items()
+            if sk.n_distinct >= min_distinct]
+    rows = []
+    for i, ((ta, ca), a) in enumerate(cols):
+        for (tb, cb), b in cols[i + 1:]:
+            if ta == tb:
+                continue
+            jac, a_in_b, b_in_a = estimate_overlap(a, b)
+            for (child, parent, sk_p, contain) in (
+                    ((ta, ca), (tb, cb), b, a_in_b),
+                    ((tb, cb), (ta, ca), a, b_in_a)):
+                if contain >= min_containment:
+                    rows.append(child + parent +
+                                (jac, contain, sk_p.uniqueness,
+                                 contain * sk_p.uniqueness))
+    return pd.DataFrame(rows, columns=[
+        'table_a', 'col_a', 'table_b', 'col_b', 'jaccard', 'containment',
+        'uniqueness_b', 'score']).sort_values(
+            'score', ascending=False).reset_index(drop=True)
+
+
+def _renamed_key_chunks(source, col, chunksize):
+    for chunk in _iter_chunks(source, chunksize, [col]):
+        yield pd.DataFrame({'KEY': normalize_values(chunk[col])})
+
+
+def check_key_candidates(tables, candidates, top=5, chunksize=1000000,
+                         **kwargs):
+    """Exactly count the relational patterns of the `top` candidates of
+    `discover_keys` with `count_relational_patterns_ooc` (keys compared as
+    by `sketches.normalize_values`).  Returns a list of
+    `(candidate, patterns)` tuples."""
+    results = []
+    for _, cand in candidates.head(top).iterrows():
+        sources = [_renamed_key_chunks(tables[tbl], col, chunksize)
+                   for (tbl, col) in ((cand.table_a, cand.col_a),
+                                      (cand.table_b, cand.col_b))]
+        names = ['%s.%s' % (cand.table_a, cand.col_a),
+                 '%s.%s' % (cand.table_b, cand.col_b)]
+        results.append((cand, count_relational_patterns_ooc(
+            sources, names, 'KEY', chunksize=chunksize, **kwargs)))
+    return results
+
+
+def test_existence_patterns_empty_and_sparse():
+    empty = pd.DataFrame({'k': pd.Series([], dtype=str)})
+    patterns = count_existence_patterns([empty, empty], ['a', 'b'], 'k')
+    assert list(patterns.columns) == ['a', 'b', 'COUNT'] and \
+        len(patterns) == 0
+    a = pd.DataFrame({'k': ['1', '2']})
+    b = pd.DataFrame({'k': ['2', '3']})
+    # Three keys in 64 buckets: most buckets are empty.
+    patterns = count_existence_patterns_ooc([[a], [b]], ['a', 'b'], 'k')
+    assert sorted(map(tuple, patterns.values.tolist())) == \
+        [(False, True, 1), (True, False, 1), (True, True, 1)]
@@ -11,13 +11,17 @@ Common statistical operations, functions, and utilities.
 ##############################################################################
 import getpass
 import os
+import subprocess
+import threading
+from collections import deque
 from contextlib import contextmanager
 from functools import partial
 from io import BytesIO, StringIO
 
-import gnupg
+from epana.lazy import lazy_import
 
-import paramiko
+gnupg = lazy_import('gnupg')
+paramiko = lazy_import('paramiko')
 
 try:
     basestring
@@ -77,6 +81,88 @@ def decrypt(fin, pwd=None, ostream=False):
         return d.data.rstrip(os.linesep.encode()).split(os.linesep.encode())
 
 
+def decrypt_blocks(blocks, pwd=None, binary='gpg', blocksize=1048576):
+    """Yield decrypted blocks of bytes from an iterable of encrypted blocks.
+
+    Unlike `decrypt`, which holds the whole plaintext in memory, this pipes
+    the ciphertext through a `gpg` subprocess and yields its output as it is
+    produced, so memory use does not depend on file size.  The passphrase
+    is passed on a separate pipe.
+    """
+    pwd = getpass.getpass(
+        'private key password: ') if pwd is None else pwd
+    pwd_r, pwd_w = os.pipe()
+    os.write(pwd_w, pwd.encode() + b'\n')
+    os.close(pwd_w)
+    try:
+        proc = subprocess.Popen(
+            [binary, '--batch', '--quiet', '--yes', '--pinentry-mode',
+             'loopback', '--passphrase-fd', str(pwd_r), '--decrypt'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, pass_fds=(pwd_r,))
+    finally:
+        os.close(pwd_r)
+    yield from _filter_blocks(proc, blocks, blocksize)
+
+
+def pipe_blocks(blocks, args, blocksize=1048576):
+    """Yield the output of command `args` (e.g., `['zstd', '-dc']`) as
+    blocks of bytes while feeding it an iterable of blocks of bytes."""
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    yield from _filter_blocks(proc, blocks, blocksize)
+
+
+def _filter_blocks(proc, blocks, blocksize):
+    """Feed blocks to the stdin of subprocess proc in one thread, collect
+    its stderr in another, and yield its stdout.  Raises RuntimeError if
+    proc fails, and kills it if the consumer stops early."""
+    errors = deque(maxlen=20)
+
+    def feed():
+        try:
+            for blk in blocks:
+                proc.stdin.write(blk)
+            proc.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    def drain():
+        for line in proc.stderr:
+            errors.append(line.decode(errors='replace').rstrip())
+
+    threads = [threading.Thread(target=feed, daemon=True),
+               threading.Thread(target=drain, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            blk = proc.stdout.read(blocksize)
+            if not blk:
+                break
+            yield blk
+        if proc.wait() != 0:
+            raise RuntimeError('%s exited with status %d: %s' %
+                               (os.path.basename(proc.args[0]),
+                                proc.returncode, '; '.join(errors)))
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+
+def iter_blocks(fpath, blocksize=1048576):
+    """Yield the raw contents of file `fpath` (as understood by `fopen`) in
+    blocks of `blocksize` bytes."""
+    with fopen(fpath) as fin:
+        while True:
+            blk = fin.read(blocksize)
+            if not blk:
+                break
+            yield blk
+
+
 def head(fname, N=10, bytes=None):
     if fname.endswith('.gpg'):
         s = None
@@ -10,10 +10,391 @@ Basic DB utilities.
 """
 ##############################################################################
 import datetime
+import itertools
+import math
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from pandas import Timestamp
+import numpy as np
 
-import cx_Oracle
+from epana.lazy import lazy_import
+from epana.logutils import get_logger
+from epana.logutils import mstime
+from epana.querycache import connection_id
+
+cx_Oracle = lazy_import('cx_Oracle')
+pd = lazy_import('pandas')
+
+
+##############################################################################
+# Bulk loading through a DB-API backend abstraction.
+
+class SqliteBackend(object):
+    """DB-API dialect for `sqlite3`, the local stand-in for Oracle."""
+
+    types = {'str': 'TEXT', 'int': 'INTEGER', 'float': 'REAL',
+             'datetime': 'TIMESTAMP'}
+
+    def connect(self, database=':memory:'):
+        return sqlite3.connect(database, check_same_thread=False)
+
+    def column_type(self, kind, maxlen):
+        return self.types[kind]
+
+    def placeholders(self, ncols):
+        return ', '.join(['?'] * ncols)
+
+    def input_sizes(self, coltypes):
+        return None  # sqlite3 ignores setinputsizes
+
+    def fit(self, cursor, name, cnames, coltypes, batch):
+        return coltypes  # TEXT holds any string
+
+    def hash_predicate(self, key, n, i):
+        # SQLite has no hash function, so the key must be an integer.
+        return '((%s %% %d) + %d) %% %d = %d' % (key, n, n, n, i)
+
+    def create(self, cursor, name, cols_str, temporary=False):
+        if temporary:
+            cursor.execute('create temporary table if not exists ' +
+                           '%s (%s)' % (name, cols_str))
+        else:
+            cursor.execute('create table %s (%s)' % (name, cols_str))
+
+
+class OracleBackend(object):
+    """DB-API dialect for `cx_Oracle`.  String columns are VARCHAR2 sized
+    in bytes (Oracle's default length semantics), or CLOB if longer than
+    `max_varchar` bytes."""
+
+    min_varchar = 512
+    max_varchar = 4000
+
+    def column_type(self, kind, maxlen):
+        if kind == 'str':
+            if maxlen > self.max_varchar:
+                return 'CLOB'
+            return 'VARCHAR2(%d)' % self._varchar_len(maxlen)
+        return {'int': 'NUMBER', 'float': 'NUMBER',
+                'datetime': 'DATE'}[kind]
+
+    def _varchar_len(self, maxlen):
+        return min(self.max_varchar, max(self.min_varchar, maxlen))
+
+    def placeholders(self, ncols):
+        return ', '.join([':%d' % (i + 1) for i in range(ncols)])
+
+    def input_sizes(self, coltypes):
+        sizes = {'int': cx_Oracle.NUMBER, 'float': cx_Oracle.NUMBER,
+                 'datetime': cx_Oracle.DATETIME}
+        return [sizes[kind] if kind != 'str'
+                else cx_Oracle.CLOB if maxlen > self.max_varchar
+                else self._varchar_len(maxlen)
+                for (kind, maxlen) in coltypes]
+
+    def fit(self, cursor, name, cnames, coltypes, batch):
+        """Return coltypes updated for the rows of batch, first widening
+        VARCHAR2 columns of table `name` that are too narrow for them (DDL,
+        which commits).  Raises ValueError, before any of batch is inserted,
+        for values the table cannot hold: strings longer than `max_varchar`
+        bytes in a VARCHAR2 column (which cannot be modified to CLOB), or
+        other than numbers in a NUMBER column."""
+        fitted = []
+        for (cname, (kind, maxlen), col) in zip(cnames, coltypes,
+                                                zip(*batch)):
+            k, n = infer_kind(col)
+            if kind == 'str' and maxlen < n:
+                if maxlen <= self.max_varchar < n:
+                    raise ValueError(
+                        '%s.%s: %d-byte string exceeds VARCHAR2(%d) and '
+                        'cannot become CLOB; infer types from more rows '
+                        '(sample_size)' % (name, cname, n,
+                                           self._varchar_len(maxlen)))
+                if self._varchar_len(maxlen) < self._varchar_len(n):
+                    cursor.execute('alter table %s modify (%s %s)' % (
+                        name, cname, self.column_type(kind, n)))
+                maxlen = n
+            elif kind != 'str' and n and k != kind and \
+                    {k, kind} != {'int', 'float'}:
+                raise ValueError('%s.%s: %s values in a %s column; infer '
+                                 'types from more rows (sample_size)' % (
+                                     name, cname, k, kind))
+            elif kind == 'int' and k == 'float':
+                kind = 'float'
+            fitted.append((kind, maxlen))
+        return fitted
+
+    def hash_predicate(self, key, n, i):
+        return 'ORA_HASH(%s, %d) = %d' % (key, n - 1, i)
+
+    def create(self, cursor, name, cols_str, temporary=False):
+        if not temporary:
+            cursor.execute('create table %s (%s)' % (name, cols_str))
+            return
+        try:
+            cursor.execute('create global temporary table %s (%s) '
+                           'on commit preserve rows' % (name, cols_str))
+        except cx_Oracle.DatabaseError as dberr:
+            error, = dberr.args
+            if error.code == 955:  # name is already used by an object
+                pass
+            else:
+                raise
+
+
+def infer_kind(values):
+    """Return `(kind, maxlen)` for an iterable of column values, where kind
+    is one of 'int', 'float', 'datetime', or 'str' and maxlen is the length
+    in UTF-8 bytes of the longest string representation seen.  Nulls are
+    ignored, so a column of all nulls is 'str'.  Mixed ints and floats are
+    'float'; any other mix is 'str'.
+    """
+    kind, maxlen = None, 0
+    for v in values:
+        if v is None or v is pd.NaT or (isinstance(v, float) and
+                                          math.isnan(v)):
+            continue
+        if isinstance(v, (bool, int, np.integer)):
+            k = 'int'
+        elif isinstance(v, (float, np.floating)):
+            k = 'float'
+        elif isinstance(v, (datetime.date, np.datetime64)):
+            k = 'datetime'
+        else:
+            k = 'str'
+        maxlen = max(maxlen, len(str(v).encode('utf8')))
+        if kind is None or kind == k:
+            kind = k
+        elif {kind, k} == {'int', 'float'}:
+            kind = 'float'
+        else:
+            kind = 'str'
+    return (kind or 'str', maxlen)
+
+
+def infer_column_types(data, sample_size=1000):
+    """Return a list of `(kind, maxlen)` (see `infer_kind`), one per column
+    of `data`, which may be a DataFrame, a 2-D NumPy array, or a list of rows.
+    Only the first `sample_size` rows are inspected unless it is None.
+    """
+    if isinstance(data, pd.DataFrame):
+        coltypes = []
+        for cname in data.columns:
+            col = data[cname]
+            dkind = col.dtype.kind
+            if dkind in 'iub':
+                coltypes.append(('int', 0))
+            elif dkind == 'f':
+                coltypes.append(('float', 0))
+            elif dkind == 'M':
+                coltypes.append(('datetime', 0))
+            else:
+                col = col.dropna()
+                col = col if sample_size is None else col.iloc[:sample_size]
+                coltypes.append(infer_kind(col.values))
+        return coltypes
+    rows = data if sample_size is None else data[:sample_size]
+    return [infer_kind(col) for col in zip(*rows)]
+
+
+def _df_rows(df):
+    cols = []
+    for cname in df.columns:
+        col = df[cname]
+        if col.dtype.kind == 'M':
+            cols.append([None if pd.isnull(x) else x.to_pydatetime()
+                         for x in col])
+        else:
+            obj = col.astype(object)
+            cols.append(obj.where(obj.notnull(), None).tolist())
+    return list(zip(*cols))
+
+
+def _array_rows(arr):
+    if arr.dtype.kind == 'f':
+        obj = arr.astype(object)
+        obj[np.isnan(arr)] = None
+        return [tuple(row) for row in obj.tolist()]
+    return [tuple(row) for row in arr.tolist()]
+
+
+def iter_batches(data, batch_size=10000):
+    """Yield lists of at most `batch_size` row tuples of Python values from
+    a DataFrame, a 2-D NumPy array, or any iterable of rows.  Nulls (NaN,
+    NaT) become None.
+    """
+    if isinstance(data, pd.DataFrame):
+        for i in range(0, len(data), batch_size):
+            yield _df_rows(data.iloc[i:i + batch_size])
+    elif isinstance(data, np.ndarray):
+        for i in range(0, len(data), batch_size):
+            yield _array_rows(data[i:i + batch_size])
+    else:
+        rows = iter(data)
+        while True:
+            batch = [tuple(row) for row in itertools.islice(rows, batch_size)]
+            if not batch:
+                return
+            yield batch
+
+
+def bulk_load(conn, name, cnames, data, backend=None, temporary=False,
+              create=True, batch_size=10000, commit_every=None,
+              sample_size=1000):
+    """Create table `name` and stream `data` into it with array DML.
+
+    `data` may be a DataFrame, a 2-D NumPy array, or an iterable of rows
+    (e.g., a generator); `cnames` defaults to the DataFrame's columns.
+    Column types are inferred from the first `sample_size` rows, or from all
+    rows if `sample_size` is None (which materializes an iterator).  Rows are
+    sent in batches of `batch_size` through a prepared statement with
+    `setinputsizes`, and the connection is committed every `commit_every`
+    rows (and at the end) if it is given; otherwise committing is left to
+    the caller.  `backend` is a dialect such as `OracleBackend` or
+    `SqliteBackend` (the default).
+
+    Values past the sample may not fit the inferred types.  If the table is
+    created here, each batch is first checked with `backend.fit`, which on
+    Oracle widens VARCHAR2 columns for longer strings and raises ValueError
+    for what cannot be widened (see `OracleBackend.fit`).
+
+    Returns a dict with the number of rows loaded, the elapsed seconds, and
+    rows per second.
+    """
+    LOGNAME = '%s:%s' % ('db.py', 'bulk_load()')
+    log = get_logger(LOGNAME)
+    backend = SqliteBackend() if backend is None else backend
+    if cnames is None:
+        cnames = list(data.columns)
+
+    if isinstance(data, (pd.DataFrame, np.ndarray)):
+        sample = data if isinstance(data, pd.DataFrame) else \
+            _array_rows(data if sample_size is None else data[:sample_size])
+        batches = iter_batches(data, batch_size)
+    else:
+        rows = iter(data)
+        sample = [tuple(row) for row in
+                  (rows if sample_size is None
+                   else itertools.islice(rows, sample_size))]
+        batches = iter_batches(itertools.chain(sample, rows), batch_size)
+    coltypes = infer_column_types(sample, sample_size)
+    if not coltypes:
+        coltypes = [('str', 0)] * len(cnames)
+
+    cursor = conn.cursor()
+    if create:
+        cols_str = ', '.join(['%s %s' % (cname,
+                                         backend.column_type(kind, maxlen))
+                              for cname, (kind, maxlen)
+                              in zip(cnames, coltypes)])
+        backend.create(cursor, name, cols_str, temporary=temporary)
+
+    sql_load = 'insert into %s (%s) values (%s)' % (
+        name, ', '.join(list(cnames)), backend.placeholders(len(cnames)))
+    sizes = backend.input_sizes(coltypes)
+    nrows, nrows_committed = 0, 0
+    t0 = mstime()
+    for batch in batches:
+        if create:
+            fitted = backend.fit(cursor, name, cnames, coltypes, batch)
+            if fitted != coltypes:
+                coltypes, sizes = fitted, backend.input_sizes(fitted)
+        if sizes is not None:
+            cursor.setinputsizes(*sizes)
+        cursor.executemany(sql_load, batch)
+        nrows += len(batch)
+        if commit_every is not None and \
+                nrows - nrows_committed >= commit_every:
+            conn.commit()
+            nrows_committed = nrows
+            log.debug('%s: committed %d rows', name, nrows)
+    if commit_every is not None and nrows > nrows_committed:
+        conn.commit()
+    secs = max(mstime() - t0, 1) / 1000
+    log.info('loaded %s: %d rows (%.0f rows/sec)' % (name, nrows,
+                                                     nrows / secs))
+    return {'rows': nrows, 'secs': secs, 'rows_per_sec': nrows / secs}
+
+
+##############################################################################
+# Columnar fetch into DataFrame chunks.
+
+def _reduce_column(col):
+    """Downcast an integer or float column to its smallest dtype."""
+    kind = col.dtype.kind
+    if kind in 'iu':
+        return pd.to_numeric(col, downcast='integer')
+    if kind == 'f':
+        return pd.to_numeric(col, downcast='float')
+    return col
+
+
+def fetch_frames(cursor, sql=None, params=None, arraysize=50000,
+                 reduce=True, arrow=False):
+    """Yield the result set of `cursor` (after executing `sql`, if given) as
+    DataFrames of at most `arraysize` rows.
+
+    Rows are fetched with `fetchmany` and transposed straight into column
+    arrays, so no per-row Python objects outlive a chunk and memory use is
+    bounded by `arraysize`.  If `reduce` is True, numeric columns are
+    downcast to their smallest dtype in the spirit of `get_reduced_dtypes`.
+    A column's dtype can only widen from one chunk to the next, and each chunk
+    is cast to the widest dtype seen so far (a chunk in which a numeric
+    column is all NULL to its float counterpart), so concatenating the
+    chunks of a numeric column never falls back to object.  Without `reduce`,
+    all-NULL chunks are object columns of None.  If `arrow` is True, chunks
+    are yielded as `pyarrow.RecordBatch`es instead.
+    """
+    if sql is not None:
+        if params is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql, params)
+    cursor.arraysize = arraysize
+    names = [x[0] for x in cursor.description]
+    frames = _column_frames(cursor, names, arraysize)
+    if reduce:
+        frames = _reduce_frames(frames)
+    for df in frames:
+        if arrow:
+            import pyarrow
+            yield pyarrow.RecordBatch.from_pandas(df, preserve_index=False)
+        else:
+            yield df
+
+
+def _column_frames(cursor, names, arraysize):
+    while True:
+        rows = cursor.fetchmany(arraysize)
+        if not rows:
+            return
+        cols = zip(*rows)
+        yield pd.DataFrame({name: pd.Series(col) for (name, col)
+                            in zip(names, cols)}, columns=names)
+
+
+def _reduce_frames(frames):
+    """Yield the DataFrames of iterable `frames` with numeric columns
+    downcast to their smallest dtype, widened as needed so that a column's
+    dtype never narrows from one frame to the next (see `fetch_frames`)."""
+    dtypes = {}
+    for df in frames:
+        for name in df.columns:
+            col = _reduce_column(df[name])
+            prev = dtypes.get(name)
+            if col.isna().all() and (prev is None or prev.kind in 'iuf'):
+                # All NULL (object Nones): NaN of the dtype seen so far.
+                col = col.astype(np.float32 if prev is None else
+                                 np.promote_types(prev, np.float32))
+            elif prev is not None and prev.kind in 'iuf' and \
+                    col.dtype.kind in 'iuf':
+                col = col.astype(np.promote_types(prev, col.dtype))
+            dtypes[name] = col.dtype
+            df[name] = col
+        yield df
 
 
 class DbOra:
@@ -22,7 +403,11 @@ class DbOra:
 #     oracle_connection_string = 'oracle+cx_oracle://' + \
 #         '{username}:{password}@{hostname}:{port}/{database}'
 
-    def __init__(self, username, password, hostname, sid, port=1521):
+    def __init__(self, username, password, hostname, sid, port=1521,
+                 cache=None):
+        """`cache` is an optional `querycache.QueryCache` consulted by
+        `query` and `query_frames`."""
+        self.cache = cache
         self._username = username
         self._hostname = hostname
         self._sid = sid
@@ -43,66 +428,70 @@ class DbOra:
     def cursor(self):
         return self._cursor
 
-    def put_data(self, name, cnames, data):
-        map_dtype_to_oratype = {
-            str: 'VARCHAR2(512)',
-            type(None): 'VARCHAR2(512)',
-            int: 'NUMBER',
-            float: 'NUMBER',
-            datetime.datetime: 'DATE',
-            Timestamp: 'DATE'
-        }
-        ora_types = [map_dtype_to_oratype[type(x)] for x in data[0]]
-        cols_str = ', '.join(['%s %s' % (cname, oratype)
-                              for cname, oratype in zip(cnames, ora_types)])
-        sql_create = 'create table ' + \
-            '%s (%s) ' % (name, cols_str)
-
-        ncols = len(data[0])
-        bind_vars_str = ', '.join([':%d' % (i + 1) for i in range(ncols)])
-        sql_load = 'insert into %s (%s) values (%s)' % (
-            name, ', '.join(list(cnames)), bind_vars_str)
-        self._cursor.execute(sql_create)
-        self._cursor.prepare(sql_load)
-        self._cursor.executemany(None, data)
-
-    def stage_data(self, name, cnames, data):
-        map_dtype_to_oratype = {
-            str: 'VARCHAR2(512)',
-            type(None): 'VARCHAR2(512)',
-            int: 'NUMBER',
-            float: 'NUMBER',
-            datetime.datetime: 'DATE',
-            Timestamp: 'DATE'
-        }
-        ora_types = [map_dtype_to_oratype[type(x)] for x in data[0]]
-        cols_str = ', '.join(['%s %s' % (cname, oratype)
-                              for cname, oratype in zip(cnames, ora_types)])
-        sql_create = 'create global temporary table ' + \
-            '%s (%s) on commit preserve rows' % (name, cols_str)
-
-        ncols = len(data[0])
-        bind_vars_str = ', '.join([':%d' % (i + 1) for i in range(ncols)])
-        sql_load = 'insert into %s (%s) values (%s)' % (
-            name, ', '.join(list(cnames)), bind_vars_str)
-        try:
-            self._cursor.execute(sql_create)
-        except cx_Oracle.DatabaseError as dberr:
-            error, = dberr.args
-            if error.code == 955:
-                pass
-            else:
-                raise
-        self._cursor.prepare(sql_load)
-        self._cursor.executemany(None, data)
+    def put_data(self, name, cnames, data, **kwargs):
+        """Create table `name` and load `data` into it.  See `bulk_load` for
+        accepted data types and keyword arguments."""
+        return bulk_load(self._connection, name, cnames, data,
+                         backend=OracleBackend(), **kwargs)
+
+    def stage_data(self, name, cnames, data, **kwargs):
+        """Like `put_data` but into a global temporary table that is kept
+        (not recreated) if it already exists."""
+        return bulk_load(self._connection, name, cnames, data,
+                         backend=OracleBackend(), temporary=True, **kwargs)
 
     def execute(self, sql):
         self._cursor.execute(sql)
 
     def query(self, sql):
-        self._cursor.execute(sql)
-        for rec in self._cursor:
-            yield rec
+        if self.cache is None:
+            self._cursor.execute(sql)
+            for rec in self._cursor:
+                yield rec
+        else:
+            for df in self.query_frames(sql, reduce=False):
+                for rec in _df_rows(df):
+                    yield rec
+
+    def query_frames(self, sql, params=None, arraysize=None, reduce=True,
+                     arrow=False):
+        """Like `query` but yields DataFrame chunks; see `fetch_frames`.
+
+        With a cache, a warm query's chunks are record batches of the
+        memory-mapped cached table (converted to DataFrames one at a time
+        unless `arrow` is True), and a cold query's chunks are written to
+        the cache as they are fetched (see `QueryCache.put_batches`).  The
+        cache holds the result as fetched, and `reduce` is applied as it is
+        read, so `query` and `query_frames` share one entry."""
+        arraysize = self._cursor.arraysize if arraysize is None else arraysize
+        if self.cache is None:
+            return fetch_frames(self._cursor, sql, params=params,
+                                arraysize=arraysize, reduce=reduce,
+                                arrow=arrow)
+        return self._cached_frames(sql, params, arraysize, reduce, arrow)
+
+    def _cached_frames(self, sql, params, arraysize, reduce, arrow):
+        conn_id = connection_id(self)
+        table = self.cache.get(sql, params, conn_id, arrow=True)
+        if table is not None:
+            batches = table.to_batches(max_chunksize=arraysize)
+        else:
+            batches = self.cache.put_batches(
+                fetch_frames(self._cursor, sql, params=params,
+                             arraysize=arraysize, reduce=False, arrow=True),
+                sql, params, conn_id)
+        if arrow and not reduce:
+            for batch in batches:
+                yield batch
+            return
+        frames = (batch.to_pandas() for batch in batches)
+        for df in _reduce_frames(frames) if reduce else frames:
+            if arrow:
+                import pyarrow
+                yield pyarrow.RecordBatch.from_pandas(df,
+                                                      preserve_index=False)
+            else:
+                yield df
 
     def get_column_names(self):
         return [x[0] for x in self._cursor.description]
@@ -116,3 +505,264 @@ class DbOra:
     def __del__(self):
         self._connection.rollback()
         self._connection.close()
+
+
+##############################################################################
+# Connection pools and partitioned parallel extraction.
+
+class ConnectionPool(object):
+    """Fixed-size pool of DB-API connections, each made by calling `connect`.
+    `backend` is the dialect used to build partition predicates."""
+
+    def __init__(self, connect, size=4, backend=None):
+        self.size = size
+        self.backend = SqliteBackend() if backend is None else backend
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(connect())
+
+    @contextmanager
+    def connection(self):
+        conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def query_frames(self, sql, key, n_partitions=None, bounds=None,
+                     **kwargs):
+        """See `partitioned_frames`."""
+        return partitioned_frames(self, sql, key, n_partitions=n_partitions,
+                                  bounds=bounds, **kwargs)
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+
+class DbOraPool(ConnectionPool):
+    """`ConnectionPool` backed by a cx_Oracle session pool."""
+
+    def __init__(self, username, password, hostname, sid, port=1521,
+                 size=4):
+        self.size = size
+        self.backend = OracleBackend()
+        self._pool = cx_Oracle.SessionPool(
+            username, password, '%s:%d/%s' % (hostname, port, sid),
+            min=size, max=size, increment=0, threaded=True)
+
+    @contextmanager
+    def connection(self):
+        conn = self._pool.acquire()
+        try:
+            yield conn
+        finally:
+            self._pool.release(conn)
+
+    def close(self):
+        self._pool.close()
+
+
+def partition_queries(sql, key, n_partitions=None, bounds=None,
+                      backend=None):
+    """Split query `sql` into disjoint queries that together return the same
+    rows, and return them as a list of `(query, params)` pairs.
+
+    With `bounds` (a sorted list of key values), partition i holds the rows
+    with `bounds[i-1] <= key < bounds[i]`, giving `len(bounds) + 1`
+    partitions; the bounds are passed as the named bind variables
+    `:lo_i` and `:hi_i` in `params`, never written into the SQL.  Otherwise
+    there are `n_partitions` partitions by a hash of `key` (e.g., `ORA_HASH`
+    on Oracle) and `params` is empty.  Rows with a null key go to the first
+    partition.
+    """
+    backend = SqliteBackend() if backend is None else backend
+    if bounds is not None:
+        lims = [None] + list(bounds) + [None]
+        preds, params = [], []
+        for (i, (lo, hi)) in enumerate(zip(lims[:-1], lims[1:])):
+            conds, binds = [], {}
+            if lo is not None:
+                conds.append('%s >= :lo_%d' % (key, i))
+                binds['lo_%d' % i] = lo
+            if hi is not None:
+                conds.append('%s < :hi_%d' % (key, i))
+                binds['hi_%d' % i] = hi
+            preds.append(' and '.join(conds or ['1 = 1']))
+            params.append(binds)
+    else:
+        preds = [backend.hash_predicate(key, n_partitions, i)
+                 for i in range(n_partitions)]
+        params = [{} for _ in preds]
+    preds[0] = '(%s or %s is null)' % (preds[0], key)
+    return [('select * from (%s) p where %s' % (sql, pred), binds)
+            for (pred, binds) in zip(preds, params)]
+
+
+_DONE = object()
+
+
+def partitioned_frames(pool, sql, key, n_partitions=None, bounds=None,
+                       ordered=True, queue_size=2, **fetch_kwargs):
+    """Run the partitions of `sql` (see `partition_queries`) concurrently on
+    the connections of `pool` and yield their DataFrame chunks (see
+    `fetch_frames`, which receives `fetch_kwargs`).  Bind variables of
+    `sql` may be given as a dict in `params`, alongside the partitions' own.
+
+    If `ordered` is True, all chunks of partition 0 are yielded first, then
+    those of partition 1, and so on; otherwise chunks are yielded as they
+    arrive.  Each partition buffers at most `queue_size` chunks ahead of the
+    consumer, so memory stays bounded by
+    `pool.size * queue_size * arraysize` rows.
+    """
+    n_partitions = pool.size if n_partitions is None and bounds is None \
+        else n_partitions
+    base_params = fetch_kwargs.pop('params', None) or {}
+    queries = partition_queries(sql, key, n_partitions=n_partitions,
+                                bounds=bounds, backend=pool.backend)
+    stop = threading.Event()
+    if ordered:
+        queues = [queue.Queue(maxsize=queue_size) for _ in queries]
+    else:
+        queues = [queue.Queue(maxsize=queue_size * len(queries))] * \
+            len(queries)
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker(i):
+        if stop.is_set():  # the consumer is gone; skip the query
+            return
+        q = queues[i]
+        try:
+            with pool.connection() as conn:
+                if stop.is_set():
+                    return
+                (sql_i, params_i) = queries[i]
+                params_i = dict(base_params, **params_i)
+                for chunk in fetch_frames(conn.cursor(), sql_i,
+                                          params=params_i or None,
+                                          **fetch_kwargs):
+                    if not put(q, chunk):
+                        return
+        except Exception as e:
+            put(q, e)
+        put(q, _DONE)
+
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        try:
+            for i in range(len(queries)):
+                executor.submit(worker, i)
+            n_done = 0
+            i = 0
+            while n_done < len(queries):
+                item = queues[i].get()
+                if item is _DONE:
+                    n_done += 1
+                    i += 1 if ordered else 0
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def test_bulk_load_sqlite():
+    conn = SqliteBackend().connect()
+    df = pd.DataFrame({'i': [1, 2, 3], 'x': [0.5, np.nan, 2.0],
+                       's': ['a', 'ñandú', None]})
+    assert bulk_load(conn, 't', None, df, batch_size=2)['rows'] == 3
+    rows = conn.execute('select i, x, s from t order by i').fetchall()
+    assert rows == [(1, 0.5, 'a'), (2, None, 'ñandú'), (3, 2.0, None)]
+    gen = ((i, 'é' * i) for i in range(5))
+    bulk_load(conn, 'g', ['i', 's'], gen, sample_size=2)
+    assert conn.execute('select s from g where i = 4').fetchone() == \
+        ('éééé',)
+
+
+def test_fetch_frames_null_chunks():
+    conn = SqliteBackend().connect()
+    conn.execute('create table t (i INTEGER, n INTEGER)')
+    conn.executemany('insert into t values (?, ?)',
+                     [(i, None if i < 2 or i > 3 else i) for i in range(6)])
+    frames = list(fetch_frames(conn.cursor(), 'select * from t order by i',
+                               arraysize=2))
+    assert [str(df['n'].dtype) for df in frames] == ['float32'] * 3
+    df = pd.concat(frames, ignore_index=True)
+    assert df['n'].dtype == np.float32 and df['n'].isna().sum() == 4
+
+
+def test_oracle_string_sizes():
+    assert infer_kind(['ñandú', 'abc']) == ('str', 7)
+    ora = OracleBackend()
+    assert ora.column_type(*infer_kind(['é' * 1000])) == 'VARCHAR2(2000)'
+    assert ora.column_type(*infer_kind(['é' * 2001])) == 'CLOB'
+
+
+def test_oracle_fit_widens():
+    class Cursor(object):
+        executed = []
+
+        def execute(self, sql):
+            self.executed.append(sql)
+
+    ora, cursor = OracleBackend(), Cursor()
+    coltypes = [('str', 3), ('int', 0)]
+    fitted = ora.fit(cursor, 't', ['s', 'i'], coltypes,
+                     [('é' * 300, 1), (None, 2.5)])
+    assert fitted == [('str', 600), ('float', 0)]
+    assert cursor.executed == ['alter table t modify (s VARCHAR2(600))']
+    for batch in ([('x' * 4001, 1)], [('x', 'one')]):
+        try:
+            ora.fit(cursor, 't', ['s', 'i'], fitted, batch)
+            assert False
+        except ValueError:
+            pass
+    assert len(cursor.executed) == 1
+
+
+def test_partition_binds():
+    conn = SqliteBackend().connect()
+    conn.execute('create table t (k TEXT, v INTEGER)')
+    keys = ["a'b", 'b', 'c', None, "x'); drop table t; --"]
+    conn.executemany('insert into t values (?, ?)',
+                     [(k, i) for (i, k) in enumerate(keys)])
+    queries = partition_queries('select * from t', 'k', bounds=["b'", 'c'])
+    assert all("'" not in q for (q, _) in queries)
+    parts = [sorted(v for (_, v) in conn.execute(q, p).fetchall())
+             for (q, p) in queries]
+    assert parts == [[0, 1, 3], [], [2, 4]]
+
+
+def test_cached_query_matches_uncached():
+    import tempfile
+    from epana.querycache import QueryCache
+    conn = SqliteBackend().connect()
+    conn.execute('create table t (i INTEGER, s TEXT, x REAL)')
+    conn.executemany('insert into t values (?, ?, ?)',
+                     [(i, None if i < 3 else 's%d' % i, i / 4 or None)
+                      for i in range(25)] + [(300, 'big', None)])
+    db = DbOra.__new__(DbOra)  # a DbOra on sqlite, without cx_Oracle
+    (db._connection, db._cursor) = (conn, conn.cursor())
+    (db._username, db._hostname, db._port, db._sid) = ('u', 'h', 1, 's')
+    db.cache = None
+    rows = list(db.query('select * from t'))
+    dtypes = [df.i.dtype for df in db.query_frames('select * from t',
+                                                   arraysize=10)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db.cache = QueryCache(tmpdir)
+        for _ in range(2):  # cold, then warm from the same entry
+            assert [df.i.dtype for df in
+                    db.query_frames('select * from t', arraysize=10)] == \
+                dtypes
+            assert list(db.query('select * from t')) == rows
+        assert len(db.cache.entries()) == 1
+        db.cache = None
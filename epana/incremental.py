@@ -0,0 +1,192 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Evan T. Phelps
+#
+# Distributed under terms of the MIT license.
+"""
+Incremental re-profiling of append-only files.
+
+`IncrementalProfile` keeps the accumulators behind `get_summary`, `freq`,
+and `count_charclasses` in a state file, together with the byte offset and
+SHA-256 checksum of the prefix of the data file that they cover.  Each
+`update` checks the prefix against the checksum and then profiles only the
+bytes appended since the last run.  If the prefix changed (the file was
+rewritten, truncated, or edited in place), or the profile settings changed,
+everything is recomputed from the start.
+"""
+##############################################################################
+import hashlib
+import itertools
+import os
+import pickle
+
+import numpy as np
+
+from epana.logutils import get_logger
+from epana.logutils import span
+from epana.scrubdub import charclass_counts
+from epana.scrubdub import guess_block_encoding
+from epana.scrubdub import isstring
+
+STATE_VERSION = 2
+
+
+class IncrementalProfile(object):
+    """Profile of a growing file, kept in `state_fn` between runs.
+
+    `freqs` lists the attribute groups to count for `freq` (e.g.,
+    `[['cat'], ['cat', 'subcat']]`).  Other keyword arguments go to
+    `tabular.parse_blocks` (and so to `pd.read_csv`, e.g. `sep='|'`).
+
+    Only complete lines are profiled.  An unterminated last line, which may
+    still be being written, is left for the next run.  Quoted fields that
+    span lines must not straddle the end of a run.
+
+    >>> prof = IncrementalProfile('feed.state', freqs=[['cat']])
+    >>> prof.update('feed.csv')  # daily
+    >>> prof.summary(); prof.freq('cat'); prof.charclasses()
+    """
+
+    def __init__(self, state_fn, freqs=(), blocksize=1048576,
+                 chunksize=100000, max_distinct=100000, **kwargs):
+        self.state_fn = state_fn
+        self.freqs = [tuple([g] if isstring(g) else g) for g in freqs]
+        self.blocksize = blocksize
+        self.chunksize = chunksize
+        self.max_distinct = max_distinct
+        self.kwargs = kwargs
+        self._log = get_logger('incremental.py:IncrementalProfile')
+        self.state = self._load()
+
+    def _settings(self):
+        return {'freqs': self.freqs, 'max_distinct': self.max_distinct,
+                'kwargs': sorted(self.kwargs.items())}
+
+    def _load(self):
+        try:
+            with open(self.state_fn, 'rb') as fin:
+                state = pickle.load(fin)
+        except FileNotFoundError:
+            return None
+        if state.get('version') != STATE_VERSION or \
+                state.get('settings') != self._settings():
+            self._log.info('%s: state is stale; will recompute',
+                           self.state_fn)
+            return None
+        return state
+
+    def _save(self):
+        tmp = '%s.%d.tmp' % (self.state_fn, os.getpid())
+        with open(tmp, 'wb') as fout:
+            pickle.dump(self.state, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.state_fn)
+
+    def _new_state(self):
+        from epana.tabular import FreqAccumulator, SummaryAccumulator
+        return {'version': STATE_VERSION, 'settings': self._settings(),
+                'offset': 0, 'sha256': hashlib.sha256().hexdigest(),
+                'header': None, 'encoding': None,
+                'summary': SummaryAccumulator(self.max_distinct),
+                'freqs': FreqAccumulator(self.freqs),
+                'header_bytes': np.zeros(256, dtype=np.int64),
+                'body_bytes': np.zeros(256, dtype=np.int64)}
+
+    def _prefix_matches(self, fin, hasher, offset):
+        """Hash the first `offset` bytes of fin into hasher and return True
+        if they match the saved checksum."""
+        remaining = offset
+        while remaining:
+            blk = fin.read(min(self.blocksize, remaining))
+            if not blk:
+                return False
+            hasher.update(blk)
+            remaining -= len(blk)
+        return hasher.hexdigest() == self.state['sha256']
+
+    def _appended(self, fin, hasher):
+        """Yield appended blocks up to the last line break, updating the
+        hash, offset, and byte counts as they are consumed."""
+        st = self.state
+        pending = b''
+        while True:
+            blk = fin.read(self.blocksize)
+            if not blk:
+                break
+            blk, pending = pending + blk, b''
+            cut = blk.rfind(b'\n') + 1
+            blk, pending = blk[:cut], blk[cut:]
+            if not blk:
+                continue
+            if st['header'] is None:
+                end = blk.index(b'\n') + 1
+                st['header'] = blk[:end]
+                st['encoding'] = guess_block_encoding(blk) or 'utf-8'
+                st['header_bytes'] += np.bincount(
+                    np.frombuffer(blk[:end], dtype=np.uint8), minlength=256)
+                body = blk[end:]
+            else:
+                body = blk
+            st['body_bytes'] += np.bincount(
+                np.frombuffer(body, dtype=np.uint8), minlength=256)
+            hasher.update(blk)
+            st['offset'] += len(blk)
+            yield blk
+
+    def update(self, fn):
+        """Profile the bytes of fn appended since the last update (or all of
+        fn if the state is missing, stale, or does not match fn's prefix),
+        save the state, and return a dict with the `mode` ('incremental' or
+        'full') and the number of bytes profiled."""
+        from epana.tabular import parse_blocks
+        size = os.path.getsize(fn)
+        mode = 'incremental'
+        with open(fn, 'rb') as fin:
+            hasher = hashlib.sha256()
+            if self.state is None or size < self.state['offset'] or \
+                    not self._prefix_matches(fin, hasher,
+                                             self.state['offset']):
+                if self.state is not None:
+                    self._log.info('%s: prefix changed; recomputing', fn)
+                self.state = self._new_state()
+                hasher = hashlib.sha256()
+                fin.seek(0)
+                mode = 'full'
+            st = self.state
+            start = st['offset']
+            blocks = self._appended(fin, hasher)
+            first = next(blocks, None)
+            if first is not None:
+                with span('incremental_profile', bytes=size - start) as sp:
+                    head = [] if start == 0 else [st['header']]
+                    chunks = parse_blocks(
+                        itertools.chain(head, [first], blocks),
+                        st['encoding'], self.chunksize, **self.kwargs)
+                    for chunk in chunks:
+                        sp.add(rows=len(chunk))
+                        st['summary'].update(chunk)
+                        st['freqs'].update(chunk)
+            st['sha256'] = hasher.hexdigest()
+        self._save()
+        self._log.info('%s: %s update of %d bytes', fn, mode,
+                       st['offset'] - start)
+        return {'mode': mode, 'bytes': st['offset'] - start,
+                'offset': st['offset']}
+
+    def summary(self):
+        """Return the `get_summary` table of the profiled rows."""
+        return self.state['summary'].summary()
+
+    def freq(self, attgrp, agglvl=0, multi_idx=False, cumsum=False):
+        """Return the `freq` table of the profiled rows for one of the
+        attribute groups given as `freqs`."""
+        return self.state['freqs'].freq(attgrp, agglvl=agglvl,
+                                        multi_idx=multi_idx, cumsum=cumsum)
+
+    def charclasses(self):
+        """Return the `count_charclasses` Counters for header and body of the
+        profiled lines."""
+        return tuple(charclass_counts({k: int(n) for (k, n) in
+                                       enumerate(self.state[key]) if n})
+                     for key in ('header_bytes', 'body_bytes'))
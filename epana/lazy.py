@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Evan T. Phelps
+#
+# Distributed under terms of the MIT license.
+"""
+Deferred imports of heavy or optional dependencies, and import-time
+measurement.
+"""
+##############################################################################
+import importlib
+import subprocess
+import sys
+
+
+class LazyModule(object):
+    """Stand-in for a module that is imported on first attribute access.
+
+    `LazyModule('scipy.stats')` behaves like the name bound by
+    `import scipy.stats` (i.e., the top-level `scipy` package, with `stats`
+    loaded), and `LazyModule('matplotlib.pyplot', leaf=True)` like the name
+    bound by `from matplotlib import pyplot`.  A missing module raises
+    ImportError at first use rather than at import of the using module.
+    """
+
+    def __init__(self, name, leaf=False):
+        self.__dict__['_name'] = name
+        self.__dict__['_leaf'] = leaf
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            name = self.__dict__['_name']
+            module = importlib.import_module(name)
+            if not self.__dict__['_leaf']:
+                module = sys.modules[name.split('.')[0]]
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return '<lazy module %r%s>' % (
+            self.__dict__['_name'],
+            '' if self.__dict__['_module'] is None else ' (loaded)')
+
+
+def lazy_import(name, leaf=False):
+    """Return a `LazyModule` for module `name`."""
+    return LazyModule(name, leaf=leaf)
+
+
+def measure_import_times(modules=None, repeat=3):
+    """Time `import <module>` in fresh interpreters.
+
+    Returns a dict mapping each module (by default every `epana` module) to
+    the best wall-clock seconds over `repeat` runs, measured inside the child
+    so that interpreter startup is excluded.
+    """
+    modules = ['epana.%s' % m for m in ('logutils', 'scrubdub', 'tabular',
+                                         'crosstabular', 'stats', 'sketches',
+                                         'throttle', 'rxn', 'db',
+                                         'querycache', 'cryptic')] \
+        if modules is None else modules
+    code = ('import time; t0 = time.perf_counter(); import %s; '
+            'print(time.perf_counter() - t0)')
+    times = {}
+    for module in modules:
+        best = None
+        for _ in range(repeat):
+            proc = subprocess.run([sys.executable, '-c', code % module],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+            if proc.returncode != 0:
+                best = None
+                break
+            secs = float(proc.stdout.decode().split()[-1])
+            best = secs if best is None else min(best, secs)
+        times[module] = best
+    return times
+
+
+def test_lazy_import():
+    json = lazy_import('json')
+    assert json.__dict__['_module'] is None
+    assert json.loads('[1]') == [1]
+    assert json.__dict__['_module'] is sys.modules['json']
@@ -8,12 +8,19 @@
 """
 Logger wrapper and associated convencience functions.
 """
+import json
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import threading
 import time
-# from functools import wraps
+from collections import deque
+from functools import wraps
 
 ENV_LOGLEVEL = 'LOGLEVEL'
+ENV_PROFILE = 'EPANA_PROFILE'
 LEVELS = {
     'debug': logging.DEBUG,
     'info': logging.INFO,
@@ -23,22 +30,296 @@ LEVELS = {
 }
 
 
+LOG_FORMAT = '%(asctime)s.%(msecs)03d | ' + \
+    '%(levelname)s | %(message)s'
+# '%(filename)s:%(lineno)d [%(funcName)s] | ' +
+LOG_DATEFMT = '%s'  # '%Y-%m-%d %H:%M:%S'
+_configured = False
+
+
 def get_logger(logname):
-    logging.basicConfig(level=LEVELS.get(os.getenv(ENV_LOGLEVEL),
-                                         logging.INFO),
-                        format='%(asctime)s.%(msecs)03d | ' +
-                               # '%(filename)s:%(lineno)d [%(funcName)s] | ' +
-                               '%(levelname)s | %(message)s',
-                        datefmt='%s')  # '%Y-%m-%d %H:%M:%S')
+    global _configured
+    if not _configured:
+        logging.basicConfig(level=LEVELS.get(os.getenv(ENV_LOGLEVEL),
+                                             logging.INFO),
+                            format=LOG_FORMAT,
+                            datefmt=LOG_DATEFMT)
+        _configured = True
     log = logging.getLogger(logname)
     # log.addHandler(logging.StreamHandler())
     return log
 
 
+##############################################################################
+# Asynchronous (queue-based) logging.
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting (timestamps, layout) to the
+    listener thread.  Only the message arguments are merged, and any
+    exception text is rendered, so that records can be pickled to other
+    processes."""
+
+    def prepare(self, record):
+        # Records are handled by this handler alone (it replaces the root
+        # handlers), so they are modified in place rather than copied.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+_log_queue = None
+
+
+def start_async_logging(handlers=None, mp=True):
+    """Route all logging through a queue drained by one listener thread.
+
+    The root logger's handlers (configuring them first, as `get_logger`
+    does, if there are none), or `handlers` if given, move to a
+    `QueueListener`; the root logger gets a handler that only enqueues
+    records.  With `mp`, the queue is a `multiprocessing.Queue`, so that
+    child processes started with `worker_logging_init` (e.g., as a pool
+    initializer, with `get_log_queue()`) log through the same listener.
+    Returns the queue.
+    """
+    global _listener, _log_queue
+    if _listener is not None:
+        return _log_queue
+    get_logger(__name__)
+    root = logging.getLogger()
+    handlers = list(root.handlers) if handlers is None else handlers
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    _log_queue = multiprocessing.Queue(-1) if mp else queue.SimpleQueue()
+    root.addHandler(_DeferredQueueHandler(_log_queue))
+    _listener = logging.handlers.QueueListener(
+        _log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _log_queue
+
+
+def stop_async_logging():
+    """Flush the queue, stop the listener, and restore its handlers to the
+    root logger."""
+    global _listener, _log_queue
+    if _listener is None:
+        return
+    _listener.stop()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, _DeferredQueueHandler):
+            root.removeHandler(handler)
+    for handler in _listener.handlers:
+        root.addHandler(handler)
+    _listener, _log_queue = None, None
+
+
+def get_log_queue():
+    return _log_queue
+
+
+def worker_logging_init(log_queue, level=None):
+    """Initializer for worker processes: send all records to `log_queue`
+    (from `start_async_logging`) instead of configuring logging locally."""
+    global _configured
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.setLevel(LEVELS.get(os.getenv(ENV_LOGLEVEL), logging.INFO)
+                  if level is None else level)
+    _configured = True
+
+
+def measure_logging(n=100000, fn=os.devnull):
+    """Microbenchmark per-call latency of logging to file fn in a tight
+    loop, synchronously and through the async queue, for records that pass
+    and that are filtered by level.  Returns a dict of microseconds per
+    call."""
+    log = logging.getLogger('logutils.py:measure_logging()')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    handler = logging.FileHandler(fn)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATEFMT))
+
+    def per_call(level):
+        t0 = time.perf_counter_ns()
+        for i in range(n):
+            log.log(level, 'record %d of %d', i, n)
+        return (time.perf_counter_ns() - t0) / n / 1e3
+
+    results = {}
+    log.addHandler(handler)
+    try:
+        results['sync_us'] = per_call(logging.INFO)
+        results['filtered_us'] = per_call(logging.DEBUG)
+    finally:
+        log.removeHandler(handler)
+    q = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(q, handler)
+    qhandler = _DeferredQueueHandler(q)
+    log.addHandler(qhandler)
+    listener.start()
+    try:
+        results['async_us'] = per_call(logging.INFO)
+    finally:
+        log.removeHandler(qhandler)
+        listener.stop()
+        handler.close()
+    return results
+
+
 def mstime():
     return int(round(time.time() * 1000))
 
 
+##############################################################################
+# Hierarchical profiling spans.
+
+_profiling = bool(os.getenv(ENV_PROFILE))
+_local = threading.local()
+_span_stats = {}
+_span_lock = threading.Lock()
+SPAN_SAMPLES = 10000  # durations kept per span path for percentiles
+
+
+def enable_profiling(enabled=True):
+    """Turn span recording on or off (it starts on if the EPANA_PROFILE
+    environment variable is set)."""
+    global _profiling
+    _profiling = enabled
+
+
+class _NullSpan(object):
+    """What `span` returns while profiling is disabled; does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counters):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    """A timed region, nested under whatever span is open on this thread
+    (so its path reads like `get_df_raw>guess_encoding>parse`)."""
+    __slots__ = ('name', 'path', 'counters', 't0')
+
+    def __init__(self, name, counters):
+        self.name = name
+        self.counters = counters
+        self.path = None
+        self.t0 = None
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.path = '%s>%s' % (stack[-1].path, self.name) if stack \
+            else self.name
+        stack.append(self)
+        self.t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        dt = time.perf_counter_ns() - self.t0
+        _local.stack.pop()
+        with _span_lock:
+            stats = _span_stats.get(self.path)
+            if stats is None:
+                stats = _span_stats[self.path] = {
+                    'count': 0, 'total_ns': 0,
+                    'samples': deque(maxlen=SPAN_SAMPLES), 'counters': {}}
+            stats['count'] += 1
+            stats['total_ns'] += dt
+            stats['samples'].append(dt)
+            for k, v in self.counters.items():
+                stats['counters'][k] = stats['counters'].get(k, 0) + v
+        return False
+
+    def add(self, **counters):
+        """Accumulate counters such as rows= or bytes= on the span."""
+        for k, v in counters.items():
+            self.counters[k] = self.counters.get(k, 0) + v
+
+
+def span(name, **counters):
+    """Context manager that records a profiling span named `name` with
+    optional initial counters.  Returns a shared no-op object while
+    profiling is disabled."""
+    if not _profiling:
+        return _NULL_SPAN
+    return Span(name, counters)
+
+
+def logged(func):
+    """Decorator that logs entry and exit of `func` at debug level, with
+    timing, on a logger named like the hand-built `LOGNAME`s
+    (`module.py:func()`), and records a profiling span named after it.  It
+    costs two flag checks per call when neither is enabled."""
+    logname = '%s.py:%s()' % (func.__module__.split('.')[-1], func.__name__)
+    loggers = []
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not loggers:
+            loggers.append(get_logger(logname))
+        log = loggers[0]
+        debug = log.isEnabledFor(logging.DEBUG)
+        if not debug and not _profiling:
+            return func(*args, **kwargs)
+        if debug:
+            log.debug('enter')
+        t0 = time.perf_counter_ns()
+        with span(func.__name__):
+            retval = func(*args, **kwargs)
+        if debug:
+            log.debug('exit (%.3f msecs)' %
+                      ((time.perf_counter_ns() - t0) / 1e6))
+        return retval
+
+    return wrapper
+
+
+def _percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def profile_stats():
+    """Return per-span-path aggregates: count, total/mean/p50/p95 msecs
+    (percentiles over the most recent SPAN_SAMPLES calls), and counters."""
+    with _span_lock:
+        return {path: dict({'count': st['count'],
+                            'total_ms': st['total_ns'] / 1e6,
+                            'mean_ms': st['total_ns'] / 1e6 / st['count'],
+                            'p50_ms': _percentile(st['samples'], 0.50) / 1e6,
+                            'p95_ms': _percentile(st['samples'], 0.95) / 1e6},
+                           **st['counters'])
+                for (path, st) in sorted(_span_stats.items())}
+
+
+def export_profile(fn):
+    """Write `profile_stats()` to JSON file fn."""
+    with open(fn, 'w') as fout:
+        json.dump(profile_stats(), fout, indent=2)
+
+
+def reset_profile():
+    with _span_lock:
+        _span_stats.clear()
+
+
 def test_get_logger():
     log = get_logger('test log name')
     log.debug('I am debug.')
@@ -60,3 +341,38 @@ def test_mstime():
     t1 = mstime()
     dt = t1 - t0 - wtime_ms
     assert dt >= 0 and dt < threshold_ms
+
+
+def test_span():
+    reset_profile()
+    enable_profiling(True)
+    try:
+        with span('outer') as outer:
+            outer.add(rows=3)
+            with span('inner', bytes=10):
+                time.sleep(0.001)
+    finally:
+        enable_profiling(False)
+    stats = profile_stats()
+    assert stats['outer']['count'] == 1 and stats['outer']['rows'] == 3
+    assert stats['outer>inner']['bytes'] == 10
+    assert stats['outer']['total_ms'] >= stats['outer>inner']['total_ms'] >= 1
+    assert span('disabled') is _NULL_SPAN
+
+
+def test_async_logging():
+    records = []
+
+    class ListHandler(logging.Handler):
+        def emit(self, record):
+            records.append(self.format(record))
+
+    start_async_logging(handlers=[ListHandler()], mp=False)
+    try:
+        log = get_logger('test async')
+        log.setLevel(logging.INFO)
+        log.info('value %d', 42)
+        log.debug('filtered %d', 0)
+    finally:
+        stop_async_logging()
+    assert records == ['value 42']
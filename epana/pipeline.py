@@ -0,0 +1,220 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Evan T. Phelps
+#
+# Distributed under terms of the MIT license.
+"""
+Streaming pipelines of generator stages connected by bounded queues.
+
+A pipeline starts from a source iterable (e.g., `cryptic.iter_blocks`) and
+applies stages, each a function from an iterator to an iterator (e.g.,
+`cryptic.decrypt_blocks`, `scrubdub.repair_blocks`, `tabular.parse_blocks`).
+Every stage runs in its own thread, so stages overlap, and at most
+`queue_size` items wait between any two stages, so memory use depends on
+block and chunk sizes but not on the size of the input.
+"""
+##############################################################################
+import queue
+import threading
+import time
+from functools import partial
+
+from epana.logutils import get_logger
+
+_DONE = object()
+
+
+class StageStats(object):
+    """Counters of one pipeline stage.  `busy` is the time spent producing
+    items; `wait_in` and `wait_out` are the times spent blocked on the
+    previous and next stages, which show where the bottleneck is."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.rows = 0
+        self.busy = 0.0
+        self.wait_in = 0.0
+        self.wait_out = 0.0
+        self.t0 = None
+        self.t1 = None
+
+    def count(self, item):
+        self.items += 1
+        if isinstance(item, (bytes, bytearray, str)):
+            self.bytes += len(item)
+        elif hasattr(item, 'shape'):
+            self.rows += item.shape[0]
+
+    def as_dict(self):
+        secs = (self.t1 or time.perf_counter()) - (self.t0 or 0) \
+            if self.t0 is not None else 0.0
+        return {'stage': self.name, 'items': self.items,
+                'bytes': self.bytes, 'rows': self.rows, 'secs': secs,
+                'busy': self.busy, 'wait_in': self.wait_in,
+                'wait_out': self.wait_out,
+                'mb_per_sec': self.bytes / 2**20 / secs if secs else None,
+                'rows_per_sec': self.rows / secs if secs else None}
+
+
+class Pipeline(object):
+    """Chain of stages over a source iterable.
+
+    >>> p = (Pipeline(iter_blocks(fn))
+    ...      .pipe(repair_blocks, name='repair')
+    ...      .pipe(parse_blocks, encoding='utf8', chunksize=50000))
+    >>> for chunk in p: ...
+
+    Iterating starts one thread per stage (including the source) and yields
+    the items of the last stage.  An exception in any stage stops the others
+    and is re-raised in the consumer; stopping early also stops every stage.
+    `stats` gives per-stage counts and throughput.
+    """
+
+    def __init__(self, source, name='source', queue_size=4):
+        self.queue_size = queue_size
+        self._stages = [(name, lambda _: source)]
+        self._stats = []
+        self._errors = []
+        self._log = get_logger('pipeline.py:Pipeline')
+
+    def pipe(self, func, name=None, **kwargs):
+        """Append stage `func(iterator, **kwargs)`, which returns an
+        iterator, and return the pipeline."""
+        name = getattr(func, '__name__', 'stage') if name is None else name
+        self._stages.append((name, partial(func, **kwargs)
+                             if kwargs else func))
+        return self
+
+    def _put(self, q, item, stop, st):
+        t0 = time.perf_counter()
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        st.wait_out += time.perf_counter() - t0
+
+    def _inputs(self, q, stop, st):
+        """Yield items from the previous stage's queue until it is done or
+        the pipeline stops."""
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            finally:
+                st.wait_in += time.perf_counter() - t0
+            if item is _DONE:
+                return
+            yield item
+
+    def _run_stage(self, func, q_in, q_out, stop, st):
+        st.t0 = time.perf_counter()
+        items = None
+        try:
+            items = iter(func(None if q_in is None
+                              else self._inputs(q_in, stop, st)))
+            while not stop.is_set():
+                t0, wait_in = time.perf_counter(), st.wait_in
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    st.busy += time.perf_counter() - t0 - \
+                        (st.wait_in - wait_in)
+                st.count(item)
+                self._put(q_out, item, stop, st)
+            self._put(q_out, _DONE, stop, st)
+        except BaseException as e:
+            self._log.error('stage %s failed: %r', st.name, e)
+            self._errors.append(e)
+            stop.set()
+        finally:
+            st.t1 = time.perf_counter()
+            if hasattr(items, 'close'):
+                items.close()
+
+    def __iter__(self):
+        stop = threading.Event()
+        self._errors = []
+        self._stats = [StageStats(name) for (name, _) in self._stages]
+        queues = [queue.Queue(self.queue_size) for _ in self._stages]
+        threads = [threading.Thread(target=self._run_stage, daemon=True,
+                                    args=(func, queues[i - 1] if i else None,
+                                          queues[i], stop, self._stats[i]))
+                   for (i, (_, func)) in enumerate(self._stages)]
+        for thread in threads:
+            thread.start()
+        try:
+            while not self._errors:
+                try:
+                    item = queues[-1].get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    break
+                yield item
+            if self._errors:
+                raise self._errors[0]
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def run(self):
+        """Run the pipeline to completion and return the last item (e.g.,
+        the accumulator yielded by `profile_chunks`)."""
+        last = None
+        for last in self:
+            pass
+        return last
+
+    def stats(self):
+        """Return per-stage counts, seconds, and throughput as a list of
+        dicts, in stage order."""
+        return [st.as_dict() for st in self._stats]
+
+
+def profile_chunks(chunks, acc=None):
+    """Pipeline sink: update a `tabular.SummaryAccumulator` (a new one if
+    `acc` is None) with every dataframe chunk and yield it once at the
+    end."""
+    from epana.tabular import SummaryAccumulator
+    acc = SummaryAccumulator() if acc is None else acc
+    for chunk in chunks:
+        acc.update(chunk)
+    yield acc
+
+
+def profile_pipeline(fpath, pwd=None, fix_unicode=False, encoding=None,
+                     blocksize=1048576, chunksize=100000, queue_size=4,
+                     **kwargs):
+    """Return a pipeline that reads `fpath` (local or remote, as understood
+    by `cryptic.fopen`), decrypts it if it ends with '.gpg', decompresses it
+    if it is compressed, optionally repairs its unicode, parses it into
+    chunks, and yields a `tabular.SummaryAccumulator` of the whole file.
+
+    >>> p = profile_pipeline('usr@host:/data/feed.csv.gpg', fix_unicode=True)
+    >>> summ = p.run().summary()
+    >>> p.stats()
+    """
+    from epana import compression, cryptic, scrubdub, tabular
+    p = Pipeline(cryptic.iter_blocks(fpath, blocksize), name='read',
+                 queue_size=queue_size)
+    if fpath.endswith('.gpg'):
+        p.pipe(cryptic.decrypt_blocks, name='decrypt', pwd=pwd,
+               blocksize=blocksize)
+    p.pipe(compression.decompress_blocks, name='decompress')
+    if fix_unicode:
+        p.pipe(scrubdub.repair_blocks, name='repair', encoding=encoding)
+        encoding = 'utf8'
+    p.pipe(tabular.parse_blocks, name='parse', encoding=encoding,
+           chunksize=chunksize, **kwargs)
+    return p.pipe(profile_chunks, name='profile')
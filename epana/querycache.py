@@ -0,0 +1,291 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Evan T. Phelps
+#
+# Distributed under terms of the MIT license.
+"""
+Persistent local cache of query results as Feather or Parquet files.
+
+Entries are keyed by normalized SQL, bind values, and connection identity.
+Feather entries are written uncompressed so that warm reads are memory-mapped
+instead of being copied.  Requires `pyarrow`.
+"""
+##############################################################################
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from epana.logutils import get_logger
+
+_QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def normalize_sql(sql):
+    """Lowercase and collapse whitespace outside quoted literals and
+    identifiers, and strip a trailing semicolon."""
+    parts = _QUOTED.split(sql.strip().rstrip(';').strip())
+    return ''.join(part if i % 2 else ' '.join(part.lower().split())
+                   for (i, part) in enumerate(parts))
+
+
+def connection_id(con):
+    """Return a string identifying the database behind connection `con`: a
+    SQLAlchemy engine's URL (without password), a `DbOra`'s user, host, port,
+    and SID, or else the connection's `dsn` or repr."""
+    if hasattr(con, 'url'):
+        url = con.url
+        return url.render_as_string(hide_password=True) \
+            if hasattr(url, 'render_as_string') else repr(url)
+    if hasattr(con, '_sid'):
+        return '%s@%s:%s/%s' % (con._username, con._hostname, con._port,
+                                con._sid)
+    return str(getattr(con, 'dsn', repr(con)))
+
+
+class QueryCache(object):
+    """Directory of cached query results.
+
+    Entries older than `ttl` seconds are treated as misses.  When the data
+    files exceed `max_bytes` in total, the least recently read entries are
+    evicted.  `fmt` is 'feather' (memory-mapped reads) or 'parquet'
+    (smaller files).
+    """
+
+    def __init__(self, directory, ttl=None, max_bytes=None, fmt='feather'):
+        if fmt not in ('feather', 'parquet'):
+            raise ValueError('fmt must be feather or parquet')
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.fmt = fmt
+        self._log = get_logger('querycache.py:QueryCache')
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, sql, params=None, conn_id=None):
+        ident = json.dumps([normalize_sql(sql), params, conn_id],
+                           default=str, sort_keys=True)
+        return hashlib.sha256(ident.encode('utf8')).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.' + self.fmt, base + '.json'
+
+    def get(self, sql, params=None, conn_id=None, arrow=False):
+        """Return the cached DataFrame or None on a miss.  If `arrow` is
+        True, the `pyarrow.Table` is returned as read instead, still
+        memory-mapped for feather entries."""
+        fn_data, fn_meta = self._paths(self.key(sql, params, conn_id))
+        try:
+            with open(fn_meta) as fin:
+                meta = json.load(fin)
+        except (FileNotFoundError, ValueError):
+            return None
+        if self.ttl is not None and time.time() - meta['created'] > self.ttl:
+            self._remove(fn_data, fn_meta)
+            return None
+        try:
+            if self.fmt == 'feather':
+                from pyarrow import feather
+                table = feather.read_table(fn_data, memory_map=True)
+            else:
+                from pyarrow import parquet
+                table = parquet.read_table(fn_data, memory_map=True)
+        except (FileNotFoundError, OSError):
+            self._remove(fn_data, fn_meta)
+            return None
+        os.utime(fn_meta)  # last read, for eviction
+        return table if arrow else table.to_pandas()
+
+    def put(self, df, sql, params=None, conn_id=None):
+        fn_data, fn_meta = self._paths(self.key(sql, params, conn_id))
+        tmp = '%s.%d.tmp' % (fn_data, os.getpid())
+        if self.fmt == 'feather':
+            from pyarrow import feather
+            feather.write_feather(df, tmp, compression='uncompressed')
+        else:
+            df.to_parquet(tmp)
+        self._commit(tmp, sql, params, conn_id, len(df))
+
+    def put_batches(self, batches, sql, params=None, conn_id=None):
+        """Yield the `pyarrow.RecordBatch`es of iterable `batches` while
+        writing them to the entry for `sql`, so a result is cached without
+        ever being held in memory whole.
+
+        If a batch's schema is wider than what has been written (e.g., a
+        column downcast by `db.fetch_frames` widens), the part already
+        written is rewritten with the wider schema.  The entry is stored
+        only once `batches` is exhausted; if the consumer stops early,
+        nothing is cached.  Nor is an empty result, or one whose schemas
+        cannot be unified (those batches are still yielded).
+        """
+        import pyarrow
+        fn_data, _ = self._paths(self.key(sql, params, conn_id))
+        tmp = '%s.%d.%d.tmp' % (fn_data, os.getpid(), threading.get_ident())
+        schema, writer, rows, caching = None, None, 0, True
+        try:
+            for batch in batches:
+                if caching:
+                    try:
+                        if writer is None:
+                            schema = batch.schema
+                            writer = self._writer(tmp, schema)
+                        elif not batch.schema.equals(schema):
+                            wider = pyarrow.unify_schemas(
+                                [schema, batch.schema],
+                                promote_options='permissive')
+                            if not wider.equals(schema):
+                                writer.close()
+                                writer = self._rewrite(tmp, wider)
+                                schema = wider
+                        writer.write_batch(batch.cast(schema))
+                        rows += batch.num_rows
+                    except (ValueError, TypeError, NotImplementedError) as e:
+                        self._log.debug('not caching %.80s: %s', sql, e)
+                        caching = False
+                        if writer is not None:
+                            writer.close()
+                            writer = None
+                        self._remove(tmp)
+                yield batch
+            if writer is not None:
+                writer.close()
+                writer = None
+                self._commit(tmp, sql, params, conn_id, rows)
+        finally:
+            if writer is not None:
+                writer.close()
+                self._remove(tmp)
+
+    def _writer(self, fn, schema):
+        if self.fmt == 'feather':
+            # Uncompressed Feather v2 is the Arrow IPC file format.
+            from pyarrow import ipc
+            return ipc.new_file(fn, schema)
+        from pyarrow import parquet
+        return parquet.ParquetWriter(fn, schema)
+
+    def _rewrite(self, fn, schema):
+        """Return a writer for `fn` that has rewritten the batches already
+        in it (written by `_writer` and closed) cast to `schema`."""
+        fn_old = fn + '.old'
+        os.replace(fn, fn_old)
+        try:
+            if self.fmt == 'feather':
+                import pyarrow
+                from pyarrow import ipc
+                reader = ipc.open_file(pyarrow.memory_map(fn_old))
+                old = (reader.get_batch(i)
+                       for i in range(reader.num_record_batches))
+            else:
+                from pyarrow import parquet
+                old = parquet.ParquetFile(fn_old,
+                                          memory_map=True).iter_batches()
+            writer = self._writer(fn, schema)
+            try:
+                for batch in old:
+                    writer.write_batch(batch.cast(schema))
+            except BaseException:
+                writer.close()
+                raise
+            return writer
+        finally:
+            self._remove(fn_old)
+
+    def _commit(self, tmp, sql, params, conn_id, rows):
+        fn_data, fn_meta = self._paths(self.key(sql, params, conn_id))
+        os.replace(tmp, fn_data)
+        with open(fn_meta, 'w') as fout:
+            json.dump({'sql': normalize_sql(sql), 'params': params,
+                       'conn_id': conn_id, 'created': time.time(),
+                       'rows': rows}, fout, default=str)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def fetch(self, sql, fetch, params=None, conn_id=None):
+        """Return the cached result of `sql`, or call `fetch()` for it and
+        cache the DataFrame it returns."""
+        df = self.get(sql, params, conn_id)
+        if df is not None:
+            self._log.debug('cache hit: %.80s', sql)
+            return df
+        df = fetch()
+        self.put(df, sql, params, conn_id)
+        return df
+
+    def entries(self):
+        """Return a list of (key, metadata, data bytes, last read time)."""
+        entries = []
+        for fn in os.listdir(self.directory):
+            if not fn.endswith('.json'):
+                continue
+            key = fn[:-len('.json')]
+            fn_data, fn_meta = self._paths(key)
+            try:
+                with open(fn_meta) as fin:
+                    meta = json.load(fin)
+                entries.append((key, meta, os.path.getsize(fn_data),
+                                os.path.getmtime(fn_meta)))
+            except (FileNotFoundError, ValueError):
+                continue
+        return entries
+
+    def _remove(self, *fns):
+        for fn in fns:
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, sql=None, params=None, conn_id=None):
+        """Remove the entry for `sql` (with `params` and `conn_id`) or, if
+        `sql` is None, every entry for `conn_id` or, if that is also None,
+        every entry.  Returns the number of entries removed."""
+        if sql is not None:
+            keys = [self.key(sql, params, conn_id)]
+        else:
+            keys = [key for (key, meta, _, _) in self.entries()
+                    if conn_id is None or meta.get('conn_id') == conn_id]
+        n = 0
+        for key in keys:
+            fn_data, fn_meta = self._paths(key)
+            n += os.path.exists(fn_meta)
+            self._remove(fn_data, fn_meta)
+        return n
+
+    def evict(self, max_bytes):
+        """Remove least recently read entries until the data files total no
+        more than `max_bytes`."""
+        entries = sorted(self.entries(), key=lambda e: e[3])
+        total = sum(e[2] for e in entries)
+        for (key, _, nbytes, _) in entries:
+            if total <= max_bytes:
+                break
+            self._remove(*self._paths(key))
+            total -= nbytes
+            self._log.debug('evicted %s (%d bytes)', key, nbytes)
+
+
+def test_put_batches():
+    import tempfile
+    import pyarrow
+    batches = [pyarrow.RecordBatch.from_pydict(
+        {'i': pyarrow.array(vals, type), 's': ['x'] * len(vals)})
+        for (vals, type) in [([1, 2], pyarrow.int8()),
+                             ([300], pyarrow.int16())]]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for fmt in ('feather', 'parquet'):
+            cache = QueryCache(os.path.join(tmpdir, fmt), fmt=fmt)
+            stream = cache.put_batches(iter(batches), 'select 1')
+            next(stream)
+            stream.close()
+            assert cache.get('select 1') is None
+            assert list(cache.put_batches(iter(batches), 'select 1')) == \
+                batches
+            table = cache.get('select 1', arrow=True)
+            assert table.schema.field('i').type == pyarrow.int16()
+            assert table.column('i').to_pylist() == [1, 2, 300]
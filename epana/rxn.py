@@ -1,48 +1,73 @@
 import functools
 import pickle
-import requests
 import datetime
-
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
 from epana import throttle
+from epana.lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+requests = lazy_import('requests')
+
+
+class _PickleCache(dict):
+    """Dict that fills itself from a pickle file on first `load()`, so that
+    importing a module with cached functions does not read the file."""
+
+    def __init__(self, fn):
+        super(_PickleCache, self).__init__()
+        self.fn = fn
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            try:
+                with open(self.fn, 'rb') as fin:
+                    self.update(pickle.load(fin))
+            except FileNotFoundError:
+                pass
+        return self
 
 
 def cached(func):
-    func.cache = {}
-    try:
-        func.cache = pickle.load(open('%s.cache.pickle' % func.__name__, 'rb'))
-    except FileNotFoundError:
-        pass
+    func.cache = _PickleCache('%s.cache.pickle' % func.__name__)
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         key = (args, frozenset(kwargs.items()))
+        cache = func.cache.load()
         try:
-            return func.cache[key]
+            return cache[key]
         except KeyError:
-            func.cache[key] = result = func(*args, **kwargs)
+            result = func(*args, **kwargs)
+            if result is not None:  # failed requests are retried next time
+                cache[key] = result
             return result
 
     return wrapper
 
 
-@throttle.throttle(per_sec=20)
-@cached
-def rxnorm_req(resource, **kwargs):
-    is_json = True
-    if 'rxnorm_base' not in kwargs:
-        kwargs['rxnorm_base'] = 'https://rxnav.nlm.nih.gov/REST/'
-    if 'json' in kwargs:
-        is_json = kwargs['json']
-    if is_json:
-        resource += '.json'
+# Attempts at a request that RxNav refuses with 429 or 503 (each after the
+# throttle has backed off) before `rxnorm_req` gives up.
+THROTTLED_ATTEMPTS = 5
 
-    attrs = ['%s=%s' % (attr, val) for (attr, val) in
-             kwargs.items() if attr != 'rxnorm_base']
 
-    req = kwargs['rxnorm_base'] + resource + '?%s' % ('&'.join(attrs))
+class RxNavError(Exception):
+    pass
+
+
+def _req_failed(resp):
+    # _rxnav_get returns None once all of its timeout retries are exhausted.
+    return resp is None or throttle.is_throttled_response(resp)
 
+
+@throttle.adaptive_throttle(per_sec=20, min_per_sec=2, max_per_sec=50,
+                            is_failure=_req_failed)
+def _rxnav_get(req):
+    """GET url req, retrying on timeouts, and return the raw response (so
+    that the throttle sees its status), or None if every retry failed."""
     try:
         resp = requests.get(req, timeout=(1, 1))
     except: #requests.exceptions.Timeout:
@@ -56,16 +81,59 @@ def rxnorm_req(resource, **kwargs):
             except: #requests.exceptions.Timeout:
                 try:
                     print('Timout 3. Retrying')
-                    resp = requests.get(req, timout(5,10))
+                    resp = requests.get(req, timeout=(5, 10))
                 except: #requests.exceptions.Timeout:
-                    print(kwargs)
                     return None
+    return resp
+
+
+@cached
+def rxnorm_req(resource, **kwargs):
+    """Return the decoded JSON (or, with json=False, the response) of RxNav
+    REST `resource` with query attributes kwargs, or None if the request
+    failed (timeouts, or any status other than 200).
+
+    A request refused with 429 or 503 is retried, up to THROTTLED_ATTEMPTS
+    times in all, at the rate the throttle has backed off to; if it is still
+    refused, `RxNavError` is raised."""
+    is_json = True
+    if 'rxnorm_base' not in kwargs:
+        kwargs['rxnorm_base'] = 'https://rxnav.nlm.nih.gov/REST/'
+    if 'json' in kwargs:
+        is_json = kwargs['json']
+    if is_json:
+        resource += '.json'
+
+    attrs = ['%s=%s' % (attr, val) for (attr, val) in
+             kwargs.items() if attr != 'rxnorm_base']
+
+    req = kwargs['rxnorm_base'] + resource + '?%s' % ('&'.join(attrs))
+
+    for _ in range(THROTTLED_ATTEMPTS):
+        resp = _rxnav_get(req)
+        if not throttle.is_throttled_response(resp):
+            break
+    else:
+        raise RxNavError('%s: still refused (HTTP %d) after %d attempts' %
+                         (req, resp.status_code, THROTTLED_ATTEMPTS))
+    if resp is None:
+        print(kwargs)
+        return None
+    if resp.status_code != 200:
+        return None
 
     return resp.json() if is_json else resp
 
 
+# The throttle is applied to the raw requests, but monitored from here, e.g.
+# rxnorm_req.throttle.control.stats().
+rxnorm_req.throttle = _rxnav_get.throttle
+
+
 def coerce_rxcui(rxcui):
     json = rxnorm_req('rxcui/%s/status' % rxcui)
+    if json is None:
+        return None
     status = json['rxcuiStatus']['status']
 
     if status in ('Retired', 'Unknown', 'Alien'):
@@ -78,6 +146,8 @@ def coerce_rxcui(rxcui):
 
 def get_status(rxcui):
     json = rxnorm_req('rxcui/%s/status' % rxcui)
+    if json is None:
+        return None
     status = json['rxcuiStatus']['status']
     return status
 
@@ -93,6 +163,8 @@ def get_TTY(rxcui):
     if tmp_n_get_TTY % 1000 == 0:
         print(datetime.datetime.now(), tmp_n_get_TTY, flush=True)
     json = rxnorm_req('rxcui/%s/property' % rxcui, propName='TTY')
+    if json is None:
+        return None
     cgroup = json['propConceptGroup']
     if cgroup is None:
         return ''
@@ -182,12 +254,23 @@ def get_rxcui(rxname):
     return retval
 
 
-def get_related(rxcui):
+RELATED_TTYS = ('IN', 'PIN', 'MIN', 'SCDC', 'SCDF', 'SCDG', 'SCD', 'GPCK',
+                'BN', 'SBDC', 'SBDF', 'SBDG', 'SBD', 'BPCK')
+
+
+def get_related(rxcui, ttys=RELATED_TTYS):
+    related = _fetch_related(rxcui, ttys)
+    return [] if related is None else related
+
+
+def _fetch_related(rxcui, ttys):
+    """`get_related`, but None if the request failed."""
     # https://rxnav.nlm.nih.gov/REST/rxcui/174742/related?tty=SBD+SBDF
-    ttys = 'IN+PIN+MIN+SCDC+SCDF+SCDG+SCD+GPCK+BN+SBDC+SBDF+SBDG+SBD+BPCK'
     json = rxnorm_req('rxcui/%s/related' % rxcui,
-                      tty=ttys)
+                      tty='+'.join(ttys))
     # pprint(json)
+    if json is None:
+        return None
     try:
         cgs = json['relatedGroup']['conceptGroup']
         retval = [y for y in  # (y['rxcui'], y['name']) for y in
@@ -207,6 +290,70 @@ def get_rxcuis_related(rxcui):
     return [rxcui for (rxcui, _, _) in get_related(rxcui)]
 
 
+def expand_related(seeds, ttys=RELATED_TTYS, max_depth=1, n_workers=1):
+    """Breadth-first expansion of the RxNorm relation graph from `seeds`.
+
+    Each frontier level is deduplicated against every rxcui already visited
+    before any request is issued, so shared neighbors are fetched only once
+    per expansion.  The level's requests are then issued as one batch over
+    `n_workers` threads (still subject to the `rxnorm_req` throttle).  Only
+    relations to concepts of the term types `ttys` are followed.  Expansion
+    stops after `max_depth` levels or, if `max_depth` is None, when the
+    frontier is empty (i.e., the transitive closure).
+
+    Returns an edge-list dataframe with columns `src`, `dst`, `tty`, `name`,
+    and `depth` (the level at which the edge was discovered).  See
+    `related_to_csr` for a compressed adjacency form.  Raises `RxNavError`
+    naming the rxcuis whose relations could not be fetched, rather than
+    treating them as leaves; as successful requests are cached, calling
+    again retries only those.
+    """
+    seeds = [seeds] if isinstance(seeds, str) else seeds
+    visited = set(str(rxcui) for rxcui in seeds)
+    frontier = sorted(visited)
+    ttys = tuple(ttys)
+    edges = []
+    depth = 0
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            related = list(pool.map(
+                lambda rxcui: _fetch_related(rxcui, ttys), frontier))
+            failed = [src for (src, rels) in zip(frontier, related)
+                      if rels is None]
+            if failed:
+                raise RxNavError('could not fetch relations of %d rxcuis: %s'
+                                 % (len(failed), ', '.join(failed)))
+            next_frontier = set()
+            for src, rels in zip(frontier, related):
+                for (dst, tty, name) in rels:
+                    edges.append((src, dst, tty, name, depth))
+                    if dst not in visited:
+                        visited.add(dst)
+                        next_frontier.add(dst)
+            frontier = sorted(next_frontier)
+    return pd.DataFrame(edges, columns=['src', 'dst', 'tty', 'name', 'depth'])
+
+
+def related_to_csr(edges):
+    """Convert an edge-list dataframe from `expand_related` to CSR arrays.
+
+    Returns a tuple `(nodes, indptr, indices)`: `nodes` is the sorted array of
+    distinct rxcuis, and the neighbors of `nodes[i]` are
+    `nodes[indices[indptr[i]:indptr[i + 1]]]`.
+    """
+    n_edges = len(edges)
+    nodes, codes = np.unique(
+        np.concatenate([edges['src'].values.astype(str),
+                        edges['dst'].values.astype(str)]),
+        return_inverse=True)
+    src, dst = codes[:n_edges], codes[n_edges:]
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=len(nodes)), out=indptr[1:])
+    return nodes, indptr, dst[order]
+
+
 def get_top_result(results):
     if results is None:
         return None
@@ -220,3 +367,47 @@ def get_top_result(results):
 
 def get_approx_matches(desc):
     return rxnorm_req('approximateTerm', term=desc, maxEntries=4, option=1)
+
+
+def test_rxnorm_req_retries_after_backoff():
+    global requests
+    import tempfile
+
+    class _Response(object):
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+        def json(self):
+            return {'status': self.status_code}
+
+    statuses = [429, 200, 503, 503, 503, 503, 503]
+
+    class _Requests(object):
+        @staticmethod
+        def get(url, timeout=None):
+            return _Response(statuses.pop(0))
+
+    control = rxnorm_req.throttle.control
+    inner = rxnorm_req.__wrapped__
+    saved = (requests, inner.cache, control.bucket.rate, control._t_backoff)
+    with tempfile.TemporaryDirectory() as tmp:
+        requests = _Requests()
+        inner.cache = _PickleCache(tmp + '/rxnorm_req.cache.pickle')
+        control._t_backoff = None
+        rate, n_fail = control.rate, control.n_fail
+        try:
+            # The refused request is retried after the backoff.
+            assert rxnorm_req('rxcui/1/status') == {'status': 200}
+            assert control.n_fail == n_fail + 1
+            assert control.rate < rate
+            assert control.backoffs[-1]['reason'] == 'response'
+            control.bucket.rate = 1000.0
+            try:
+                rxnorm_req('rxcui/2/status')
+                assert False, 'persistent 503s must raise'
+            except RxNavError:
+                pass
+            assert not statuses and len(inner.cache) == 1
+        finally:
+            (requests, inner.cache, control.bucket.rate,
+             control._t_backoff) = saved
@@ -9,14 +9,21 @@
 Basic utilities for low-level data cleaning and characterizing.
 """
 ##############################################################################
+import codecs
 import io
 import shutil
 import string
 from collections import Counter
 
-import cchardet as chardet
+from epana.compression import open_input
+from epana.compression import rewind
+from epana.lazy import lazy_import
 
-import ftfy
+chardet = lazy_import('cchardet')
+ftfy = lazy_import('ftfy')
+
+# Bytes sampled to guess the encoding of a file.
+ENCODING_SAMPLE = 1 << 20
 
 try:
     basestring
@@ -29,16 +36,22 @@ def isstring(s):
 
 
 def head(fname, N=10):
-    with open(fname, 'rb') as fin:
+    with open_input(fname) as fin:
         return [next(fin).rstrip() for i in range(N)]
 
 
-def guess_encoding(fn):
-    """Return a guess of encoding scheme of file fn."""
-    guess = None
-    with open(fn, 'rb') as f:
-        blk = b''.join(f.readlines())
-        guess = chardet.detect(blk)['encoding']
+def guess_encoding(fn, n_bytes=None, pwd=None):
+    """Return a guess of encoding scheme of file fn, from its first n_bytes
+    bytes (after decryption with passphrase pwd and decompression) or, if
+    n_bytes is None, all of them."""
+    with open_input(fn, pwd=pwd) as f:
+        blk = f.read() if n_bytes is None else f.read(n_bytes)
+    return guess_block_encoding(blk)
+
+
+def guess_block_encoding(blk):
+    """Return a guess of encoding scheme of bytes blk."""
+    guess = chardet.detect(blk)['encoding']
     # This should NOT be required, but there seems to be a bug in
     # either chardet or the csv package.
     guess = 'ISO-8859-1' if guess == 'WINDOWS-1252' else guess
@@ -59,7 +72,7 @@ def guess_encoding(fn):
 
 def count_chars(fn, chars):
     cntrs = {ch: Counter() for ch in chars}
-    with open(fn) as fin:
+    with open_input(fn) as fin:
         for rec in fin:
             for ch, c in cntrs.items():
                 c[rec.count(ch.encode())] += 1
@@ -92,14 +105,16 @@ def get_charclass(c):
 def iterable_to_stream(iterable, buffer_size=io.DEFAULT_BUFFER_SIZE):
     """Yields read-only bytestrings.
 
-    Lets you use an iterable (e.g. a generator) that yields bytestrings as a
-    read-only input stream.  The stream implements Python 3's newer I/O API
-    (available in Python 2's io module).  For efficiency, the stream is
-    buffered.
+    Lets you use an iterable (e.g. a generator) that yields strings or
+    bytestrings as a read-only input stream (strings are encoded as UTF-8).
+    The stream implements Python 3's newer I/O API (available in Python 2's
+    io module).  For efficiency, the stream is buffered.
 
     Credit to Mechanical snail on stackoverflow.com; modified for the current
     special case requiring a byte stream.
     """
+    iterable = iter(iterable)
+
     class IterStream(io.RawIOBase):
         def __init__(self):
             self.leftover = None
@@ -110,8 +125,14 @@ def iterable_to_stream(iterable, buffer_size=io.DEFAULT_BUFFER_SIZE):
         def readinto(self, b):
             try:
                 lngth = len(b)  # We're supposed to return at most this much
-                chunk = self.leftover or next(iterable).encode('utf8')
-                output, self.leftover = chunk[:lngth], chunk[lngth:]
+                while not self.leftover:
+                    chunk = next(iterable)
+                    if not isinstance(chunk, bytes):
+                        chunk = chunk.encode('utf8')
+                    # Slices of a memoryview do not copy large chunks.
+                    self.leftover = memoryview(chunk)
+                output = self.leftover[:lngth]
+                self.leftover = self.leftover[lngth:]
                 b[:len(output)] = output
                 return len(output)
             except StopIteration:
@@ -152,14 +173,22 @@ def chunk_chrs(s):
     return (s_reduced, s_run_counts)
 
 
-def count_charclasses(fn, fix_unicode=False):
-    """Returns character class Counter for header and body of file fn"""
+def count_charclasses(fn, fix_unicode=False, pwd=None):
+    """Returns character class Counter for header and body of file fn
+    (decrypted with passphrase pwd if it ends with '.gpg').  With
+    fix_unicode, the encoding is guessed from the first `ENCODING_SAMPLE`
+    bytes, and bytes later in the file that it cannot decode are replaced
+    (see `decode_lines`)."""
     bcounts, bcountsH = None, None
 
-    with open(fn, 'rb') as fin:
+    with open_input(fn, pwd=pwd) as fin:
         if fix_unicode:
-            guess = guess_encoding(fn)
-            fin_fixed = ftfy.fix_file(fin, encoding=guess)
+            head = fin.read(ENCODING_SAMPLE)
+            guess = guess_block_encoding(head)
+            # An ASCII sample may be followed by UTF-8.
+            guess = 'utf-8' if guess in (None, 'ASCII') else guess
+            fin = rewind(fin, head)
+            fin_fixed = ftfy.fix_file(decode_lines(fin, guess))
             with iterable_to_stream(fin_fixed) as bffr:
                 bcountsH = Counter(bffr.readlines(1)[0])
                 bcounts = Counter(bffr.read())
@@ -167,26 +196,74 @@ def count_charclasses(fn, fix_unicode=False):
             bcountsH = Counter(fin.readlines(1)[0])
             bcounts = Counter(fin.read())
 
-    ccountsH = {(get_charclass(chr(k)), chr(k), k): n
-                for (k, n) in bcountsH.items()}
+    return (charclass_counts(bcountsH), charclass_counts(bcounts))
+
+
+def charclass_counts(bcounts):
+    """Return a character class Counter from a mapping of byte values to
+    counts (as from `Counter(some_bytes)`)."""
     ccounts = {(get_charclass(chr(k)), chr(k), k): n
                for (k, n) in bcounts.items()}
 
-    charclassesH = Counter()
-    for k, v in ccountsH.items():
-        charclassesH[k[0]] += v
     charclasses = Counter()
     for k, v in ccounts.items():
         charclasses[k[0]] += v
-    return (charclassesH, charclasses)
-
-
-def fix_unicode_and_copy(fn_i, fn_o):
-    """Fix unicode of file fn_i and copy to fn_o."""
-    guess = guess_encoding(fn_i)
-    if guess != 'UTF-8':
-        with open(fn_o, 'w', encoding='utf8') as fout, open(fn_i, 'rb') as fin:
-            for line in ftfy.fix_file(fin, encoding=guess):
-                fout.write(line)
-    else:
-        shutil.copyfile(fn_i, fn_o)
+    return charclasses
+
+
+def fix_unicode_and_copy(fn_i, fn_o, pwd=None):
+    """Fix unicode of file fn_i (decrypted with passphrase pwd if it ends
+    with '.gpg') and copy to fn_o.  The encoding is guessed from the first
+    `ENCODING_SAMPLE` bytes, and bytes later in the file that it cannot
+    decode are replaced (see `decode_lines`)."""
+    with open_input(fn_i, pwd=pwd) as fin:
+        head = fin.read(ENCODING_SAMPLE)
+        guess = guess_block_encoding(head)
+        fin = rewind(fin, head)
+        if guess != 'UTF-8':
+            # An ASCII sample may be followed by UTF-8.
+            encoding = 'utf-8' if guess in (None, 'ASCII') else guess
+            with open(fn_o, 'w', encoding='utf8') as fout:
+                for line in ftfy.fix_file(decode_lines(fin, encoding)):
+                    fout.write(line)
+        else:
+            with open(fn_o, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+
+
+def decode_lines(fin, encoding):
+    """Yield the lines of binary stream fin decoded from `encoding`.  As the
+    encoding is guessed from a sample, bytes it cannot decode (e.g., Latin-1
+    after an all-ASCII sample) are replaced rather than raising
+    UnicodeDecodeError, as in `repair_blocks`."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    for line in fin:
+        yield decoder.decode(line)
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def repair_blocks(blocks, encoding=None):
+    """Yield UTF-8 blocks of unicode-fixed text from an iterable of raw
+    blocks of bytes in `encoding` (guessed from the first block if None).
+
+    Like `fix_unicode_and_copy`, but streaming: blocks are cut at the last
+    line break, so ftfy always sees whole lines, and only one block is held
+    at a time.  Undecodable bytes are replaced rather than raising.
+    """
+    decoder, pending = None, ''
+    for blk in blocks:
+        if decoder is None:
+            encoding = encoding or guess_block_encoding(blk)
+            encoding = 'utf-8' if encoding in (None, 'ASCII') else encoding
+            decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        text = pending + decoder.decode(blk)
+        cut = text.rfind('\n') + 1
+        text, pending = text[:cut], text[cut:]
+        if text:
+            yield ftfy.fix_text(text).encode('utf8')
+    if decoder is not None:
+        pending += decoder.decode(b'', final=True)
+    if pending:
+        yield ftfy.fix_text(pending).encode('utf8')
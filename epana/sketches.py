@@ -0,0 +1,278 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2018 Evan T. Phelps
+#
+# Distributed under terms of the MIT license.
+"""
+Mergeable streaming sketches of column values.
+"""
+##############################################################################
+import numpy as np
+
+from epana.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+
+def normalize_values(values):
+    """Return the non-null values of an array-like as a Series of strings.
+
+    Values are compared by their string form so that the same key matches
+    across tables that typed it differently; integral floats are formatted as
+    integers for the same reason.
+    """
+    s = pd.Series(values).dropna()
+    if s.dtype.kind == 'f' and len(s) and (s == np.floor(s)).all():
+        s = s.astype(np.int64)
+    return s.astype(str).astype(object)
+
+
+def hash_values(values):
+    """Return uint64 hashes of the normalized non-null values of an
+    array-like (see `normalize_values`)."""
+    return pd.util.hash_array(normalize_values(values).values)
+
+
+def _clz64(x):
+    """Count leading zeros of each element of a uint64 array."""
+    x = x.copy()
+    n = np.zeros(len(x), dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        small = x < np.uint64(1 << (64 - shift))
+        n[small] += shift
+        x[small] <<= np.uint64(shift)
+    n[x == 0] = 64
+    return n
+
+
+class HyperLogLog(object):
+    """HyperLogLog distinct-count sketch with `2**p` registers (relative
+    standard error about `1.04 / sqrt(2**p)`)."""
+
+    def __init__(self, p=12):
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def update_hashes(self, hashes):
+        idx = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        rho = np.minimum(_clz64(hashes << np.uint64(self.p)) + 1,
+                         64 - self.p + 1).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rho)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / np.sum(2.0 ** -self.registers.astype(float))
+        n_zero = np.count_nonzero(self.registers == 0)
+        if est <= 2.5 * m and n_zero:
+            est = m * np.log(m / n_zero)  # linear counting for small sets
+        return float(est)
+
+
+class BottomK(object):
+    """Bottom-k MinHash sketch: the `k` smallest distinct value hashes.
+
+    Estimates Jaccard similarity with about `1 / sqrt(k)` error and is exact
+    for sets of fewer than `k` distinct values.
+    """
+
+    def __init__(self, k=1024):
+        self.k = k
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def update_hashes(self, hashes):
+        self.hashes = np.unique(np.concatenate([self.hashes,
+                                                hashes]))[:self.k]
+
+    def merge(self, other):
+        self.update_hashes(other.hashes)
+        return self
+
+    @property
+    def exact(self):
+        return len(self.hashes) < self.k
+
+    def jaccard(self, other):
+        union = np.unique(np.concatenate([self.hashes, other.hashes]))
+        union = union[:min(self.k, other.k)]
+        if len(union) == 0:
+            return 0.0
+        both = np.isin(union, self.hashes, assume_unique=True) & \
+            np.isin(union, other.hashes, assume_unique=True)
+        return float(np.count_nonzero(both)) / len(union)
+
+
+class ColumnSketch(object):
+    """Row and null counts plus HyperLogLog and bottom-k sketches of the
+    values of one column, built from chunks with `update`."""
+
+    def __init__(self, k=1024, p=12):
+        self.n_rows = 0
+        self.n_null = 0
+        self.hll = HyperLogLog(p)
+        self.minhash = BottomK(k)
+
+    def update(self, values):
+        hashes = hash_values(values)
+        self.n_rows += len(values)
+        self.n_null += len(values) - len(hashes)
+        self.hll.update_hashes(hashes)
+        self.minhash.update_hashes(hashes)
+        return self
+
+    def merge(self, other):
+        self.n_rows += other.n_rows
+        self.n_null += other.n_null
+        self.hll.merge(other.hll)
+        self.minhash.merge(other.minhash)
+        return self
+
+    @property
+    def n_distinct(self):
+        if self.minhash.exact:
+            return float(len(self.minhash.hashes))
+        return self.hll.estimate()
+
+    @property
+    def uniqueness(self):
+        """Estimated fraction of non-null values that are distinct."""
+        n = self.n_rows - self.n_null
+        return min(1.0, self.n_distinct / n) if n else 0.0
+
+
+def estimate_overlap(a, b):
+    """Estimate the overlap of the value sets of column sketches `a` and `b`.
+
+    Returns `(jaccard, contain_a_in_b, contain_b_in_a)`, where containment
+    is the fraction of one column's distinct values found in the other.
+    """
+    jac = a.minhash.jaccard(b.minhash)
+    n_a, n_b = a.n_distinct, b.n_distinct
+    inter = jac * (n_a + n_b) / (1 + jac)
+    return (jac, min(1.0, inter / n_a) if n_a else 0.0,
+            min(1.0, inter / n_b) if n_b else 0.0)
+
+
+class KLL(object):
+    """KLL streaming quantile sketch with moment tracking.
+
+    Values are added in chunks with `update`, and sketches of separate chunks
+    or files combine with `merge`.  Quantiles returned by `quantile` are
+    within a normalized rank error of about `rank_error()` (roughly 1.3% for
+    the default `k=200`, with 99% confidence), using memory proportional to
+    `k` regardless of the number of values.  The count, mean, standard
+    deviation, min, and max are exact.
+    """
+
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.n = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, h):
+        depth = len(self.levels) - 1 - h
+        return max(2, int(np.ceil(self.k * (2.0 / 3) ** depth)))
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                lvl = np.sort(self.levels[h])
+                odd = len(lvl) % 2
+                promoted = lvl[odd:][self._rng.integers(2)::2]
+                self.levels[h] = lvl[:odd]
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1],
+                                                     promoted])
+            h += 1
+
+    def _update_moments(self, n, mean, m2, lo, hi):
+        total = self.n + n
+        delta = mean - self._mean
+        self._m2 += m2 + delta ** 2 * self.n * n / total
+        self._mean += delta * n / total
+        self.n = total
+        self.min = min(self.min, lo)
+        self.max = max(self.max, hi)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        mean = values.mean()
+        self._update_moments(len(values), mean,
+                             ((values - mean) ** 2).sum(),
+                             values.min(), values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        self._update_moments(other.n, other._mean, other._m2,
+                             other.min, other.max)
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, lvl in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], lvl])
+        self._compress()
+        return self
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def std(self):
+        """Population standard deviation (as in `scipy.stats.zscore`)."""
+        return np.sqrt(self._m2 / self.n) if self.n else np.nan
+
+    def rank_error(self):
+        """Approximate normalized rank error bound of `quantile` (99%
+        confidence), after the KLL error analysis."""
+        return 2.296 / self.k ** 0.9723
+
+    def quantile(self, q):
+        """Return approximate quantiles for probabilities q in [0, 1]."""
+        q = np.asarray(q, dtype=float)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(lvl), 2.0 ** h)
+                                  for (h, lvl) in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items, cumw = items[order], np.cumsum(weights[order])
+        idx = np.searchsorted(cumw, q * cumw[-1], side='left')
+        result = items[np.clip(idx, 0, len(items) - 1)]
+        result = np.where(q <= 0, self.min, np.where(q >= 1, self.max,
+                                                     result))
+        return result if result.ndim else result.item()
+
+
+def kll_from(source, k=200, column=None, chunksize=1000000, seed=None):
+    """Build a `KLL` sketch from an array, an iterable of arrays or Series
+    (e.g., file chunks), or a CSV file path (reading only `column`, one
+    chunk at a time)."""
+    sketch = KLL(k=k, seed=seed)
+    if isinstance(source, str):
+        for chunk in pd.read_csv(source, usecols=[column],
+                                 chunksize=chunksize):
+            sketch.update(pd.to_numeric(chunk[column], errors='coerce'))
+    elif isinstance(source, (np.ndarray, pd.Series, list)):
+        sketch.update(source)
+    else:
+        for chunk in source:
+            sketch.update(chunk)
+    return sketch
@@ -9,58 +9,130 @@
 Common statistical operations, functions, and utilities.
 """
 ##############################################################################
-import math
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import scipy.stats
-from matplotlib import pyplot as plt
+
+from epana.lazy import lazy_import
+from epana.sketches import KLL
+from epana.sketches import kll_from
+
+pd = lazy_import('pandas')
+scipy = lazy_import('scipy.stats')
+plt = lazy_import('matplotlib.pyplot', leaf=True)
+
+
+def _result(x, *args):
+    """Return x as a Python scalar if every argument is scalar, otherwise as
+    an array; inputs broadcast against each other like NumPy ufuncs."""
+    if all(np.ndim(arg) == 0 for arg in args):
+        return x.item() if isinstance(x, np.ndarray) or \
+            isinstance(x, np.generic) else x
+    return x
+
+
+def _alpha(alpha, one_tailed):
+    return np.where(one_tailed, alpha, np.divide(alpha, 2))
 
 
 def get_sample_size(alpha, beta, diff_numstds=3, one_tailed=False):
     """Calculate the sample size required to achieve Type I and Type II error
     levels, alpha and beta, for given difference in standardized means.
-    Assumes equal-variance normal distributions.
+    Assumes equal-variance normal distributions.  Arguments may be arrays.
     """
-    a = alpha if one_tailed else alpha / 2
-    z_alpha = scipy.stats.norm.ppf(1 - a)
-    z_beta = scipy.stats.norm.ppf(1 - beta)
+    a = _alpha(alpha, one_tailed)
+    z_alpha = scipy.stats.norm.isf(a)
+    z_beta = scipy.stats.norm.isf(beta)
 
-    return math.ceil(((z_alpha + z_beta) / diff_numstds)**2)
+    n = np.ceil(((z_alpha + z_beta) / diff_numstds)**2).astype(np.int64)
+    return _result(n, alpha, beta, diff_numstds, one_tailed)
 
 
 def get_effect_size(std, N, alpha, beta, one_tailed=False):
     """Calculate the raw effect size detectable assuming Type I and II error
-    levels of alpha and beta.
+    levels of alpha and beta.  Arguments may be arrays.
     """
-    a = alpha if one_tailed else alpha / 2
+    a = _alpha(alpha, one_tailed)
     z_alpha = scipy.stats.norm.ppf(a)
     z_beta = scipy.stats.norm.ppf(beta)
 
-    return (std * (z_alpha + z_beta)) / math.sqrt(N)
+    es = (std * (z_alpha + z_beta)) / np.sqrt(N)
+    return _result(es, std, N, alpha, beta, one_tailed)
 
 
 def get_power(std, N, alpha, effect_size, one_tailed=False):
     """Calculate the probability of detecting an effect when the alternative
     hypothesis is true, given N samples, a significance level alpha, and a raw
-    effect size effect_size.
+    effect size effect_size.  Arguments may be arrays.
     """
-    a = alpha if one_tailed else alpha / 2
-    z_alpha = scipy.stats.norm.ppf(1 - a)
-    se = std / math.sqrt(N)
+    a = _alpha(alpha, one_tailed)
+    z_alpha = scipy.stats.norm.isf(a)
+    se = std / np.sqrt(N)
     crit = z_alpha * se
 
-    return scipy.stats.norm.sf((crit - effect_size) / se)
+    power = scipy.stats.norm.sf((crit - effect_size) / se)
+    return _result(power, std, N, alpha, effect_size, one_tailed)
 
 
 def binom_test_from_stats(p, N, p0, one_tailed=False):
     """Test of proportion from sample statistic.  For testing sample data
-    directly see scipy.stats.binom_test.
+    directly see scipy.stats.binom_test.  Arguments may be arrays.
     """
-    zscore = (p - p0) / math.sqrt(p0 * (1 - p0) / N)
+    zscore = (p - p0) / np.sqrt(p0 * (1 - p0) / N)
     pscore = scipy.stats.norm.sf(zscore)
-    pscore = pscore if one_tailed else 2 * pscore
+    pscore = np.where(one_tailed, pscore, 2 * pscore)
+
+    return (_result(zscore, p, N, p0, one_tailed),
+            _result(pscore, p, N, p0, one_tailed))
+
+
+_GRID_FUNCS = {'sample_size': get_sample_size,
+               'effect_size': get_effect_size,
+               'power': get_power}
+
+
+def solve_grid(solve, **params):
+    """Evaluate `get_<solve>` (`sample_size`, `effect_size`, or `power`) over
+    the full grid of the given parameter values in one vectorized call.
+
+    Each keyword argument is a scalar or 1-D array of values for the
+    parameter of that name.  Returns a dataframe with one row per grid point,
+    a column per parameter, and a column `solve` with the result.
+    """
+    names = list(params)
+    values = [np.atleast_1d(params[name]) for name in names]
+    mesh = np.ix_(*values)
+    result = _GRID_FUNCS[solve](**dict(zip(names, mesh)))
+    shape = [len(v) for v in values]
+    cols = {name: np.broadcast_to(m, shape).ravel()
+            for (name, m) in zip(names, mesh)}
+    cols[solve] = np.broadcast_to(result, shape).ravel()
+    return pd.DataFrame(cols)
+
 
-    return (zscore, pscore)
+def measure_grid(n_side=100):
+    """Time `solve_grid` for power on an `n_side**3` grid of N, effect size,
+    and alpha against the equivalent loop of scalar `get_power` calls (run on
+    a 1000-point subset and extrapolated).  Returns a dict of seconds and the
+    speedup."""
+    Ns = np.linspace(10, 10000, n_side)
+    effects = np.linspace(0.01, 1, n_side)
+    alphas = np.linspace(0.001, 0.1, n_side)
+    t0 = time.perf_counter()
+    solve_grid('power', std=1.0, N=Ns, effect_size=effects, alpha=alphas)
+    t_vec = time.perf_counter() - t0
+
+    n_points = n_side ** 3
+    sample = list(itertools.islice(
+        itertools.product(Ns, effects, alphas), 1000))
+    t0 = time.perf_counter()
+    for (N, es, alpha) in sample:
+        get_power(1.0, N, alpha, es)
+    t_loop = (time.perf_counter() - t0) * n_points / len(sample)
+    return {'points': n_points, 'vectorized_secs': t_vec,
+            'scalar_loop_secs': t_loop, 'speedup': t_loop / t_vec}
 
 
 def zz(X, Y, npoints=10, plot=None):
@@ -81,3 +153,144 @@ def xVnorm(X, plot=None):
     if plot:
         plot.grid()
     return retval
+
+
+def _as_sketch(X, k):
+    return X if isinstance(X, KLL) else kll_from(X, k=k)
+
+
+def zz_sketch(X, Y, npoints=10, plot=None, k=200):
+    """Like `zz` but from streaming quantile sketches, for samples too large
+    to sort.
+
+    `X` and `Y` may be `sketches.KLL` sketches or anything `sketches.kll_from`
+    accepts (arrays, iterables of chunks, or file paths).  Returns the z-scored
+    quantiles of each sample at the `zz` cutoffs, plus the rank error bound of
+    the coarser sketch: each z-quantile lies between the exact z-quantiles at
+    `cutoff - 100 * err` and `cutoff + 100 * err` percent.
+    """
+    X, Y = _as_sketch(X, k), _as_sketch(Y, k)
+    lo, hi, stepsize = 0, 100.1, 100 / npoints
+    cutoffs = np.array([p for p in np.arange(lo, hi, stepsize) if p <= 100])
+    zs_by_quantile = [(sk.quantile(cutoffs / 100) - sk.mean) / sk.std
+                      for sk in [X, Y]]
+    if plot:
+        plt.plot(*zs_by_quantile, 'bo')
+        x45 = np.linspace(*plt.xlim())
+        plt.plot(x45, x45, 'r--')
+        plt.grid()
+    return zs_by_quantile, max(X.rank_error(), Y.rank_error())
+
+
+def xVnorm_sketch(X, npoints=100, plot=None, k=200):
+    """Like `xVnorm` but from a streaming quantile sketch of `X` (see
+    `zz_sketch`), evaluated at `npoints` Filliben plotting positions instead
+    of at every observation.
+
+    Returns `((osm, osr), (slope, intercept, r), err)`: the theoretical normal
+    quantiles, the approximate ordered values, the least-squares fit as in
+    `scipy.stats.probplot`, and the rank error bound of the sketch.
+    """
+    sk = _as_sketch(X, k)
+    i = np.arange(1, npoints + 1)
+    pos = (i - 0.3175) / (npoints + 0.365)
+    pos[0], pos[-1] = 1 - 0.5 ** (1.0 / npoints), 0.5 ** (1.0 / npoints)
+    osm = scipy.stats.norm.ppf(pos)
+    osr = sk.quantile(pos)
+    slope, intercept, r, _, _ = scipy.stats.linregress(osm, osr)
+    if plot:
+        plot.plot(osm, osr, 'bo')
+        plot.plot(osm, slope * osm + intercept, 'r-')
+        plot.grid()
+    return (osm, osr), (slope, intercept, r), sk.rank_error()
+
+
+##############################################################################
+# Resampling (bootstrap and permutation tests).
+
+_resample_data = None
+
+
+def _init_resample(data):
+    global _resample_data
+    _resample_data = data
+
+
+def _mean_diff(a, b, axis=-1):
+    return np.mean(a, axis=axis) - np.mean(b, axis=axis)
+
+
+def _resample_block(task):
+    """Compute the statistic for one block of resamples of `_resample_data`
+    with the block's own seed sequence."""
+    kind, statistic, n_block, seed_seq = task
+    rng = np.random.default_rng(seed_seq)
+    if kind == 'bootstrap':
+        x = _resample_data
+        idx = rng.integers(0, len(x), size=(n_block, len(x)))
+        return statistic(x[idx], axis=-1)
+    x, y = _resample_data
+    pooled = np.concatenate([x, y])
+    idx = rng.permuted(np.broadcast_to(np.arange(len(pooled)),
+                                       (n_block, len(pooled))), axis=1)
+    resampled = pooled[idx]
+    return statistic(resampled[:, :len(x)], resampled[:, len(x):], axis=-1)
+
+
+def _resample(kind, data, statistic, n_resamples, n_obs, seed, n_jobs,
+              max_bytes):
+    """Run `n_resamples` resamples in blocks of index matrices of at most
+    `max_bytes` each.  Every block gets its own child of `SeedSequence(seed)`,
+    so results depend only on the seed, not on `n_jobs`."""
+    block = max(1, min(n_resamples, max_bytes // (8 * max(1, n_obs))))
+    sizes = [block] * (n_resamples // block) + \
+        ([n_resamples % block] if n_resamples % block else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(kind, statistic, n, ss) for (n, ss) in zip(sizes, seeds)]
+    if n_jobs == 1:
+        _init_resample(data)
+        try:
+            return np.concatenate([_resample_block(task) for task in tasks])
+        finally:
+            _init_resample(None)
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_resample,
+                             initargs=(data,)) as executor:
+        return np.concatenate(list(executor.map(_resample_block, tasks)))
+
+
+def bootstrap_ci(x, statistic=np.mean, n_resamples=10000, ci=0.95, seed=None,
+                 n_jobs=1, max_bytes=2**26):
+    """Percentile bootstrap confidence interval of `statistic` of sample x.
+
+    `statistic` must reduce along `axis=-1` (e.g., `np.mean`, `np.median`)
+    and, if `n_jobs > 1`, be picklable (a module-level function).  Resamples
+    are drawn as index matrices of at most `max_bytes` per block, spread
+    across `n_jobs` processes, with reproducible results for a given `seed`.
+    Returns `(estimate, low, high)`.
+    """
+    x = np.asarray(x)
+    dist = _resample('bootstrap', x, statistic, n_resamples, len(x), seed,
+                     n_jobs, max_bytes)
+    tail = 100 * (1 - ci) / 2
+    low, high = np.percentile(dist, [tail, 100 - tail])
+    return (statistic(x, axis=-1), low, high)
+
+
+def permutation_test(x, y, statistic=_mean_diff, n_resamples=10000,
+                     one_tailed=False, seed=None, n_jobs=1, max_bytes=2**26):
+    """Permutation test of the difference between samples x and y.
+
+    `statistic(a, b, axis=-1)` compares two samples (by default the
+    difference in means).  If `one_tailed`, the alternative is that it is
+    greater for x than for y.  See `bootstrap_ci` for the remaining
+    arguments.  Returns `(observed, pvalue)`.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    observed = statistic(x, y, axis=-1)
+    dist = _resample('permutation', (x, y), statistic, n_resamples,
+                     len(x) + len(y), seed, n_jobs, max_bytes)
+    if one_tailed:
+        n_extreme = np.count_nonzero(dist >= observed)
+    else:
+        n_extreme = np.count_nonzero(np.abs(dist) >= np.abs(observed))
+    return (observed, (n_extreme + 1) / (n_resamples + 1))
@@ -9,71 +9,246 @@
 Basic tabular-data utilities for preliminary data charactization.
 """
 ##############################################################################
+import builtins
+import codecs
+import contextlib
 import csv
+import functools
+import io
+import itertools
 import os
 
-import ftfy
-
-import numpy as np
-
-import pandas as pd
-
+from epana.compression import open_input
+from epana.compression import rewind
+from epana.lazy import lazy_import
 from epana.logutils import get_logger
+from epana.logutils import logged
 from epana.logutils import mstime
+from epana.logutils import span
 
-from epana.scrubdub import guess_encoding
+from epana.querycache import connection_id
+
+from epana.scrubdub import ENCODING_SAMPLE
+from epana.scrubdub import decode_lines
+from epana.scrubdub import get_charclass
+from epana.scrubdub import guess_block_encoding
 from epana.scrubdub import isstring
 from epana.scrubdub import iterable_to_stream
 
+from epana.sketches import HyperLogLog
+from epana.sketches import hash_values
+
+ftfy = lazy_import('ftfy')
+np = lazy_import('numpy')
+pa = lazy_import('pyarrow')
+pc = lazy_import('pyarrow.compute', leaf=True)
+pd = lazy_import('pandas')
+
+# Column storage for raw (all-string) loads: pandas' default for dtype=str,
+# Python objects, Arrow strings, or dictionary-encoded Arrow strings.
+RAW_STORAGES = (None, 'object', 'arrow', 'dictionary')
+
+# Lines of the first input file sampled by `plan_load`.
+PLAN_ROWS = 10000
+
 
 def guess_dialect(fn):
     """Return CSV dialect assumed by csv package"""
     dialect = None
     # , encoding=guess_encoding(fn), newline='') as fin:
-    with open(fn, 'r') as fin:
-        dialect = csv.Sniffer().sniff(fin.read(4096 * 10))
+    with open_input(fn) as fin:
+        sample = fin.read(4096 * 10).decode('utf8', errors='replace')
+    dialect = csv.Sniffer().sniff(sample)
     return dialect
 
 
-def get_df_raw(fn, fix_unicode=False):
+@logged
+def get_df_raw(fn, fix_unicode=False, storage=None, mem_budget=None,
+               pwd=None):
     """Return a dataframe of character string types.
 
     Useful if you don't want to let Pandas automatically determine the data
     types, for example, in first steps of input data evaluation.
 
+    `storage` is one of `RAW_STORAGES`.  'arrow' keeps each column as an
+    Arrow string array, and 'dictionary' as a dictionary-encoded one (best
+    for low-cardinality columns), either of which is several times smaller
+    than Python string objects.  The summary functions (`n_null`, `vlen`,
+    `n_distinct`, `freq`, etc.) work on them directly.
+
+    `mem_budget` (bytes, or 'auto' for half of `available_memory()`) caps
+    the projected size of the result (see `plan_load`).  If the requested
+    storage would not fit, a more compact one is used; if none fits, an
+    iterator of dataframe chunks is returned instead of a dataframe (which
+    `get_summary` and `multi_freq` accept).
+
+    fn is decrypted with passphrase `pwd` if it ends with '.gpg' (see
+    `compression.open_input`).  The encoding is guessed from the first
+    `scrubdub.ENCODING_SAMPLE` bytes.
+
     WARNING: using fix_unicode=True is very slow!  Might be better to fix and
     copy (see fix_unicode_and_copy) the file for future use, if required.
     In my experieence, it is relatively rare to have to do this anyway.
     """
     LOGNAME = '%s:%s' % (os.path.basename(__file__), 'get_df_raw()')
     log = get_logger(LOGNAME)
-    guess = guess_encoding(fn)
-    with open(fn, 'rb') as fin:
+    stats = {}
+    with contextlib.ExitStack() as stack:
+        # One stream serves the encoding guess, the load plan, and the
+        # parse, so encrypted input is decrypted only once.
+        fin = stack.enter_context(open_input(fn, pwd=pwd, stats=stats))
+        with span('guess_encoding') as sp:
+            lines = b''.join(itertools.islice(fin, PLAN_ROWS + 1)) \
+                if mem_budget is not None else b''
+            head = lines + fin.read(builtins.max(
+                0, ENCODING_SAMPLE - len(lines)))
+            guess = guess_block_encoding(head)
+            # An ASCII sample may be followed by UTF-8.
+            guess = 'utf-8' if guess in (None, 'ASCII') else guess
+            sp.add(bytes=len(head))
+        plan = None
+        if mem_budget is not None:
+            plan = _plan_load([fn], lines, stats, functools.partial(
+                pd.read_csv, encoding=guess, dtype=_raw_dtype(storage)),
+                storage, mem_budget, compact=True)
+            storage = plan['storage']
+        fin = rewind(fin, head)
+        if plan is not None and plan['chunksize']:
+            return _raw_chunks(stack.pop_all(), fin, guess, fix_unicode,
+                               storage, plan['chunksize'])
         if fix_unicode:
             log.warn('! Fixing unicode: This may take some time!')
             log.info('creating unicode generator')
-            fin_fixed = ftfy.fix_file(fin, encoding=guess)
+            fin_fixed = ftfy.fix_file(decode_lines(fin, guess))
             log.info('done creating unicode generator')
-            with iterable_to_stream(fin_fixed) as bffr:
+            with iterable_to_stream(fin_fixed) as bffr, \
+                    span('parse_fixed') as sp:
                 t0 = mstime()
-                df = pd.read_csv(bffr, encoding='utf8', dtype=str)
+                df = _read_raw(bffr, 'utf8', storage)
                 t1 = mstime()
+                sp.add(rows=len(df), bytes=_bytes_read(fin, stats))
                 log.info('created dataframe from fixed unicode of ' +
                          '%s: %d x %d (%d msecs)' % (fn,
                                                      len(df),
                                                      len(df.columns),
                                                      t1 - t0))
-                return df
         else:
-            t0 = mstime()
-            df = pd.read_csv(fin, encoding=guess, dtype=str)
-            t1 = mstime()
+            with span('parse') as sp:
+                t0 = mstime()
+                df = _read_raw(fin, guess, storage)
+                t1 = mstime()
+                sp.add(rows=len(df), bytes=_bytes_read(fin, stats))
             log.info('created dataframe ' +
                      '%s: %d x %d (%d msecs)' % (fn,
                                                  len(df),
                                                  len(df.columns),
                                                  t1 - t0))
-            return df
+    if plan is not None:
+        _log_footprint(log, fn, plan, df)
+    return df
+
+
+def _raw_frames(fin, encoding, storage, chunksize):
+    """Yield raw dataframe chunks of delimited stream fin."""
+    for chunk in pd.read_csv(fin, encoding=encoding, chunksize=chunksize,
+                             dtype=_raw_dtype(storage)):
+        yield to_arrow_strings(chunk, dictionary=True) \
+            if storage == 'dictionary' else chunk
+
+
+def _raw_chunks(stack, fin, encoding, fix_unicode, storage, chunksize):
+    """Yield raw dataframe chunks of stream fin, as `get_df_raw` would load
+    it, and then close `stack` (which holds fin open)."""
+    with stack:
+        if fix_unicode:
+            fin = iterable_to_stream(ftfy.fix_file(
+                decode_lines(fin, encoding)))
+            encoding = 'utf8'
+        for chunk in _raw_frames(fin, encoding, storage, chunksize):
+            yield chunk
+
+
+def _read_raw(fin, encoding, storage):
+    """Return the raw dataframe of delimited stream fin.  Dictionary storage
+    is encoded chunk by chunk, so the whole file is never held as plain
+    strings."""
+    if storage != 'dictionary':
+        return pd.read_csv(fin, encoding=encoding, dtype=_raw_dtype(storage))
+    return pd.concat(list(_raw_frames(fin, encoding, storage, 100000)),
+                     ignore_index=True)
+
+
+def _bytes_read(fin, stats):
+    """Return the number of (decrypted and decompressed) bytes read so far
+    from stream fin, opened by `open_input` with `stats`."""
+    return fin.tell() if fin.seekable() else stats['bytes']
+
+
+def _raw_dtype(storage):
+    if storage not in RAW_STORAGES:
+        raise ValueError('storage must be one of %s' % (RAW_STORAGES,))
+    return {None: str, 'object': object}.get(storage,
+                                             pd.StringDtype('pyarrow'))
+
+
+def to_arrow_strings(df, dictionary=False):
+    """Return a copy of raw dataframe df with its string columns stored as
+    Arrow string arrays or, if dictionary is True, as dictionary-encoded
+    Arrow arrays.  Other columns are left as they are."""
+    out = df.copy()
+    for col in df.columns:
+        s = df[col]
+        if not (s.dtype == object or isinstance(s.dtype, pd.StringDtype)):
+            continue
+        try:
+            s = s.astype(pd.StringDtype('pyarrow'))
+        except (TypeError, ValueError, pa.ArrowException):
+            continue
+        if dictionary:
+            arr = pc.dictionary_encode(s.array.__arrow_array__())
+            s = pd.Series(pd.arrays.ArrowExtensionArray(arr), index=s.index,
+                          name=col)
+        out[col] = s
+    return out
+
+
+def _arrow(s):
+    """Return the pyarrow ChunkedArray behind an Arrow-backed string Series,
+    or None for any other Series."""
+    dtype = s.dtype
+    if isinstance(dtype, pd.StringDtype):
+        return s.array.__arrow_array__() if dtype.storage == 'pyarrow' \
+            else None
+    if isinstance(dtype, pd.ArrowDtype):
+        typ = dtype.pyarrow_dtype
+        typ = typ.value_type if pa.types.is_dictionary(typ) else typ
+        if pa.types.is_string(typ) or pa.types.is_large_string(typ):
+            return s.array.__arrow_array__()
+    return None
+
+
+def _arrow_map(arr, func):
+    """Apply elementwise compute function func to ChunkedArray arr, once
+    per dictionary entry for dictionary-encoded chunks."""
+    chunks = [func(c.dictionary).take(c.indices)
+              if pa.types.is_dictionary(c.type) else func(c)
+              for c in arr.chunks]
+    return pa.chunked_array(chunks) if chunks else \
+        pa.chunked_array([func(pa.array([], pa.string()))])
+
+
+def _arrow_counts(arr):
+    """Return the distinct non-null values of ChunkedArray arr and their
+    counts."""
+    if pa.types.is_dictionary(arr.type):
+        arr = arr.unify_dictionaries()
+    vc = pc.value_counts(arr)
+    values, counts = vc.field(0), vc.field(1)
+    valid = values.is_valid()
+    values, counts = values.filter(valid), counts.filter(valid)
+    if pa.types.is_dictionary(values.type):
+        values = values.dictionary_decode()
+    return values, counts
 
 
 def print_full(x):
@@ -85,6 +260,11 @@ def print_full(x):
         print(x)
 
 def n_null(s):
+    arr = _arrow(s)
+    if arr is not None:
+        blank = _arrow_map(arr, lambda a: pc.equal(
+            pc.utf8_length(pc.utf8_rtrim_whitespace(a)), 0))
+        return arr.null_count + (pc.sum(blank).as_py() or 0)
     return (s.isnull() | (s.astype(str).str.rstrip().str.len() == 0)).sum()
 
 
@@ -93,50 +273,82 @@ def n_not_null(s):
 
 
 def n_zero(s):
+    if _arrow(s) is not None:
+        return 0  # strings never equal 0
     return sum(s == 0)
 
 
 def n_most_common(s):
+    arr = _arrow(s)
+    if arr is not None:
+        return int(pc.max(_arrow_counts(arr)[1]).as_py())
     return int(s.value_counts().max())
 
 
 def most_common(s):
     if s is None:
         return None
+    arr = _arrow(s)
+    if arr is not None:
+        values, counts = _arrow_counts(arr)
+        return values[pc.index(counts, pc.max(counts)).as_py()].as_py() \
+            if len(counts) else None
     else:
         return s.value_counts().idxmax()
 
 
 def n_distinct(s):
+    arr = _arrow(s)
+    if arr is not None:
+        return len(_arrow_counts(arr)[0])
     return len(s.value_counts())
 
 
 def vlen(s):
+    arr = _arrow(s)
+    if arr is not None:
+        # Nulls count as 'nan', as with s.apply(str) on object storage.
+        lens = _arrow_map(arr, pc.utf8_length).fill_null(3)
+        lo_hi = pc.min_max(lens)
+        return (pc.mean(lens).as_py(), pc.count_distinct(lens).as_py(),
+                lo_hi['min'].as_py(), lo_hi['max'].as_py())
     s1 = s.apply(str)
     lens = s1.str.len()
     return (np.mean(lens), len(lens.value_counts()), min(lens), max(lens))
 
 def min(s):
+    arr = _arrow(s)
+    if arr is not None:
+        return pc.min_max(_arrow_counts(arr)[0])['min'].as_py()
     return s.dropna().min()
 
 def max(s):
+    arr = _arrow(s)
+    if arr is not None:
+        return pc.min_max(_arrow_counts(arr)[0])['max'].as_py()
     return s.dropna().max()
 
+@logged
 def get_summary(data, navals=None):
         LOGNAME = '%s:%s' % (os.path.basename(__file__), 'get_summary()')
         log = get_logger(LOGNAME)
         df = data
+        if not isinstance(df, pd.DataFrame) and not isstring(df) and \
+                not hasattr(df, 'read'):  # iterable of dataframe chunks
+            log.debug('generating summary of chunks')
+            acc = SummaryAccumulator()
+            for chunk in df:
+                acc.update(chunk)
+            return acc.summary()
         if not isinstance(df, pd.DataFrame):
             fn_bn = os.path.basename(data)
-            log.debug('reading %s' % fn_bn)
+            log.debug('reading %s', fn_bn)
 
             t0 = mstime()
             df = pd.read_csv(data, na_values=navals, low_memory=False)
 
-            log.debug('done reading %s: %d x %d (%d msecs)' % (fn_bn,
-                                                               len(df),
-                                                               len(df.columns),
-                                                               mstime() - t0))
+            log.debug('done reading %s: %d x %d (%d msecs)', fn_bn,
+                      len(df), len(df.columns), mstime() - t0)
 
         aggs = [n_not_null, n_null, n_zero, n_distinct, vlen,
                 min, max, most_common, n_most_common]
@@ -147,8 +359,7 @@ def get_summary(data, navals=None):
         df_summ = df.apply(aggs).T
         df_summ = df_summ[[c for c in cols if c in df_summ.columns]]
         df_summ['dtype'] = df.dtypes
-        log.debug('done generating summary: (%d msecs)' %
-                  (mstime() - t0))
+        log.debug('done generating summary: (%d msecs)', mstime() - t0)
 
         return df_summ
     # df = data
@@ -226,28 +437,527 @@ def get_summary(data, navals=None):
 #     return df_summ
 
 
+class _ColumnSummary(object):
+    """Running `get_summary` statistics of one column."""
+
+    def __init__(self):
+        self.n = 0
+        self.n_null = 0
+        self.n_zero = 0
+        self.counts = pd.Series(dtype='int64')
+        self.lens = pd.Series(dtype='int64')
+        self.min = None
+        self.max = None
+        self.dtype = None
+        self.hll = None
+
+    @staticmethod
+    def _add(a, b):
+        return a.add(b, fill_value=0).astype('int64')
+
+    @staticmethod
+    def _extreme(func, a, b):
+        vals = [v for v in (a, b) if v is not None]
+        if not vals:
+            return None
+        try:
+            return func(vals)
+        except TypeError:
+            return func(vals, key=str)
+
+    def _truncate(self, max_distinct):
+        if len(self.counts) > max_distinct:
+            if self.hll is None:
+                self.hll = HyperLogLog()
+                self.hll.update_hashes(hash_values(self.counts.index))
+            self.counts = self.counts.nlargest(max_distinct)
+
+    def update(self, s, max_distinct):
+        self.n += len(s)
+        self.n_null += n_null(s)
+        self.n_zero += n_zero(s)
+        if self.hll is not None:
+            self.hll.update_hashes(hash_values(s))
+        self.counts = self._add(self.counts,
+                                _decode_dictionary_index(s.value_counts()))
+        arr = _arrow(s)
+        lens = s.apply(str).str.len() if arr is None else pd.Series(
+            _arrow_map(arr, pc.utf8_length).fill_null(3).to_numpy())
+        self.lens = self._add(self.lens, lens.value_counts())
+        if s.notna().any():
+            self.min = self._extreme(builtins.min, self.min, min(s))
+            self.max = self._extreme(builtins.max, self.max, max(s))
+        self.dtype = s.dtype if self.dtype in (None, s.dtype) else \
+            np.dtype(object)
+        self._truncate(max_distinct)
+
+    def merge(self, other, max_distinct):
+        self.n += other.n
+        self.n_null += other.n_null
+        self.n_zero += other.n_zero
+        if self.hll is not None or other.hll is not None:
+            for summ in (self, other):
+                if summ.hll is None:
+                    summ.hll = HyperLogLog()
+                    summ.hll.update_hashes(hash_values(summ.counts.index))
+            self.hll.merge(other.hll)
+        self.counts = self._add(self.counts, other.counts)
+        self.lens = self._add(self.lens, other.lens)
+        self.min = self._extreme(builtins.min, self.min, other.min)
+        self.max = self._extreme(builtins.max, self.max, other.max)
+        if other.dtype is not None:
+            self.dtype = other.dtype if self.dtype in (None, other.dtype) \
+                else np.dtype(object)
+        self._truncate(max_distinct)
+
+    def row(self):
+        lens = self.lens
+        n_lens = lens.sum()
+        vlen = ((lens.index.values * lens.values).sum() / n_lens
+                if n_lens else np.nan, len(lens),
+                lens.index.min() if n_lens else np.nan,
+                lens.index.max() if n_lens else np.nan)
+        n_distinct = len(self.counts) if self.hll is None else \
+            int(round(self.hll.estimate()))
+        return {'n_not_null': self.n - self.n_null, 'n_null': self.n_null,
+                'n_zero': self.n_zero, 'n_distinct': n_distinct,
+                'vlen': vlen, 'min': self.min, 'max': self.max,
+                'most_common': self.counts.idxmax() if len(self.counts)
+                else None,
+                'n_most_common': int(self.counts.max()) if len(self.counts)
+                else np.nan,
+                'dtype': self.dtype}
+
+
+class SummaryAccumulator(object):
+    """Mergeable `get_summary` over dataframe chunks.
+
+    Feed chunks (e.g., from `pd.read_csv(..., chunksize=n)`) to `update`,
+    combine accumulators of separate pieces with `merge`, and call `summary`
+    for the table that `get_summary` returns for the concatenated chunks.
+    Value counts are exact until a column has more than `max_distinct`
+    distinct values.  From then on its `n_distinct` is a HyperLogLog
+    estimate and its most common value is taken from the `max_distinct` most
+    frequent values retained, so that memory stays bounded.
+    """
+
+    def __init__(self, max_distinct=100000):
+        self.max_distinct = max_distinct
+        self.n_rows = 0
+        self.columns = {}
+
+    def update(self, df):
+        self.n_rows += len(df)
+        for col in df.columns:
+            if col not in self.columns:
+                self.columns[col] = _ColumnSummary()
+            self.columns[col].update(df[col], self.max_distinct)
+        return self
+
+    def merge(self, other):
+        self.n_rows += other.n_rows
+        for (col, summ) in other.columns.items():
+            if col not in self.columns:
+                self.columns[col] = _ColumnSummary()
+            self.columns[col].merge(summ, self.max_distinct)
+        return self
+
+    def summary(self):
+        return pd.DataFrame([summ.row() for summ in self.columns.values()],
+                            index=list(self.columns))
+
+
+def parse_blocks(blocks, encoding=None, chunksize=100000, **kwargs):
+    """Yield dataframe chunks of up to `chunksize` rows parsed from an
+    iterable of blocks of CSV bytes (see `scrubdub.repair_blocks` and
+    `cryptic.iter_blocks`), with `encoding` guessed from the first block if
+    None.  Like `get_df_raw`, columns are strings unless `dtype` is given;
+    other keyword arguments go to `pd.read_csv`."""
+    blocks = iter(blocks)
+    first = next(blocks, None)
+    if first is None:
+        return
+    encoding = encoding or guess_block_encoding(first) or 'utf-8'
+    kwargs.setdefault('dtype', str)
+    stream = iterable_to_stream(itertools.chain([first], blocks))
+    for chunk in pd.read_csv(stream, encoding=encoding,
+                             encoding_errors='replace', chunksize=chunksize,
+                             **kwargs):
+        yield chunk
+
+
+##############################################################################
+# Fixed-width-field data.
+
+# Byte classes for layout detection, in the style of tag_chrs.
+_FWF_SPACE, _FWF_DIGIT, _FWF_ALPHA, _FWF_OTHER = range(4)
+_FWF_MAX_DIGITS = 18  # every integer of this many digits fits in int64
+
+
+@functools.lru_cache(maxsize=None)
+def _fwf_tables():
+    """Return lookup tables from byte value to class (via `get_charclass`)
+    and to whether the byte can occur in a number."""
+    classes = {':digit:': _FWF_DIGIT, ':alpha:': _FWF_ALPHA}
+    cls = np.array([_FWF_SPACE if chr(b).isspace() or b == 0 else
+                    classes.get(get_charclass(chr(b)), _FWF_OTHER)
+                    for b in range(256)], dtype=np.uint8)
+    numeric = np.zeros(256, dtype=bool)
+    numeric[list(b' \t\r\n+-.0123456789')] = True
+    return cls, numeric
+
+
+def _line_grid(buf, width):
+    """Return an n x width uint8 array of the lines in bytes buf, padded
+    with spaces, without slicing lines in Python.  The grid is filled one
+    character position at a time, so no temporary is larger than one offset
+    per line."""
+    buf = np.frombuffer(buf, dtype=np.uint8)
+    if not len(buf):
+        return np.empty((0, width), dtype=np.uint8)
+    ends = np.flatnonzero(buf == 10)
+    if not len(ends) or ends[-1] != len(buf) - 1:
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    lens = ends - starts
+    grid = np.full((len(starts), width), 32, dtype=np.uint8)
+    for j in range(width):
+        rows = lens > j
+        grid[rows, j] = buf[starts[rows] + j]
+    grid[grid == 13] = 32
+    return grid
+
+
+def _fwf_runs(mask):
+    """Return (start, end) of the runs of True in a boolean array."""
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def detect_fwf(fn, n_sample=1000, dominance=0.95, pwd=None):
+    """Infer the layout of fixed-width-field file fn from its first n_sample
+    lines (decrypted with passphrase `pwd` if fn ends with '.gpg').
+
+    Fields are the runs of character positions that are non-blank in some
+    line, further split where the class profile of the positions (see
+    `tag_chrs`) switches between digits and letters in at least `dominance`
+    of the lines (e.g., an account number packed against a name).  The first
+    line is taken as a header if it has letters where the other lines have
+    digits, or if it has text in positions blank in every other line.
+
+    Returns a dict of `colspecs` (half-open (start, end) positions),
+    `names`, `header` (True/False), `width`, and `kinds`, one of 'int',
+    'float', or 'str' per field.  Digit fields with leading zeros (codes,
+    not quantities) are 'str'.  Returns None if fn is empty.
+    """
+    with open_input(fn, pwd=pwd) as fin:
+        lines = list(itertools.islice(fin, n_sample))
+    return _fwf_layout(lines, dominance)
+
+
+def _fwf_layout(lines, dominance=0.95):
+    """Return the layout `detect_fwf` infers from sample lines (bytes)."""
+    if not lines:
+        return None
+    width = builtins.max(len(line.rstrip(b'\r\n')) for line in lines)
+    classes, numeric = _fwf_tables()
+    grid = _line_grid(b''.join(lines), width)
+    cls = classes[grid]
+    data, header = grid, False
+    if len(grid) > 1:
+        body = cls[1:]
+        filled = np.maximum((body != _FWF_SPACE).sum(axis=0), 1)
+        digit = (body == _FWF_DIGIT).sum(axis=0) / filled >= dominance
+        first = cls[0]
+        header = bool(((first == _FWF_ALPHA) & digit).any() or
+                      ((first != _FWF_SPACE) &
+                       ~(body != _FWF_SPACE).any(axis=0)).any())
+        if header:
+            data, cls = grid[1:], body
+
+    nonblank = cls != _FWF_SPACE
+    filled = np.maximum(nonblank.sum(axis=0), 1)
+    dom = np.full(width, -1)
+    for c in (_FWF_DIGIT, _FWF_ALPHA):
+        dom[(cls == c).sum(axis=0) / filled >= dominance] = c
+    occupied = nonblank.any(axis=0)
+    if header:
+        occupied |= classes[grid[0]] != _FWF_SPACE
+    colspecs = []
+    for (start, end) in _fwf_runs(occupied):
+        cuts = [p for p in range(start + 1, end)
+                if dom[p - 1] >= 0 and dom[p] >= 0 and dom[p - 1] != dom[p]]
+        bounds = [start] + cuts + [end]
+        colspecs.extend(zip(bounds[:-1], bounds[1:]))
+
+    kinds = []
+    for (a, b) in colspecs:
+        sub = data[:, a:b]
+        kind = 'str'
+        if numeric[sub].all() and (classes[sub] == _FWF_DIGIT).any():
+            vals = np.char.strip(np.ascontiguousarray(sub).view(
+                'S%d' % (b - a)).ravel())
+            lead0 = np.char.startswith(vals, b'0') & \
+                ~np.char.startswith(vals, b'0.') & (np.char.str_len(vals) > 1)
+            # Digit runs too long for int64 (e.g., account numbers) are
+            # identifiers too.
+            if not lead0.any() and (b - a <= _FWF_MAX_DIGITS or
+                                    (sub == ord('.')).any()):
+                kind = 'float' if (sub == ord('.')).any() else 'int'
+        kinds.append(kind)
+
+    # Blank gaps belong to the right-justified (numeric) field after them,
+    # or else to the left-justified field before them, so that values wider
+    # than any in the sample are not cut.
+    bounds = [0] + [a for (a, _) in colspecs[1:]] + [width]
+    for j in range(1, len(colspecs)):
+        if kinds[j] == 'str':
+            bounds[j] = colspecs[j][0]
+        else:
+            bounds[j] = colspecs[j - 1][1]
+    colspecs = [(int(a), int(b)) for (a, b) in zip(bounds[:-1], bounds[1:])]
+
+    names = ['col%d' % j for j in range(len(colspecs))]
+    if header:
+        names = [grid[0, a:b].tobytes().decode('latin-1').strip() or name
+                 for ((a, b), name) in zip(colspecs, names)]
+    return {'colspecs': colspecs, 'names': names, 'header': header,
+            'width': width, 'kinds': kinds}
+
+
+class _FieldKindError(ValueError):
+    """A field's values do not all parse as its (numeric) kind."""
+
+    def __init__(self, name, kind):
+        super(_FieldKindError, self).__init__(
+            "field %r is not all %s; set its kind in the layout to 'str' "
+            "or pass dtype=str" % (name, kind))
+        self.name = name
+
+
+def _fwf_field(sub, kind, encoding, name=None):
+    """Convert an n x w byte view of one field to an array of values:
+    stripped strings (NaN if blank), or numbers for numeric kinds.  Raises
+    `_FieldKindError` if a numeric field has other values, so that a column
+    is never numeric in some chunks and strings in others."""
+    vals = np.char.strip(np.ascontiguousarray(sub).view(
+        'S%d' % sub.shape[1]).ravel())
+    blank = vals == b''
+    if kind in ('int', 'float'):
+        try:
+            nums = np.where(blank, b'0', vals).astype(
+                np.int64 if kind == 'int' else np.float64)
+        except (ValueError, OverflowError):
+            raise _FieldKindError(name, kind)
+        if blank.any():
+            nums = nums.astype(np.float64)
+            nums[blank] = np.nan
+        return nums
+    if codecs.lookup(encoding).name in ('latin-1', 'iso8859-1') or \
+            (sub < 128).all():
+        # Bytes are code points: widen instead of decoding.
+        vals = np.char.strip(np.ascontiguousarray(sub, dtype=np.uint32)
+                             .view('U%d' % sub.shape[1]).ravel())
+    else:
+        vals = np.char.decode(vals, encoding)
+    out = vals.astype(object)
+    out[blank] = np.nan
+    return out
+
+
+def _fwf_frame(grid, layout, dtype, encoding):
+    kinds = layout['kinds'] if dtype is None else \
+        ['str'] * len(layout['colspecs'])
+    return pd.DataFrame({name: _fwf_field(grid[:, a:b], kind, encoding, name)
+                         for (name, (a, b), kind) in zip(layout['names'],
+                                                         layout['colspecs'],
+                                                         kinds)})
+
+
+def _fwf_chunks(fin, layout, dtype, encoding, chunksize, stats=None,
+                fn=None):
+    """Yield dataframes of binary stream fin, read from the start, for
+    `read_fwf`.  fn names fin if it is a plain local file, which may then be
+    memory-mapped.  If `stats` is a dict, its 'bytes' counts the bytes
+    parsed so far."""
+    stats = {} if stats is None else stats
+    stats['bytes'] = 0
+    width = builtins.max(b for (_, b) in layout['colspecs'])
+    first = fin.readline() if layout['header'] else b''
+    line = fin.readline()
+    start, reclen = len(first), len(line)
+    size = os.path.getsize(fn) if fn is not None else 0
+    if fn is not None and reclen and (size - start) % reclen == 0 and \
+            width < reclen:
+        # Equal-length records: slice fields out of a strided view of the
+        # memory-mapped file.
+        mm = np.memmap(fn, dtype=np.uint8, mode='r', offset=start,
+                       shape=(size - start,))
+        records = mm.reshape(-1, reclen)
+        if (records[:, reclen - 1] == 10).all():
+            stats['bytes'] = start
+            for i in range(0, len(records), chunksize):
+                chunk = records[i:i + chunksize]
+                stats['bytes'] += chunk.size
+                yield _fwf_frame(chunk, layout, dtype, encoding)
+            return
+    # Ragged lines: read blocks of whole lines and pad them to a grid.
+    blocksize = builtins.max(chunksize * (reclen or 80), 1 << 16)
+    stats['bytes'] = start
+    # Read one block ahead to know whether a block is the last one (not
+    # every stream, e.g. an SFTP file, can peek).
+    pending = b''
+    ahead = line + fin.read(blocksize)
+    while ahead:
+        blk, ahead = pending + ahead, fin.read(blocksize)
+        cut = blk.rfind(b'\n') + 1 if ahead else len(blk)
+        blk, pending = blk[:cut], blk[cut:]
+        if blk:
+            stats['bytes'] += len(blk)
+            yield _fwf_frame(_line_grid(blk, width), layout, dtype, encoding)
+
+
+def _closing(stack, frames):
+    """Yield dataframes frames, and then close `stack` (which holds their
+    input open)."""
+    with stack:
+        for df in frames:
+            yield df
+
+
+@logged
+def read_fwf(fn, layout=None, dtype=None, encoding=None, chunksize=None,
+             n_sample=1000, pwd=None):
+    """Return a dataframe of fixed-width-field file fn, or an iterator of
+    dataframes of up to `chunksize` rows.
+
+    `layout` is a dict as returned by `detect_fwf` (detected from fn if
+    None).  With `dtype=str` every column is strings, like `get_df_raw`,
+    for `get_summary`; otherwise fields detected as numeric are parsed to
+    int64 or float64, ready for `shrink_df`.  Fields are cut from a
+    memory-mapped, strided view of the file when its records have equal
+    length, and from padded blocks of lines otherwise.  An empty file gives
+    an empty dataframe.
+
+    fn is decrypted with passphrase `pwd` if it ends with '.gpg'.  One
+    stream serves the layout sample, the encoding guess, and the parse, as
+    for `get_df_raw`.
+
+    A field detected as numeric from the sample keeps one dtype throughout:
+    if later lines have other values in it, the file is read again with the
+    field as strings, or, when reading in chunks (which cannot be revised
+    once yielded), ValueError is raised.
+    """
+    LOGNAME = '%s:%s' % (os.path.basename(__file__), 'read_fwf()')
+    log = get_logger(LOGNAME)
+    sniffed = {}
+    with contextlib.ExitStack() as stack:
+        fin = stack.enter_context(open_input(fn, pwd=pwd, stats=sniffed))
+        lines = list(itertools.islice(fin, n_sample)) \
+            if layout is None else []
+        head = b''.join(lines)
+        if encoding is None:
+            head += fin.read(builtins.max(0, ENCODING_SAMPLE - len(head)))
+            encoding = guess_block_encoding(head) or 'utf-8'
+            encoding = 'utf-8' if encoding == 'ASCII' else encoding
+        layout = _fwf_layout(lines) if layout is None else layout
+        if layout is None:  # empty file
+            return iter([]) if chunksize is not None else pd.DataFrame()
+        fin = rewind(fin, head)
+        local = fn if sniffed['compression'] is None and \
+            not fn.endswith('.gpg') and os.path.isfile(fn) else None
+        if chunksize is not None:
+            return _closing(stack.pop_all(), _fwf_chunks(
+                fin, layout, dtype, encoding, chunksize, fn=local))
+        with span('parse_fwf') as sp:
+            while True:
+                stats = {}
+                try:
+                    frames = list(_fwf_chunks(fin, layout, dtype, encoding,
+                                              1000000, stats, local))
+                    break
+                except _FieldKindError as e:
+                    log.warning('%s; reading it as strings', e)
+                    layout = dict(layout, kinds=[
+                        'str' if name == e.name else kind
+                        for (name, kind) in zip(layout['names'],
+                                                layout['kinds'])])
+                    if fin.seekable():
+                        fin.seek(0)
+                    else:
+                        fin = stack.enter_context(open_input(fn, pwd=pwd))
+            df = pd.concat(frames, ignore_index=True) if frames else \
+                pd.DataFrame(columns=layout['names'])
+            sp.add(rows=len(df), bytes=stats['bytes'])
+    return df
+
+
 def load_files(fnames, pwd=None, delims=None, dtype=str,
                quotechar="'", escapechar="'", quoting=csv.QUOTE_NONE,
-               usecols=None, error_bad_lines=True):
-    df = None
+               usecols=None, error_bad_lines=True, storage=None,
+               mem_budget=None):
+    """Load and concatenate delimited files, with a `fname` column naming
+    the source.  With the default dtype=str, `storage` chooses the column
+    storage as for `get_df_raw`.
+
+    `mem_budget` is as for `get_df_raw`: with dtype=str a more compact
+    storage may be used, and if the files would still not fit, an iterator
+    of dataframe chunks (each from one file) is returned."""
+    LOGNAME = '%s:%s' % (os.path.basename(__file__), 'load_files()')
+    log = get_logger(LOGNAME)
     delims = len(fnames) * ['|'] if delims is None else delims
+    raw = dtype is str
+    kwargs = {'quotechar': quotechar, 'quoting': quoting,
+              'usecols': usecols, 'encoding': 'utf-8',
+              'on_bad_lines': 'error' if error_bad_lines else 'skip'}
+    plan = None
+    if mem_budget is not None and fnames:
+        def read(fin):
+            return pd.read_table(fin, sep=delims[0], dtype=_raw_dtype(storage)
+                                 if raw else dtype, **kwargs) \
+                .assign(fname=fnames[0])
+        plan = plan_load(fnames, read, storage, mem_budget, compact=raw,
+                         pwd=pwd)
+        storage = plan['storage']
+    if raw:
+        dtype = _raw_dtype(storage)
+    chunks = _table_chunks(fnames, pwd, delims, dtype, storage,
+                           plan and plan['chunksize'], kwargs)
+    if plan and plan['chunksize']:
+        return chunks
+    frames = list(chunks)
+    df = pd.concat(frames, ignore_index=True) if frames else None
+    if plan is not None and df is not None:
+        _log_footprint(log, fnames[0], plan, df)
+    return df
+
+
+def _table_chunks(fnames, pwd, delims, dtype, storage, chunksize, kwargs):
+    """Yield the dataframes (or chunks, if chunksize is not None) of
+    `load_files`."""
     for (fname, delim) in zip(fnames, delims):
-        with open(fname) as fin:
+        with open_input(fname, pwd=pwd) as fin:
             ufin = fin
-            this_df = pd.read_table(ufin, sep=delim, dtype=dtype,
-                                    quotechar=quotechar, quoting=quoting,
-                                    usecols=usecols, encoding='utf-8',
-                                    error_bad_lines=error_bad_lines)
-            this_df['fname'] = fname
-            this_df.columns = [c.replace("'", "") for c in this_df.columns]
-            df = this_df if df is None else df.append(
-                this_df, ignore_index=True)
-    return df
+            reader = pd.read_table(ufin, sep=delim, dtype=dtype,
+                                   chunksize=chunksize, **kwargs)
+            for this_df in [reader] if chunksize is None else reader:
+                this_df['fname'] = fname
+                this_df.columns = [c.replace("'", "")
+                                   for c in this_df.columns]
+                if storage == 'dictionary':
+                    this_df = to_arrow_strings(this_df, dictionary=True)
+                yield this_df
 
 
-def df_from_sql(sql, engine):
-    df = pd.read_sql(sql, con=engine)
-    return df
+def df_from_sql(sql, engine, params=None, cache=None):
+    """Return the result of query `sql` as a dataframe.  If `cache` (a
+    `querycache.QueryCache`) is given, a warm result is read from local disk
+    instead of the database."""
+    if cache is None:
+        return pd.read_sql(sql, con=engine, params=params)
+    return cache.fetch(sql,
+                       lambda: pd.read_sql(sql, con=engine, params=params),
+                       params=params, conn_id=connection_id(engine))
 
 
 def coalesce(df, cols):
@@ -258,27 +968,68 @@ def coalesce(df, cols):
 
 
 def freq(df, attgrp, agglvl=0, multi_idx=False, cumsum=False):
-    attsumm = None
     attgrp = [attgrp] if isstring(attgrp) else attgrp
+    return freq_table(group_counts(df, attgrp), attgrp, agglvl=agglvl,
+                      multi_idx=multi_idx, cumsum=cumsum)
+
+
+def group_counts(df, attgrp):
+    """Return a Series of row counts of df by the values of the attributes
+    attgrp, nulls included."""
+    if len(attgrp) == 1:
+        counts = df[attgrp[0]].value_counts(dropna=False)
+    else:
+        counts = df.groupby(attgrp, dropna=False).size()
+    return _decode_dictionary_index(counts)
+
+
+def _decode_dictionary_index(counts):
+    """Replace dictionary-encoded Arrow levels of the index of counts with
+    plain Arrow strings, which pandas can sort with nulls."""
+    def decode(idx):
+        dtype = idx.dtype
+        if isinstance(dtype, pd.ArrowDtype) and \
+                pa.types.is_dictionary(dtype.pyarrow_dtype):
+            return idx.astype(pd.StringDtype('pyarrow'))
+        return idx
+    if isinstance(counts.index, pd.MultiIndex):
+        counts.index = counts.index.set_levels(
+            [decode(lvl) for lvl in counts.index.levels])
+    else:
+        counts.index = decode(counts.index)
+    return counts
+
+
+def add_counts(*counts):
+    """Sum Series of counts from `group_counts` by index, nulls included."""
+    counts = [c for c in counts if c is not None]
+    total = pd.concat(counts)
+    return total.groupby(level=list(range(total.index.nlevels)),
+                         dropna=False).sum()
+
+
+def freq_table(counts, attgrp, agglvl=0, multi_idx=False, cumsum=False):
+    """Return the `freq` table for counts from `group_counts`."""
+    attsumm = None
     if len(attgrp) == 1:
         agglvl = 0
-        att = attgrp[0]
-        attsumm = pd.DataFrame({'COUNT': df[att].value_counts(dropna=False)})
-        attsumm.index.names = [att]
+        attsumm = pd.DataFrame({'COUNT': counts})
+        attsumm.index.names = attgrp
     else:
-        attsumm = df[attgrp].groupby(attgrp, dropna=False).agg(lambda x: len(x))
-        attsumm = attsumm.reset_index(name='COUNT')
+        attsumm = counts.reset_index(name='COUNT')
     attsumm = attsumm.sort_values(['COUNT'], ascending=[False])
     if agglvl > 0:
         attsumm = attsumm.sort_values(
             attgrp[0:agglvl] + ['COUNT'],
-            ascending=['True'] * agglvl + [False])
-        attsumm['PERC'] = attsumm.groupby(
-            attgrp[0:agglvl], dropna=False).COUNT.apply(lambda x: 100 * x / sum(x))
+            ascending=[True] * agglvl + [False])
+        groups = attsumm.groupby(attgrp[0:agglvl], dropna=False)
+        attsumm['PERC'] = 100 * attsumm.COUNT / \
+            groups.COUNT.transform('sum')
         if cumsum:
-            attsumm['CUMPERC'] = attsumm.groupby(attgrp[0:agglvl], dropna=False).PERC.cumsum()
+            attsumm['CUMPERC'] = attsumm.groupby(
+                attgrp[0:agglvl], dropna=False).PERC.cumsum()
     else:
-        attsumm['PERC'] = 100 * attsumm.COUNT / sum(attsumm.COUNT)
+        attsumm['PERC'] = 100 * attsumm.COUNT / attsumm.COUNT.sum()
         if cumsum:
             attsumm['CUMPERC'] = attsumm.PERC.cumsum()
     if multi_idx:
@@ -286,8 +1037,161 @@ def freq(df, attgrp, agglvl=0, multi_idx=False, cumsum=False):
     return attsumm
 
 
-def get_mem_usage(pandas_obj):
-    if isinstance(pandas_obj, pd.DataFrame):
+def _code_counts(chunk, attgrp, codes):
+    """Count the rows of chunk by attgrp from the factorized columns in
+    codes (column: (codes, uniques)), nulls included."""
+    shape = [len(codes[att][1]) for att in attgrp]
+    if np.prod(shape, dtype=float) >= 2 ** 62:
+        return group_counts(chunk, attgrp)
+    key = np.ravel_multi_index([codes[att][0] for att in attgrp], shape)
+    if np.prod(shape) <= 4 * len(key):
+        cnt = np.bincount(key, minlength=int(np.prod(shape)))
+        key = np.flatnonzero(cnt)
+        cnt = cnt[key]
+    else:
+        key, cnt = np.unique(key, return_counts=True)
+    idx = np.unravel_index(key, shape)
+    levels = [codes[att][1].take(i) for (att, i) in zip(attgrp, idx)]
+    index = pd.MultiIndex.from_arrays(levels, names=attgrp) \
+        if len(attgrp) > 1 else pd.Index(levels[0], name=attgrp[0])
+    return _decode_dictionary_index(pd.Series(cnt, index=index,
+                                              name='count'))
+
+
+def rollup_counts(counts, attgrp):
+    """Return counts summed over the attributes of `counts` (a Series from
+    `group_counts` of a superset of attgrp) that are not in attgrp."""
+    names = list(counts.index.names)
+    if names == list(attgrp):
+        return counts
+    total = counts.groupby(level=[names.index(att) for att in attgrp],
+                           dropna=False).sum()
+    return _decode_dictionary_index(total)
+
+
+class FreqAccumulator(object):
+    """Single-pass `freq` for many attribute groups over chunked input.
+
+    Only the maximal groups (those not contained in another requested
+    group) are counted, with each column factorized once per chunk.  Every
+    other group, and every rollup level, is summed from their counts.
+    Accumulators of separate chunks or files combine with `merge`.
+
+    >>> acc = FreqAccumulator([['cat', 'subcat'], ['cat'], ['code']])
+    >>> for chunk in pd.read_csv(fn, dtype=str, chunksize=100000):
+    ...     acc.update(chunk)
+    >>> acc.freq(['cat', 'subcat'], agglvl=1, cumsum=True)
+    >>> acc.rollup(['cat', 'subcat'])
+    """
+
+    def __init__(self, attgrps):
+        self.attgrps = [tuple([g] if isstring(g) else g) for g in attgrps]
+        self.maximal = [g for g in dict.fromkeys(self.attgrps)
+                        if not any(set(g) < set(h) for h in self.attgrps)]
+        self.source = {g: g if g in self.maximal else
+                       builtins.min((h for h in self.maximal
+                                     if set(g) <= set(h)), key=len)
+                       for g in self.attgrps}
+        self.totals = {g: None for g in self.maximal}
+
+    def update(self, df):
+        cols = dict.fromkeys(att for g in self.maximal for att in g)
+        codes = {col: pd.factorize(df[col], use_na_sentinel=False)
+                 for col in cols}
+        for g in self.maximal:
+            self.totals[g] = add_counts(self.totals[g],
+                                        _code_counts(df, list(g), codes))
+        return self
+
+    def merge(self, other):
+        for g in self.maximal:
+            self.totals[g] = add_counts(self.totals[g], other.totals[g])
+        return self
+
+    def counts(self, attgrp):
+        """Return the Series of counts by attgrp (empty if no rows have been
+        counted)."""
+        attgrp = tuple([attgrp] if isstring(attgrp) else attgrp)
+        totals = self.totals[self.source[attgrp]]
+        if totals is None:  # no chunks
+            empty = pd.DataFrame(columns=list(attgrp), dtype=object)
+            return FreqAccumulator([attgrp]).update(empty).counts(attgrp)
+        return rollup_counts(totals, attgrp)
+
+    def freq(self, attgrp, agglvl=0, multi_idx=False, cumsum=False):
+        """Return the `freq` table of attgrp."""
+        attgrp = [attgrp] if isstring(attgrp) else list(attgrp)
+        return freq_table(self.counts(attgrp), attgrp, agglvl=agglvl,
+                          multi_idx=multi_idx, cumsum=cumsum)
+
+    def freqs(self, agglvl=0, multi_idx=False, cumsum=False):
+        """Return a dict of `freq` tables of every attribute group."""
+        return {g: self.freq(g, agglvl=builtins.min(agglvl, len(g) - 1),
+                             multi_idx=multi_idx, cumsum=cumsum)
+                for g in self.attgrps}
+
+    def rollup(self, attgrp, cumsum=False):
+        """Return the grouping sets of attgrp, from the grand total (LEVEL 0)
+        down to all of attgrp (LEVEL len(attgrp)), in one table.  Attributes
+        rolled up at a level are null.  PERC is the percentage of the parent
+        (one level up) group, and CUMPERC its running total within that
+        group, in descending order of COUNT."""
+        attgrp = [attgrp] if isstring(attgrp) else list(attgrp)
+        counts = self.counts(attgrp)
+        levels = [pd.DataFrame({'LEVEL': [0], 'COUNT': [counts.sum()],
+                                'PERC': [100.0]})]
+        for k in range(1, len(attgrp) + 1):
+            lvl = rollup_counts(counts, attgrp[:k]).reset_index(name='COUNT')
+            lvl['LEVEL'] = k
+            lvl = lvl.sort_values(attgrp[:k - 1] + ['COUNT'],
+                                  ascending=[True] * (k - 1) + [False])
+            parent = lvl.groupby(attgrp[:k - 1], dropna=False).COUNT \
+                if k > 1 else None
+            lvl['PERC'] = 100 * lvl.COUNT / (
+                parent.transform('sum') if k > 1 else lvl.COUNT.sum())
+            if cumsum:
+                lvl['CUMPERC'] = lvl.groupby(
+                    attgrp[:k - 1], dropna=False).PERC.cumsum() \
+                    if k > 1 else lvl.PERC.cumsum()
+            levels.append(lvl)
+        if cumsum:
+            levels[0]['CUMPERC'] = 100.0
+        out = pd.concat(levels, ignore_index=True)
+        return out[attgrp + [c for c in out.columns if c not in attgrp]]
+
+
+def multi_freq(data, attgrps, agglvl=0, multi_idx=False, cumsum=False,
+               chunksize=None, **kwargs):
+    """Return a dict of `freq` tables, keyed by attribute-group tuple, for
+    every group in attgrps from one pass over data.
+
+    data is a dataframe, an iterable of dataframe chunks, or a CSV file name
+    (read as strings in chunks of `chunksize` rows, with other keyword
+    arguments going to `pd.read_csv`).  agglvl is capped for each group at
+    one less than its length.
+    """
+    acc = FreqAccumulator(attgrps)
+    if isinstance(data, pd.DataFrame):
+        chunks = [data]
+    elif isstring(data):
+        kwargs.setdefault('dtype', str)
+        chunks = pd.read_csv(data, chunksize=chunksize or 1000000, **kwargs)
+    else:
+        chunks = data
+    for chunk in chunks:
+        acc.update(chunk)
+    return acc.freqs(agglvl=agglvl, multi_idx=multi_idx, cumsum=cumsum)
+
+
+def get_mem_usage(pandas_obj, estimate=False):
+    """Return the memory usage of a dataframe or series in MiB, measured
+    exactly (which walks every Python string) or, if estimate is True, by
+    `estimate_mem_usage`."""
+    if estimate:
+        frame = pandas_obj if isinstance(pandas_obj, pd.DataFrame) \
+            else pandas_obj.to_frame()
+        usage_b = estimate_mem_usage(frame).sum()
+    elif isinstance(pandas_obj, pd.DataFrame):
         usage_b = pandas_obj.memory_usage(deep=True).sum()
     else:  # we assume if not a df it's a series
         usage_b = pandas_obj.memory_usage(deep=True)
@@ -295,6 +1199,159 @@ def get_mem_usage(pandas_obj):
     return usage_mb
 
 
+def _estimate_values(obj, n_sample, rng):
+    """Return the estimated deep memory usage in bytes of Series or Index
+    obj."""
+    def usage(o, deep):
+        return o.memory_usage(deep=deep) if isinstance(o, pd.Index) \
+            else o.memory_usage(index=False, deep=deep)
+    dtype = obj.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return obj.array.codes.nbytes + \
+            _estimate_values(obj.array.categories, n_sample, rng)
+    if isinstance(obj, pd.MultiIndex) or not (
+            dtype == object or getattr(dtype, 'storage', None) == 'python'):
+        return usage(obj, True)  # buffers only, so constant time
+    n = len(obj)
+    if n <= n_sample:
+        return usage(obj, True)
+    sample = obj.take(rng.integers(0, n, n_sample))
+    return usage(obj, False) + \
+        (usage(sample, True) - usage(sample, False)) * n / n_sample
+
+
+def estimate_mem_usage(df, n_sample=1000, seed=0):
+    """Return an estimate of `df.memory_usage(deep=True)`, the bytes used by
+    the index and each column of dataframe df, in time independent of the
+    number of rows.
+
+    Numeric, categorical, and Arrow columns are measured from their buffers.
+    For columns of Python objects (including python-backed strings), the
+    per-object bytes of a random sample of `n_sample` rows are scaled up.
+    Like `deep=True`, objects shared between rows are counted once per row.
+    """
+    rng = np.random.default_rng(seed)
+    usage = {'Index': _estimate_values(df.index, n_sample, rng)}
+    for (i, col) in enumerate(df.columns):
+        usage[col] = _estimate_values(df.iloc[:, i], n_sample, rng)
+    return pd.Series(usage).round().astype('int64')
+
+
+def available_memory():
+    """Return the bytes of memory available to this process: the container
+    (cgroup) limit less current usage if there is a limit, otherwise
+    MemAvailable from /proc/meminfo, or None if neither can be read."""
+    cgroups = [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+               ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                '/sys/fs/cgroup/memory/memory.usage_in_bytes')]
+    for (fn_limit, fn_usage) in cgroups:
+        try:
+            with open(fn_limit) as fin:
+                limit = fin.read().strip()
+            with open(fn_usage) as fin:
+                used = int(fin.read())
+        except (OSError, ValueError):
+            continue
+        if limit.isdigit() and int(limit) < 2 ** 60:  # else unlimited
+            return int(limit) - used
+    try:
+        with open('/proc/meminfo') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def plan_load(fnames, read, storage=None, mem_budget='auto',
+              n_rows=PLAN_ROWS, compact=True, pwd=None):
+    """Project the in-memory size of loading files fnames and choose how to
+    load them within `mem_budget` bytes ('auto' for half of
+    `available_memory()`).
+
+    `read(stream)` parses a stream of the first `n_rows` lines of the first
+    file into a dataframe as the loader would; its estimated size is scaled
+    by the total bytes of fnames (times the compression ratio of the first
+    file, as measured while reading the sample, if it is compressed).
+
+    Returns a dict with the `storage` to use (if compact is True,
+    'dictionary' or 'arrow' may replace the requested raw `storage`,
+    whichever is smaller), the projected bytes, and a `chunksize` (rows),
+    which is None unless even the smallest storage would exceed the budget,
+    in which case chunks are sized to a quarter of it.  Remote inputs, whose
+    size is unknown, are always planned in chunks (projected and rows None).
+    """
+    stats = {}
+    with open_input(fnames[0], pwd=pwd, threads=1, stats=stats) as fin:
+        head = b''.join(itertools.islice(fin, n_rows + 1))
+    return _plan_load(fnames, head, stats, read, storage, mem_budget,
+                      compact)
+
+
+def _plan_load(fnames, head, stats, read, storage, mem_budget, compact):
+    """`plan_load` from bytes head, the first lines of fnames[0], read with
+    `open_input` statistics `stats`."""
+    log = get_logger('tabular.py:plan_load()')
+    if mem_budget == 'auto':
+        avail = available_memory()
+        if avail is None:
+            raise ValueError('cannot determine available memory; ' +
+                             'give mem_budget in bytes')
+        mem_budget = avail // 2
+    sample = read(io.BytesIO(head))
+    candidates = [storage]
+    if compact:
+        candidates += [st for st in ('dictionary', 'arrow') if st != storage]
+    per_row = {}
+    for st in candidates:
+        frame = sample if st == storage else \
+            to_arrow_strings(sample, dictionary=st == 'dictionary')
+        est = estimate_mem_usage(frame)
+        per_row[st] = float(est.drop('Index').sum()) / \
+            builtins.max(len(sample), 1)
+    best = builtins.min(candidates, key=per_row.get)
+    if not all(os.path.isfile(fn) for fn in fnames):
+        # Remote input (user@host:path) is of unknown size: stream it.
+        plan = {'storage': best, 'budget': mem_budget, 'projected': None,
+                'rows': None, 'chunksize': builtins.max(
+                    1, int(mem_budget / 4 / builtins.max(per_row[best], 1)))}
+        log.warning('size of %s unknown; loading in chunks of %d rows as %s',
+                    fnames[0], plan['chunksize'], best or 'str')
+        return plan
+    total = sum(os.path.getsize(fn) for fn in fnames)
+    if stats['raw_bytes']:  # decrypted or decompressed
+        total *= stats['bytes'] / stats['raw_bytes']
+    rows = len(sample) * total / len(head) if head else 0.0
+    projected = {st: per_row[st] * rows for st in candidates}
+    plan = {'storage': storage, 'chunksize': None, 'budget': mem_budget,
+            'projected': projected[storage], 'rows': int(round(rows))}
+    if projected[storage] > mem_budget:
+        plan.update(storage=best, projected=projected[best])
+        if projected[best] > mem_budget:
+            plan['chunksize'] = builtins.max(
+                1, int(mem_budget / 4 / builtins.max(per_row[best], 1)))
+            log.warning('projected %.1f MiB exceeds budget of %.1f MiB; ' +
+                        'loading in chunks of %d rows as %s',
+                        projected[best] / 2**20, mem_budget / 2**20,
+                        plan['chunksize'], best or 'str')
+        else:
+            log.warning('projected %.1f MiB as %s exceeds budget of ' +
+                        '%.1f MiB; loading as %s (%.1f MiB)',
+                        projected[storage] / 2**20, storage or 'str',
+                        mem_budget / 2**20, best, projected[best] / 2**20)
+    log.info('%s: projected footprint %.1f MiB (%d rows) of budget %.1f MiB',
+             os.path.basename(fnames[0]), plan['projected'] / 2**20,
+             plan['rows'], mem_budget / 2**20)
+    return plan
+
+
+def _log_footprint(log, fn, plan, df):
+    log.info('%s: projected footprint %.1f MiB, actual %.1f MiB',
+             os.path.basename(fn), plan['projected'] / 2**20,
+             get_mem_usage(df, estimate=True))
+
+
 def shrink_df(df):
     """Determine the smallest sized dtype for each column of the DataFrame
     and replace each column with a reduced copy.
@@ -306,14 +1363,14 @@ def shrink_df(df):
     df_float = df.select_dtypes(include=['float'])
     df[df_float.columns] = df_float.apply(pd.to_numeric, downcast='float')
 
-    df_obj = df.select_dtypes(include=['object'])
+    df_obj = df.select_dtypes(include=['object', 'string'])
     for col in df_obj.columns:
         num_unique_values = len(df_obj[col].unique())
         num_total_values = len(df_obj[col])
         if num_unique_values / num_total_values < 0.5:
-            df.loc[:, col] = df_obj[col].astype('category')
+            df[col] = df_obj[col].astype('category')
         else:
-            df.loc[:, col] = df_obj[col]
+            df[col] = df_obj[col]
 
 
 def get_reduced_dtypes(df):
@@ -336,8 +1393,9 @@ def get_reduced_dtypes(df):
 def gen_code_freqs(df_in, cols, fnout):
     xlwrtr = pd.ExcelWriter(fnout, engine='xlsxwriter')
 
+    acc = FreqAccumulator(cols).update(df_in)
     for col in cols:
-        df = freq(df_in, col)
+        df = acc.freq(col)
         tabname = col if isstring(col) else '-'.join(col)[0:31]
         df.to_excel(xlwrtr, sheet_name=tabname, index=True)
-    xlwrtr.save()
+    xlwrtr.close()
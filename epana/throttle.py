@@ -1,42 +1,356 @@
-from datetime import datetime, timedelta
-from time import sleep
+import asyncio
+import math
+import os
+import struct
+import threading
+from collections import Counter, deque
 from functools import wraps
+from statistics import mean, pstdev
+from time import monotonic, sleep, time
 
+from epana.logutils import get_logger
 
-# Throttles decorated function to a rate less than per_sec calls per second.
-# No consideration is given to multithreading scenarios, which could require
-# either global or thread-specific throttling.  Global throttling would be
-# required by original use cases.
+
+class _LocalState(object):
+    """Bucket state held in process memory."""
+
+    def __init__(self, burst):
+        self.tokens = float(burst)
+        self.t = monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _FileState(object):
+    """Bucket state held in a small file and guarded by an exclusive `flock`
+    so that every process on the host draws from the same bucket.
+
+    The file is opened for each transaction (rather than once per process)
+    because `flock` locks belong to the open file description, which forked
+    children would otherwise share with their parent.  Timestamps come from
+    `time.monotonic`, which is system-wide on Linux, so they are comparable
+    across processes on one host but not across hosts.
+    """
+    _fmt = '=dd'
+    _size = struct.calcsize(_fmt)
+
+    def __init__(self, path, burst):
+        self.path = path
+        self.burst = float(burst)
+        self._fd = None
+
+    def __enter__(self):
+        import fcntl
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        raw = os.pread(self._fd, self._size, 0)
+        if len(raw) == self._size:
+            self.tokens, self.t = struct.unpack(self._fmt, raw)
+        else:
+            self.tokens, self.t = self.burst, monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        import fcntl
+        try:
+            os.pwrite(self._fd, struct.pack(self._fmt, self.tokens, self.t), 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        return False
+
+
+class TokenBucket(object):
+    """Token-bucket rate limiter on a monotonic clock.
+
+    Tokens accrue at `rate` per second up to `burst`, so up to `burst` calls
+    may proceed back to back after an idle period while the long-run rate
+    stays at `rate`.  The bucket is safe to share between threads and between
+    coroutines.  If `path` is given, the bucket state lives in that file and
+    is shared by every process on the host that uses the same path (POSIX
+    only; see `_FileState`).
+
+    A blocking `acquire` reserves its tokens immediately, letting the balance
+    go negative, and then sleeps until the reservation matures.  Waiters are
+    therefore served in the order they arrive, without polling.
+    """
+
+    def __init__(self, rate, burst=1, path=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        if burst < 1:
+            raise ValueError('burst must be at least 1')
+        self.rate = float(rate)
+        self.burst = burst
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = _LocalState(burst) if path is None else \
+            _FileState(path, burst)
+
+    def _reserve(self, n, block):
+        """Take n tokens and return the seconds to wait before using them,
+        or None if block is False and the tokens are not yet available."""
+        with self._lock, self._state as st:
+            now = monotonic()
+            tokens = min(float(self.burst),
+                         st.tokens + (now - st.t) * self.rate)
+            st.t = now
+            if tokens < n and not block:
+                st.tokens = tokens
+                return None
+            st.tokens = tokens - n
+            return max(0.0, -st.tokens / self.rate)
+
+    def acquire(self, n=1, block=True):
+        """Take n tokens, sleeping until they are available if block is True.
+        Returns False only when block is False and tokens are unavailable."""
+        wait = self._reserve(n, block)
+        if wait is None:
+            return False
+        if wait > 0:
+            sleep(wait)
+        return True
+
+    async def acquire_async(self, n=1):
+        """Like `acquire` but awaits instead of blocking the event loop."""
+        wait = self._reserve(n, True)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+
+# Throttles decorated function to a rate less than per_sec calls per second,
+# allowing up to burst calls back to back.  The limit is global to the
+# decorated function across threads (and coroutines, if fn is a coroutine
+# function).  Pass path to share the limit with other processes on the host.
 class throttle(object):
-    def __init__(self, per_sec=20):
-        self.period = timedelta(microseconds=1000000 / per_sec)
-        self.t0 = datetime.min
+    def __init__(self, per_sec=20, burst=1, path=None):
+        self.bucket = TokenBucket(per_sec, burst=burst, path=path)
 
     def __call__(self, fn):
+        if asyncio.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                await self.bucket.acquire_async()
+                return await fn(*args, **kwargs)
+
+            async_wrapper.throttle = self
+            return async_wrapper
+
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            t1 = datetime.now()
-            dt = t1 - self.t0
-            secs2wait = (self.period - dt).total_seconds()
-            if secs2wait > 0:
-                sleep(secs2wait)
-
-            self.t0 = datetime.now()
+            self.bucket.acquire()
             retval = fn(*args, **kwargs)
 
             return retval
 
+        wrapper.throttle = self
+        return wrapper
+
+
+def is_throttled_response(result):
+    """Default failure test for `AdaptiveRate`: HTTP 429 or 503 responses."""
+    return getattr(result, 'status_code', None) in (429, 503)
+
+
+class AdaptiveRate(object):
+    """Additive-increase/multiplicative-decrease control of a `TokenBucket`.
+
+    Every completed call is reported to `record` with its latency and whether
+    it failed.  While calls succeed, the rate grows by `increase` calls per
+    second for each second's worth of successful calls, up to `max_per_sec`.
+    A failure (exception, timeout, or a result for which `is_failure` is
+    true), or a p95 latency over the last `window` calls that exceeds
+    `p95_factor` times the best p95 seen so far (and `p95_floor` seconds),
+    multiplies the rate by
+    `decrease`, down to `min_per_sec`.  Backoffs are at most one per
+    `cooldown` seconds, because a burst of in-flight calls usually fails
+    together.
+
+    `stats` returns the current rate, success and failure counts, latency
+    percentiles, a latency histogram, and the most recent backoff events.
+    """
+
+    def __init__(self, per_sec=20, min_per_sec=1, max_per_sec=100,
+                 increase=1.0, decrease=0.5, p95_factor=2.0, p95_floor=0.05,
+                 window=100, cooldown=1.0, burst=1, path=None):
+        if not 0 < decrease < 1:
+            raise ValueError('decrease must be between 0 and 1')
+        self.bucket = TokenBucket(per_sec, burst=burst, path=path)
+        self.min_per_sec = float(min_per_sec)
+        self.max_per_sec = float(max_per_sec)
+        self.increase = float(increase)
+        self.decrease = float(decrease)
+        self.p95_factor = float(p95_factor)
+        self.p95_floor = float(p95_floor)
+        self.window = window
+        self.cooldown = cooldown
+        self.n_ok, self.n_fail = 0, 0
+        self.baseline_p95 = None
+        self.latencies = deque(maxlen=window)
+        self.histogram = Counter()
+        self.backoffs = deque(maxlen=1000)
+        self._t_backoff = None
+        self._lock = threading.Lock()
+        self._log = get_logger('throttle.py:AdaptiveRate')
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    @staticmethod
+    def _latency_bucket(latency):
+        """Histogram bin: upper bound in msecs, in powers of two."""
+        msecs = latency * 1000
+        return 2 ** max(0, math.ceil(math.log2(msecs))) if msecs > 1 else 1
+
+    def _p(self, q):
+        lats = sorted(self.latencies)
+        return lats[min(len(lats) - 1, int(q * len(lats)))] if lats else None
+
+    def _backoff(self, reason):
+        now = monotonic()
+        if self._t_backoff is not None and \
+                now - self._t_backoff < self.cooldown:
+            return
+        self._t_backoff = now
+        old = self.bucket.rate
+        self.bucket.rate = max(self.min_per_sec, old * self.decrease)
+        self.latencies.clear()
+        self.backoffs.append({'time': time(), 'reason': reason,
+                              'old_rate': old, 'new_rate': self.bucket.rate})
+        self._log.info('backoff (%s): %.2f -> %.2f calls/sec' %
+                       (reason, old, self.bucket.rate))
+
+    def record(self, latency, failed=False, reason='error'):
+        with self._lock:
+            self.histogram[self._latency_bucket(latency)] += 1
+            if failed:
+                self.n_fail += 1
+                self._backoff(reason)
+                return
+            self.n_ok += 1
+            self.latencies.append(latency)
+            if len(self.latencies) == self.window:
+                p95 = self._p(0.95)
+                if self.baseline_p95 is None or p95 < self.baseline_p95:
+                    self.baseline_p95 = p95
+                elif p95 > max(self.p95_floor,
+                               self.p95_factor * self.baseline_p95):
+                    self._backoff('latency')
+                    return
+            rate = self.bucket.rate
+            self.bucket.rate = min(self.max_per_sec,
+                                   rate + self.increase / rate)
+
+    def stats(self):
+        with self._lock:
+            return {'rate': self.bucket.rate,
+                    'n_ok': self.n_ok,
+                    'n_fail': self.n_fail,
+                    'p50': self._p(0.50),
+                    'p95': self._p(0.95),
+                    'baseline_p95': self.baseline_p95,
+                    'histogram_ms': dict(sorted(self.histogram.items())),
+                    'backoffs': list(self.backoffs)}
+
+
+# Like throttle, but the rate adapts to observed latency and failures (see
+# AdaptiveRate).  The controller is exposed as fn.throttle.control so that
+# callers can monitor it, e.g. rxnorm_req.throttle.control.stats().
+class adaptive_throttle(throttle):
+    def __init__(self, per_sec=20, is_failure=is_throttled_response,
+                 **kwargs):
+        self.control = AdaptiveRate(per_sec=per_sec, **kwargs)
+        self.bucket = self.control.bucket
+        self.is_failure = is_failure
+
+    def _record(self, t0, retval=None, exc=None):
+        latency = monotonic() - t0
+        if exc is not None:
+            self.control.record(latency, failed=True,
+                                reason=type(exc).__name__)
+        elif self.is_failure(retval):
+            self.control.record(latency, failed=True, reason='response')
+        else:
+            self.control.record(latency)
+
+    def __call__(self, fn):
+        if asyncio.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                await self.bucket.acquire_async()
+                t0 = monotonic()
+                try:
+                    retval = await fn(*args, **kwargs)
+                except Exception as e:
+                    self._record(t0, exc=e)
+                    raise
+                self._record(t0, retval)
+                return retval
+
+            async_wrapper.throttle = self
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            self.bucket.acquire()
+            t0 = monotonic()
+            try:
+                retval = fn(*args, **kwargs)
+            except Exception as e:
+                self._record(t0, exc=e)
+                raise
+            self._record(t0, retval)
+            return retval
+
+        wrapper.throttle = self
         return wrapper
 
 
-def measure_throttle(n=5, per_sec=1):
+def measure_throttle(n=100, per_sec=20, burst=1, n_threads=1, path=None):
+    """Benchmark a `TokenBucket` by acquiring n tokens from n_threads threads.
+
+    The first `burst` acquisitions are expected to pass immediately and are
+    excluded from the steady-state figures.  Returns a dict with the target
+    rate, the achieved steady-state rate, the mean and standard deviation
+    (jitter) of the intervals between grants, the largest interval, and
+    `within_limit`, which is True if the achieved rate does not exceed the
+    target by more than 1%.
+    """
+    bucket = TokenBucket(per_sec, burst=burst, path=path)
+    times = []
+    times_lock = threading.Lock()
+    counts = [n // n_threads + (1 if i < n % n_threads else 0)
+              for i in range(n_threads)]
+
+    def worker(k):
+        for _ in range(k):
+            bucket.acquire()
+            t = monotonic()
+            with times_lock:
+                times.append(t)
 
-    @throttle(per_sec=per_sec)
-    def get_time():
-        return datetime.now()
+    threads = [threading.Thread(target=worker, args=(k,)) for k in counts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
-    times = [get_time() for i in range(0, n)]
-    laps = [(t - times[0]).total_seconds() for t in times]
-    avg_period = sum(
-        [t2 - t1 for (t1, t2) in zip(laps[:-1], laps[1:])]) / (len(laps) - 1)
-    return 1.0 / avg_period
+    times.sort()
+    steady = times[max(burst - 1, 0):]
+    intervals = [t2 - t1 for (t1, t2) in zip(steady[:-1], steady[1:])]
+    if not intervals:
+        raise ValueError('n must exceed burst to measure a steady rate')
+    achieved = len(intervals) / (steady[-1] - steady[0])
+    return {'target': float(per_sec),
+            'achieved': achieved,
+            'mean_interval': mean(intervals),
+            'jitter': pstdev(intervals),
+            'max_interval': max(intervals),
+            'within_limit': achieved <= 1.01 * per_sec}